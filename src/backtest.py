@@ -0,0 +1,375 @@
+# =============================================================================
+# Vectorized backtest of the 75 min breakout strategy
+# Applies the live rules (gap check, reference windows, strike rounding and
+# entry/target/stop levels from strategy_rules) to stored 1 min bars. Each
+# trading day is laid out on a fixed grid of 375 one-minute slots (09:15-15:29)
+# so that reference windows, entry triggers and exits are computed with NumPy
+# over all days at once. Symbols and blocks of days run in parallel processes
+#
+# Stored bars are read from the bar archive in <data_dir> (bar_archive.py),
+# partitioned by instrument and day. Underlyings are stored under their TrueData symbol
+# (e.g. 'NIFTY 50') and options under their TrueData contract symbol
+# (e.g. 'NIFTY21070815800CE'). Each day trades the nearest expiry stored
+#
+# Usage: python backtest.py <data_dir> <start YYYY-MM-DD> <end YYYY-MM-DD> [output.npy]
+# =============================================================================
+
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+from strategy_rules import is_gap, call_put_strikes, entry_levels, trail_level
+from bar_archive import BarArchive
+
+SESSION_START = '09:15'
+SESSION_MINUTES = 375 # 1 min slots from 09:15 to 15:29
+OHLC = ['o', 'h', 'l', 'c']
+O, H, L, C = 0, 1, 2, 3
+
+# Defaults mirror the parameters at the top of main.py
+DEFAULT_PARAMS = {'GAP_TRADE_TIME': '09:30',
+                  'GAP_THRESHOLD': 0.0039,
+                  'LOTS_SCALE_FACTOR': 1,
+                  'ENTRY_BUFFER': 0.02,
+                  'TARGET': 0.02,
+                  'STOP_LOSS': 0.05,
+                  'SL_BUFFER': 0.025,
+                  'strat_eval_times': ['09:16', '10:30', '11:45', '13:15', '14:54'],
+                  'reference_bar_start_times': ['14:15', '09:15', '10:30', '11:45', '13:00'],
+                  'reference_bar_end_times': ['15:29', '10:29', '11:44', '12:59', '14:14']}
+
+SYMBOL_SPECS = {'NIFTY 50': {'fo_underlying': 'NIFTY', 'lot_size': 75, 'strike_incr': 50},
+                'NIFTY BANK': {'fo_underlying': 'BANKNIFTY', 'lot_size': 25, 'strike_incr': 100}}
+
+TRADE_DTYPE = np.dtype([('symbol', 'U16'), ('day', 'datetime64[D]'), ('eval_idx', 'i1'), ('opt_type', 'U2'),
+                        ('strike', 'f8'), ('entry', 'f8'), ('tp', 'f8'), ('sl', 'f8'), ('entry_col', 'i2'),
+                        ('exit1', 'f8'), ('exit1_col', 'i2'), ('exit2', 'f8'), ('exit2_col', 'i2'), ('pnl', 'f8')])
+
+# Grid column of an 'HH:MM' time
+def minute_col(hhmm):
+    t = datetime.strptime(hhmm, '%H:%M')
+    s = datetime.strptime(SESSION_START, '%H:%M')
+    return int((t - s).total_seconds() // 60)
+
+# =============================================================================
+# Loading stored bars onto the day grid
+# =============================================================================
+
+def list_days(data_dir, instrument):
+    return BarArchive(data_dir).days(instrument)
+
+# (375, 4) OHLC grid of an instrument's bars on a day, NaN where there is no bar
+def load_day_grid(data_dir, instrument, day):
+
+    grid = np.full((SESSION_MINUTES, 4), np.nan)
+    bars = BarArchive(data_dir).read_day(instrument, day)
+    if len(bars) == 0:
+        return grid
+
+    session_start = np.datetime64(datetime.combine(day, datetime.strptime(SESSION_START, '%H:%M').time()), 's')
+    cols = ((bars['time'] - session_start) // np.timedelta64(60, 's')).astype(np.int64)
+    keep = (cols >= 0) & (cols < SESSION_MINUTES)
+    for i, f in enumerate(OHLC):
+        grid[cols[keep], i] = bars[f][keep]
+
+    return grid
+
+# Option contracts stored for an underlying: {expiry: {(strike, opt_type): td_symbol}}
+def list_option_contracts(data_dir, fo_underlying):
+
+    contracts = {}
+    for name in BarArchive(data_dir).instruments():
+        rest = name[len(fo_underlying):]
+        if not name.startswith(fo_underlying) or len(rest) < 9 or not rest[:6].isdigit() or rest[-2:] not in ('CE', 'PE'):
+            continue
+        try:
+            expiry = datetime.strptime(rest[:6], '%y%m%d').date()
+            strike = float(rest[6:-2])
+        except ValueError:
+            continue
+        contracts.setdefault(expiry, {})[(strike, rest[-2:])] = name
+
+    return contracts
+
+# All bars needed to backtest a symbol over a block of days.
+# under: (days, 750, 4) grid of the previous and current day for each day
+# options: (rows + 1, 750, 4) grids of the same two days for each option contract
+# of the day's expiry near the underlying's range. The last row is all NaN and is
+# what a missing contract (row -1) points to
+class MarketData:
+
+    def __init__(self, symbol, days, under, option_index, options, lot_size, strike_incr):
+        self.symbol = symbol
+        self.days = days
+        self.under = under
+        self.option_index = option_index # (day_idx, opt_type, strike) -> row in options
+        self.options = options
+        self.lot_size = lot_size
+        self.strike_incr = strike_incr
+
+    def option_rows(self, opt_type, strikes):
+        return np.array([self.option_index.get((i, opt_type, float(k)), -1) if np.isfinite(k) else -1 for i, k in enumerate(strikes)], dtype=np.int64)
+
+def load_market_data(data_dir, symbol, days, spec=None):
+
+    spec = spec if spec is not None else SYMBOL_SPECS[symbol]
+    all_days = list_days(data_dir, symbol)
+    positions = {d: j for j, d in enumerate(all_days)}
+    prev_days = [all_days[positions[d] - 1] if positions[d] > 0 else None for d in days]
+    # Only the block's days and the trading day before each are read
+    grids = {d: load_day_grid(data_dir, symbol, d) for d in set(days) | set(x for x in prev_days if x is not None)}
+
+    under = np.full((len(days), 2 * SESSION_MINUTES, 4), np.nan)
+    for i, d in enumerate(days):
+        if prev_days[i] is not None:
+            under[i, :SESSION_MINUTES] = grids[prev_days[i]]
+        under[i, SESSION_MINUTES:] = grids[d]
+
+    contracts = list_option_contracts(data_dir, spec['fo_underlying'])
+    expiries = sorted(contracts)
+    incr = spec['strike_incr']
+
+    option_index = {}
+    option_grids = []
+    for i, d in enumerate(days):
+        expiry = next((x for x in expiries if x >= d), None)
+        if expiry is None or np.all(np.isnan(under[i, :, H])):
+            continue
+        # Strikes are rounded from window highs/lows, so the day's range bounds them
+        lo = np.floor(np.nanmin(under[i, :, L]) / incr) * incr
+        hi = np.ceil(np.nanmax(under[i, :, H]) / incr) * incr
+        for (strike, opt_type), td_symbol in contracts[expiry].items():
+            if strike < lo or strike > hi:
+                continue
+            grid = np.full((2 * SESSION_MINUTES, 4), np.nan)
+            if prev_days[i] is not None:
+                grid[:SESSION_MINUTES] = load_day_grid(data_dir, td_symbol, prev_days[i])
+            grid[SESSION_MINUTES:] = load_day_grid(data_dir, td_symbol, d)
+            option_index[(i, opt_type, strike)] = len(option_grids)
+            option_grids.append(grid)
+
+    option_grids.append(np.full((2 * SESSION_MINUTES, 4), np.nan))
+    options = np.stack(option_grids)
+
+    return MarketData(symbol, list(days), under, option_index, options, spec['lot_size'], incr)
+
+# =============================================================================
+# Strategy
+# =============================================================================
+
+# OHLC over a per-day window [start, end] of columns in the two-day frame
+def window_ohlc(grids, start, end):
+
+    cols = np.arange(grids.shape[1])
+    mask = (cols[None, :] >= start[:, None]) & (cols[None, :] <= end[:, None])
+    valid = mask & ~np.isnan(grids[:, :, C])
+    has_bars = valid.any(axis=1)
+
+    first = np.argmax(valid, axis=1)
+    last = grids.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    rows = np.arange(grids.shape[0])
+
+    ohlc = np.full((grids.shape[0], 4), np.nan)
+    with np.errstate(invalid='ignore'):
+        ohlc[has_bars, O] = grids[rows, first, O][has_bars]
+        ohlc[has_bars, H] = np.nanmax(np.where(valid, grids[:, :, H], -np.inf), axis=1)[has_bars]
+        ohlc[has_bars, L] = np.nanmin(np.where(valid, grids[:, :, L], np.inf), axis=1)[has_bars]
+        ohlc[has_bars, C] = grids[rows, last, C][has_bars]
+
+    return ohlc
+
+# Per-day reference windows, trade times, strikes and option reference bars for
+# every evaluation. Depends only on the gap threshold and the schedule, so it can
+# be shared by parameter sets that differ in the entry/exit levels
+def prepare(market, params):
+
+    n = len(market.days)
+    session_end = SESSION_MINUTES - 1
+    prev_close = market.under[:, session_end, C]
+    curr_open = market.under[:, SESSION_MINUTES, O]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gap = is_gap(prev_close, curr_open, params['GAP_THRESHOLD']) & np.isfinite(prev_close)
+
+    evals = []
+    for k, eval_time in enumerate(params['strat_eval_times']):
+        start = np.full(n, SESSION_MINUTES + minute_col(params['reference_bar_start_times'][k]))
+        end = np.full(n, SESSION_MINUTES + minute_col(params['reference_bar_end_times'][k]))
+        trade_col = np.full(n, minute_col(eval_time))
+
+        if k == 0:
+            # Without a gap the 09:16 entry uses the previous day's last 75 min,
+            # with a gap the 09:15-09:24 bar and a trade at GAP_TRADE_TIME
+            start = np.where(gap, SESSION_MINUTES, start - SESSION_MINUTES)
+            end = np.where(gap, SESSION_MINUTES + 9, end - SESSION_MINUTES)
+            trade_col = np.where(gap, minute_col(params['GAP_TRADE_TIME']), trade_col)
+
+        ref = window_ohlc(market.under, start, end)
+        with np.errstate(invalid='ignore'):
+            call_strike, put_strike = call_put_strikes(ref[:, H], ref[:, L], market.strike_incr)
+
+        legs = {}
+        for opt_type, strikes in (('CE', call_strike), ('PE', put_strike)):
+            rows = market.option_rows(opt_type, strikes)
+            legs[opt_type] = {'strike': strikes, 'rows': rows, 'ref': window_ohlc(market.options[rows], start, end)}
+
+        evals.append({'trade_col': trade_col, 'legs': legs})
+
+    return {'gap': gap, 'evals': evals}
+
+# First column >= from_col (per day) where hit is True, SESSION_MINUTES if none
+def first_true(hit, from_col, to_col=None):
+
+    cols = np.arange(hit.shape[1])
+    hit = hit & (cols[None, :] >= from_col[:, None])
+    if to_col is not None:
+        hit = hit & (cols[None, :] < to_col[:, None])
+
+    return np.where(hit.any(axis=1), np.argmax(hit, axis=1), SESSION_MINUTES)
+
+# Exits of positions entered at fill_col. Both lots stop out at sl unless tp is
+# reached first; then one lot takes profit and the other trails (strategy_rules.trail_level).
+# Anything still open is closed at the day's last close
+def exits(bars, entry, tp, sl, fill_col):
+
+    n = bars.shape[0]
+    rows = np.arange(n)
+    cols = np.arange(SESSION_MINUTES)
+    valid_close = ~np.isnan(bars[:, :, C])
+    last_col = SESSION_MINUTES - 1 - np.argmax(valid_close[:, ::-1], axis=1)
+    last_close = bars[rows, last_col, C]
+
+    with np.errstate(invalid='ignore'):
+        sl_col = first_true(bars[:, :, L] <= sl[:, None], fill_col + 1)
+        tp_col = first_true(bars[:, :, H] >= tp[:, None], fill_col + 1)
+
+    stopped = sl_col <= tp_col
+    stopped_out = stopped & (sl_col < SESSION_MINUTES)
+    exit1 = np.where(stopped_out, sl, last_close)
+    exit1_col = np.where(stopped_out, sl_col, last_col)
+    exit2 = exit1.copy()
+    exit2_col = exit1_col.copy()
+
+    took_profit = ~stopped
+    if took_profit.any():
+        exit1 = np.where(took_profit, tp, exit1)
+        exit1_col = np.where(took_profit, tp_col, exit1_col)
+
+        highs = np.where(cols[None, :] >= tp_col[:, None], np.nan_to_num(bars[:, :, H], nan=-np.inf), -np.inf)
+        trail = trail_level(tp[:, None], np.maximum.accumulate(highs, axis=1))
+        # A bar can only hit the stop set from the bars before it
+        trail_prev = np.concatenate([np.full((n, 1), np.inf), trail[:, :-1]], axis=1)
+        with np.errstate(invalid='ignore'):
+            trail_col = first_true(bars[:, :, L] <= trail_prev, tp_col + 1)
+        trailed_out = took_profit & (trail_col < SESSION_MINUTES)
+        exit2 = np.where(trailed_out, trail_prev[rows, np.minimum(trail_col, SESSION_MINUTES - 1)], np.where(took_profit, last_close, exit2))
+        exit2_col = np.where(trailed_out, trail_col, np.where(took_profit, last_col, exit2_col))
+
+    return exit1, exit1_col, exit2, exit2_col
+
+# Trades for one parameter set given the prepared inputs
+def simulate(market, prepared, params):
+
+    n = len(market.days)
+    qty = market.lot_size * params['LOTS_SCALE_FACTOR']
+    evals = prepared['evals']
+    trades = []
+
+    for opt_type in ('CE', 'PE'):
+        busy_until = np.full(n, -1) # column at which the open position exits
+        for k, ev in enumerate(evals):
+            leg = ev['legs'][opt_type]
+            start = ev['trade_col']
+            # An unfilled entry order stays until the next evaluation replaces it
+            stop = evals[k + 1]['trade_col'] if k + 1 < len(evals) else np.full(n, SESSION_MINUTES)
+
+            with np.errstate(invalid='ignore'):
+                entry, tp, sl = entry_levels(leg['ref'][:, H], leg['ref'][:, L], params['ENTRY_BUFFER'], params['TARGET'],
+                                             params['STOP_LOSS'], params['SL_BUFFER'])
+            armed = np.isfinite(entry) & (leg['rows'] >= 0) & (busy_until < start)
+            if not armed.any():
+                continue
+
+            days = np.nonzero(armed)[0]
+            bars = market.options[leg['rows'][days], SESSION_MINUTES:]
+            with np.errstate(invalid='ignore'):
+                fill_col = first_true(bars[:, :, H] >= entry[days, None], start[days], stop[days])
+            filled = fill_col < SESSION_MINUTES
+            if not filled.any():
+                continue
+
+            days, bars, fill_col = days[filled], bars[filled], fill_col[filled]
+            exit1, exit1_col, exit2, exit2_col = exits(bars, entry[days], tp[days], sl[days], fill_col)
+            busy_until[days] = np.maximum(exit1_col, exit2_col)
+
+            t = np.zeros(len(days), dtype=TRADE_DTYPE)
+            t['symbol'] = market.symbol
+            t['day'] = np.array(market.days, dtype='datetime64[D]')[days]
+            t['eval_idx'] = k
+            t['opt_type'] = opt_type
+            t['strike'] = leg['strike'][days]
+            t['entry'] = entry[days]
+            t['tp'] = tp[days]
+            t['sl'] = sl[days]
+            t['entry_col'] = fill_col
+            t['exit1'] = exit1
+            t['exit1_col'] = exit1_col
+            t['exit2'] = exit2
+            t['exit2_col'] = exit2_col
+            t['pnl'] = (exit1 + exit2 - 2 * entry[days]) * qty
+            trades.append(t)
+
+    if len(trades) == 0:
+        return np.zeros(0, dtype=TRADE_DTYPE)
+
+    trades = np.concatenate(trades)
+    return trades[np.lexsort((trades['entry_col'], trades['day']))]
+
+def _run_block(args):
+
+    data_dir, symbol, days, params = args
+    market = load_market_data(data_dir, symbol, days)
+
+    return simulate(market, prepare(market, params), params)
+
+# Backtest symbols over [start, end] with blocks of days_per_block days per process.
+# Returns a TRADE_DTYPE array sorted by day
+def run_backtest(data_dir, start, end, symbols=None, params=None, workers=None, days_per_block=60):
+
+    symbols = symbols if symbols is not None else list(SYMBOL_SPECS)
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+
+    blocks = []
+    for symbol in symbols:
+        days = [d for d in list_days(data_dir, symbol) if start <= d <= end]
+        for i in range(0, len(days), days_per_block):
+            blocks.append((data_dir, symbol, days[i:i + days_per_block], params))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_run_block, blocks))
+
+    if len(results) == 0:
+        return np.zeros(0, dtype=TRADE_DTYPE)
+
+    trades = np.concatenate(results)
+    return trades[np.argsort(trades['day'], kind='stable')]
+
+def summarize(trades):
+
+    summary = {}
+    for symbol in np.unique(trades['symbol']):
+        pnl = trades['pnl'][trades['symbol'] == symbol]
+        summary[symbol] = {'trades': len(pnl), 'pnl': float(pnl.sum()), 'win_rate': float((pnl > 0).mean()) if len(pnl) else np.nan}
+
+    return summary
+
+if __name__ == '__main__':
+
+    data_dir = sys.argv[1]
+    start = datetime.strptime(sys.argv[2], '%Y-%m-%d').date()
+    end = datetime.strptime(sys.argv[3], '%Y-%m-%d').date()
+
+    trades = run_backtest(data_dir, start, end)
+    for symbol, stats in summarize(trades).items():
+        print(symbol + ': ' + str(stats['trades']) + ' trades, PnL ' + str(round(stats['pnl'], 2)) + ', win rate ' + str(round(stats['win_rate'], 3)))
+    if len(sys.argv) > 4:
+        np.save(sys.argv[4], trades)
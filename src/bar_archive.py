@@ -0,0 +1,247 @@
+# =============================================================================
+# Local archive of 1 min bars
+# The canonical store of underlying and option bars, partitioned as
+# <root>/<instrument>/<YYYY-MM-DD>.bars under the TrueData symbol. A partition
+# is a headerless run of fixed size records (BAR_DTYPE) sorted by time, so it
+# is read with a memory map and a time range is a binary-search slice of it,
+# without copying. Bars closed by the live feed are appended to the end of
+# their partition; history fetched in bulk is merged in and rewrites the
+# partition atomically, so open readers keep a consistent view.
+#
+# Partitions in the older <YYYY-MM-DD>.npz layout (arrays time, o, h, l, c, v)
+# are still read, and a .bars partition of the same day takes precedence
+#
+# Usage: python bar_archive.py import <npz_dir> <archive_dir>
+# =============================================================================
+
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+
+BAR_DTYPE = np.dtype([('time', '<M8[s]'), ('o', '<f8'), ('h', '<f8'), ('l', '<f8'), ('c', '<f8'), ('v', '<f8')])
+FIELDS = ['o', 'h', 'l', 'c', 'v']
+SESSION_LAST_BAR = '15:29' # A past day whose partition reaches this minute is complete
+
+def _day_name(day):
+    return day.strftime('%Y-%m-%d')
+
+# Structured array of the list of dicts returned by get_historic_data, sorted by time
+def to_array(records):
+
+    records = sorted(records, key=lambda x: x['time'])
+    bars = np.empty(len(records), dtype=BAR_DTYPE)
+    if len(records) > 0:
+        bars['time'] = np.array([x['time'] for x in records], dtype='datetime64[s]')
+        for f in FIELDS:
+            bars[f] = np.array([x.get(f, np.nan) for x in records], dtype=np.float64)
+
+    return bars
+
+# List of dicts with the layout of get_historic_data
+def to_records(bars):
+    return [{'time': t, 'o': o, 'h': h, 'l': l, 'c': c, 'v': v}
+            for t, o, h, l, c, v in zip(bars['time'].astype(datetime), *[bars[f].tolist() for f in FIELDS])]
+
+# The weekday before day, the previous trading day unless it was a holiday
+def previous_weekday(day):
+
+    day -= timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+
+    return day
+
+class BarArchive:
+
+    def __init__(self, root):
+        self.root = root
+        self.pending = {} # (instrument, day) -> bars closed by the live feed, not yet written
+        self.last_time = {} # (instrument, day) -> time of the last bar in the partition
+        self.lock = threading.Lock() # guards pending and last_time
+        self.write_lock = threading.Lock() # serialises writes to partitions
+
+    def _path(self, instrument, day, ext='.bars'):
+        return os.path.join(self.root, instrument, _day_name(day) + ext)
+
+    def instruments(self):
+        return sorted(x for x in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, x))) if os.path.isdir(self.root) else []
+
+    # Sorted dates with a partition for an instrument
+    def days(self, instrument):
+
+        path = os.path.join(self.root, instrument)
+        if not os.path.isdir(path):
+            return []
+
+        return sorted(set(datetime.strptime(x[:10], '%Y-%m-%d').date() for x in os.listdir(path) if x.endswith('.bars') or x.endswith('.npz')))
+
+    # Bars of an instrument on a day as a read-only structured array, memory mapped
+    # when the partition is in the .bars layout. Empty if there is no partition
+    def read_day(self, instrument, day):
+
+        path = self._path(instrument, day)
+        if os.path.exists(path):
+            if os.path.getsize(path) < BAR_DTYPE.itemsize:
+                return np.empty(0, dtype=BAR_DTYPE)
+            return np.memmap(path, dtype=BAR_DTYPE, mode='r', shape=(os.path.getsize(path) // BAR_DTYPE.itemsize,))
+
+        path = self._path(instrument, day, '.npz')
+        if os.path.exists(path):
+            npz = np.load(path, allow_pickle=False)
+            bars = np.empty(len(npz['time']), dtype=BAR_DTYPE)
+            bars['time'] = npz['time'].astype('datetime64[s]')
+            for f in FIELDS:
+                bars[f] = npz[f] if f in npz.files else np.nan
+            return bars
+
+        return np.empty(0, dtype=BAR_DTYPE)
+
+    # Bars with start <= time <= end. A range within one day is a view of the
+    # partition; a range across days is concatenated
+    def read(self, instrument, start, end):
+
+        parts = []
+        for day in self.days(instrument):
+            if start.date() <= day <= end.date():
+                bars = self.read_day(instrument, day)
+                i = int(np.searchsorted(bars['time'], np.datetime64(start, 's'), side='left'))
+                j = int(np.searchsorted(bars['time'], np.datetime64(end, 's'), side='right'))
+                parts.append(bars[i:max(i, j)])
+
+        if len(parts) == 0:
+            return np.empty(0, dtype=BAR_DTYPE)
+
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    # True if a past day's partition holds the session's last minute
+    def is_complete(self, instrument, day):
+
+        bars = self.read_day(instrument, day)
+        last = datetime.combine(day, datetime.strptime(SESSION_LAST_BAR, '%H:%M').time())
+
+        return len(bars) > 0 and bars['time'][-1] >= np.datetime64(last, 's')
+
+    def _last_time(self, instrument, day):
+
+        key = (instrument, day)
+        if key not in self.last_time:
+            bars = self.read_day(instrument, day)
+            self.last_time[key] = bars['time'][-1] if len(bars) > 0 else None
+
+        return self.last_time[key]
+
+    # Merge bars (list of dicts or a structured array) into their partitions. Where
+    # both have a bar for a minute the new one is kept. Each partition touched is
+    # rewritten to a temporary file and moved into place
+    def write(self, instrument, bars):
+
+        bars = to_array(bars) if isinstance(bars, list) else bars
+        if len(bars) == 0:
+            return
+        days = bars['time'].astype('datetime64[D]')
+
+        with self.write_lock:
+            os.makedirs(os.path.join(self.root, instrument), exist_ok=True)
+            for day in np.unique(days):
+                new = bars[days == day]
+                day = day.astype(datetime)
+                old = np.array(self.read_day(instrument, day))
+                merged = np.concatenate([new, old[~np.isin(old['time'], new['time'])]])
+                merged = merged[np.argsort(merged['time'], kind='stable')]
+                path = self._path(instrument, day)
+                merged.tofile(path + '.tmp')
+                os.replace(path + '.tmp', path)
+                with self.lock:
+                    self.last_time[(instrument, day)] = merged['time'][-1]
+
+    # Queue a bar closed by the live feed (a dict with time, o, h, l, c, v). Written
+    # by the next flush if it is newer than the last bar of its partition
+    def append(self, instrument, bar):
+        with self.lock:
+            self.pending.setdefault((instrument, bar['time'].date()), []).append(bar)
+
+    # Append the queued bars to the end of their partitions
+    def flush(self):
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        with self.write_lock:
+            for (instrument, day), bars in pending.items():
+                last = self._last_time(instrument, day)
+                bars = to_array(bars)
+                if last is not None:
+                    bars = bars[bars['time'] > last]
+                if len(bars) == 0:
+                    continue
+                os.makedirs(os.path.join(self.root, instrument), exist_ok=True)
+                with open(self._path(instrument, day), 'ab') as f:
+                    bars.tofile(f)
+                with self.lock:
+                    self.last_time[(instrument, day)] = bars['time'][-1]
+
+    # Flush every interval seconds in a background thread
+    def start_writer(self, interval=5):
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    print('Bar archive write failed: ' + repr(e))
+
+        thread = threading.Thread(target=run, name='bar-archive-writer', daemon=True)
+        thread.start()
+
+        return thread
+
+# Startup history for symbols, read locally where the archive has it. A symbol
+# whose last history_days - 1 trading days are complete in the archive only
+# fetches the current day from TrueData; the others fetch history_days in one
+# concurrent batch, which is merged into the archive to fill the gap. Returns
+# {symbol: list of dicts} like get_data_underlyings
+def archived_history(archive, td_app, symbols, now, fetch, history_days=3):
+
+    today = now.date()
+    past = {}
+    for symbol in symbols:
+        days = [x for x in archive.days(symbol) if x < today][-(history_days - 1):]
+        if len(days) == history_days - 1 and days[-1] == previous_weekday(today) and all(archive.is_complete(symbol, x) for x in days):
+            past[symbol] = days
+
+    data_1min = {}
+    recent = [x for x in symbols if x in past]
+    backfill = [x for x in symbols if x not in past]
+    if len(recent) > 0:
+        data_1min.update(fetch(td_app, recent, duration='1 D'))
+    if len(backfill) > 0:
+        data_1min.update(fetch(td_app, backfill, duration=str(history_days) + ' D'))
+
+    curr_minute = now.replace(second=0, microsecond=0)
+    for symbol, history in data_1min.items():
+        archive.write(symbol, [x for x in history if x['time'] < curr_minute])
+    for symbol, days in past.items():
+        data_1min[symbol] = ([x for day in days for x in to_records(archive.read_day(symbol, day))] +
+                             [x for x in data_1min.get(symbol, []) if x['time'].date() > days[-1]])
+
+    return data_1min
+
+# Convert a directory in the .npz layout to .bars partitions
+def import_npz(npz_dir, archive_dir):
+
+    source = BarArchive(npz_dir)
+    archive = BarArchive(archive_dir)
+    for instrument in source.instruments():
+        for day in source.days(instrument):
+            archive.write(instrument, source.read_day(instrument, day))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 4 or sys.argv[1] != 'import':
+        print('Usage: python bar_archive.py import <npz_dir> <archive_dir>')
+        sys.exit(1)
+    import_npz(sys.argv[2], sys.argv[3])
@@ -0,0 +1,173 @@
+# =============================================================================
+# In-process store of 1 min bars per symbol
+# Seeded once from TrueData history at startup and then kept current from the
+# live feed started by connect_to_TD, so evaluations read bars from memory
+# instead of re-downloading 3 days of history every time. History bars and live
+# ticks are also passed to an optional WindowAggregator (window_aggregator.py)
+# that keeps the reference windows current, and closed bars can be appended to
+# the bar archive (bar_archive.py)
+# =============================================================================
+
+import threading
+import time
+from datetime import datetime
+from bars import Bars
+
+class BarStore:
+
+    def __init__(self, aggregator=None):
+        self.aggregator = aggregator
+        self.tick_listeners = [] # called as listener(symbol, timestamp, ltp) for every live tick
+        self.bar_listeners = [] # called as listener(symbol, bar) for every bar closed from ticks, under the lock
+        self.bars = {} # symbol -> Bars of completed 1 min bars
+        self.live_bar = {} # symbol -> 1 min bar currently being built from ticks
+        self.last_volume = {} # symbol -> last cumulative day volume seen on the feed
+        self.lock = threading.Lock()
+
+    # Load history for a symbol. Bars for the current (incomplete) minute are dropped
+    # as the live feed rebuilds them, and a bar the feed is already building for
+    # the current minute is kept
+    def seed(self, symbol, history, now=None):
+
+        now = now if now is not None else datetime.now()
+        curr_minute = now.replace(second=0, microsecond=0)
+        history = [x for x in history if x['time'] < curr_minute]
+        bars = Bars.from_records(history)
+        if self.aggregator is not None:
+            for x in history:
+                self.aggregator.on_bar(symbol, x['time'], x['o'], x['h'], x['l'], x['c'])
+
+        with self.lock:
+            self.bars[symbol] = bars
+            if symbol in self.live_bar and self.live_bar[symbol]['time'] < curr_minute:
+                self.live_bar.pop(symbol)
+
+    # Merge history into the bars held for a symbol, e.g. the minutes missed while
+    # the feed was down. History replaces the bars of the minutes from its first
+    # bar on, earlier bars are kept. Returns the number of history bars merged
+    def backfill(self, symbol, history, now=None):
+
+        now = now if now is not None else datetime.now()
+        curr_minute = now.replace(second=0, microsecond=0)
+        history = sorted((x for x in history if x['time'] < curr_minute), key=lambda x: x['time'])
+        if len(history) == 0:
+            return 0
+        if self.aggregator is not None:
+            for x in history:
+                self.aggregator.on_bar(symbol, x['time'], x['o'], x['h'], x['l'], x['c'])
+
+        with self.lock:
+            kept = []
+            bars = self.bars.get(symbol)
+            if bars is not None:
+                i, _ = bars.window(history[0]['time'], history[0]['time'])
+                kept = [{'time': t, 'o': o, 'h': h, 'l': l, 'c': c, 'v': v}
+                        for t, o, h, l, c, v in zip(bars.time[:i].astype(datetime), bars.o[:i], bars.h[:i], bars.l[:i], bars.c[:i], bars.v[:i])]
+            self.bars[symbol] = Bars.from_records(kept + history)
+            if symbol in self.live_bar and self.live_bar[symbol]['time'] <= history[-1]['time']:
+                self.live_bar.pop(symbol)
+
+        return len(history)
+
+    # Fold a live tick into the bar for its minute. Ticks older than the bar being
+    # built are ignored here but still reach the aggregator, which decides by now
+    # (the receive time) whether their window is still open
+    def on_tick(self, symbol, timestamp, ltp, volume=None, now=None):
+
+        minute = timestamp.replace(second=0, microsecond=0)
+        if self.aggregator is not None:
+            self.aggregator.on_tick(symbol, timestamp, ltp, now)
+        for listener in self.tick_listeners:
+            listener(symbol, timestamp, ltp)
+
+        with self.lock:
+            bar_volume = 0
+            if volume is not None:
+                if symbol in self.last_volume and volume >= self.last_volume[symbol]:
+                    bar_volume = volume - self.last_volume[symbol]
+                self.last_volume[symbol] = volume
+
+            bar = self.live_bar.get(symbol)
+            if bar is not None and minute < bar['time']:
+                return
+
+            if bar is None or minute > bar['time']:
+                self._close_live_bar(symbol)
+                self.live_bar[symbol] = {'time': minute, 'o': ltp, 'h': ltp, 'l': ltp, 'c': ltp, 'v': bar_volume}
+            else:
+                bar['h'] = max(bar['h'], ltp)
+                bar['l'] = min(bar['l'], ltp)
+                bar['c'] = ltp
+                bar['v'] += bar_volume
+
+    # Close live bars that belong to a minute earlier than now, so that a symbol
+    # without fresh ticks still has its last bar available at an evaluation
+    def roll(self, now=None):
+
+        now = now if now is not None else datetime.now()
+        curr_minute = now.replace(second=0, microsecond=0)
+
+        with self.lock:
+            for symbol in list(self.live_bar.keys()):
+                if self.live_bar[symbol]['time'] < curr_minute:
+                    self._close_live_bar(symbol)
+
+    # Snapshot of the completed bars for a symbol
+    def get_bars(self, symbol, now=None):
+
+        self.roll(now)
+        with self.lock:
+            bars = self.bars.get(symbol)
+            return bars.snapshot() if bars is not None else Bars()
+
+    def _close_live_bar(self, symbol):
+
+        bar = self.live_bar.pop(symbol, None)
+        if bar is None:
+            return
+
+        bars = self.bars.setdefault(symbol, Bars())
+        # History wins over a bar rebuilt from a partial stream of ticks
+        if len(bars) == 0 or bar['time'] > bars.last_time():
+            bars.append(bar['time'], bar['o'], bar['h'], bar['l'], bar['c'], bar['v'])
+            for listener in self.bar_listeners:
+                listener(symbol, bar)
+
+# Seed the store with history for all symbols
+def seed_bar_store(bar_store, td_app, SYMBOLS, get_history, now=None):
+
+    data_1min = get_history(td_app, SYMBOLS)
+    now = now if now is not None else datetime.now()
+    for symbol in SYMBOLS:
+        bar_store.seed(symbol, data_1min.get(symbol, []), now)
+
+# Identity of a live tick. The feed's timestamps are to the second, so the ticks
+# of a liquid contract within one second are told apart by price and traded quantity
+def tick_key(tick):
+    return (tick.timestamp, tick.ltp, getattr(tick, 'ttq', None))
+
+# Poll the TrueData live data objects for new ticks and feed them to the store.
+# req_ids may be added to or removed from while the thread runs
+def start_live_updates(td_app, req_ids, bar_store, interval=0.05, clock=None):
+
+    def poll():
+        last_seen = {}
+        while True:
+            for req_id in list(req_ids):
+                try:
+                    tick = td_app.live_data[req_id]
+                    timestamp = tick.timestamp
+                    key = tick_key(tick)
+                    if timestamp is None or tick.ltp is None or last_seen.get(req_id) == key:
+                        continue
+                    last_seen[req_id] = key
+                    bar_store.on_tick(tick.symbol, timestamp, tick.ltp, getattr(tick, 'ttq', None),
+                                      clock.now() if clock is not None else datetime.now())
+                except (KeyError, AttributeError, TypeError):
+                    pass
+            time.sleep(interval)
+
+    thread = threading.Thread(target=poll, name='live-bar-updates', daemon=True)
+    thread.start()
+
+    return thread
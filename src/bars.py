@@ -0,0 +1,146 @@
+# =============================================================================
+# Columnar 1 min bar series
+# Bars are held in NumPy arrays with a sorted timestamp column so that a
+# window's OHLC is a binary-search slice plus vectorized max/min, and an
+# exact-time lookup is O(log n)
+# =============================================================================
+
+from datetime import datetime
+import numpy as np
+
+FIELDS = ['o', 'h', 'l', 'c', 'v']
+
+def to_datetime64(t):
+    return np.datetime64(t, 's')
+
+class Bars:
+
+    def __init__(self, capacity=0):
+        capacity = max(capacity, 16)
+        self._time = np.empty(capacity, dtype='datetime64[s]')
+        self._cols = {f: np.empty(capacity, dtype=np.float64) for f in FIELDS}
+        self._n = 0
+
+    # Build from the list of dicts returned by get_historic_data
+    @classmethod
+    def from_records(cls, records):
+
+        records = sorted(records, key=lambda x: x['time'])
+        bars = cls(len(records))
+        n = len(records)
+        if n > 0:
+            bars._time[:n] = np.array([x['time'] for x in records], dtype='datetime64[s]')
+            for f in FIELDS:
+                bars._cols[f][:n] = np.array([x.get(f, np.nan) for x in records], dtype=np.float64)
+        bars._n = n
+
+        return bars
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def time(self):
+        return self._time[:self._n]
+
+    @property
+    def o(self):
+        return self._cols['o'][:self._n]
+
+    @property
+    def h(self):
+        return self._cols['h'][:self._n]
+
+    @property
+    def l(self):
+        return self._cols['l'][:self._n]
+
+    @property
+    def c(self):
+        return self._cols['c'][:self._n]
+
+    @property
+    def v(self):
+        return self._cols['v'][:self._n]
+
+    # Append a bar that is newer than the last one held. Storage grows geometrically
+    def append(self, t, o, h, l, c, v=0):
+
+        t = to_datetime64(t)
+        if self._n > 0 and t <= self._time[self._n - 1]:
+            raise ValueError('Bars must be appended in time order')
+
+        if self._n == len(self._time):
+            capacity = len(self._time) * 2
+            time_col = np.empty(capacity, dtype='datetime64[s]')
+            time_col[:self._n] = self._time[:self._n]
+            self._time = time_col
+            for f in FIELDS:
+                col = np.empty(capacity, dtype=np.float64)
+                col[:self._n] = self._cols[f][:self._n]
+                self._cols[f] = col
+
+        i = self._n
+        self._time[i] = t
+        self._cols['o'][i] = o
+        self._cols['h'][i] = h
+        self._cols['l'][i] = l
+        self._cols['c'][i] = c
+        self._cols['v'][i] = v
+        self._n += 1
+
+    # Read-only view of the bars held right now. Later appends are not visible in it
+    def snapshot(self):
+
+        view = Bars.__new__(Bars)
+        view._time = self._time[:self._n]
+        view._cols = {f: self._cols[f][:self._n] for f in FIELDS}
+        view._n = self._n
+
+        return view
+
+    # Index range [i, j) of bars with start <= time <= end
+    def window(self, start, end):
+
+        i = int(np.searchsorted(self.time, to_datetime64(start), side='left'))
+        j = int(np.searchsorted(self.time, to_datetime64(end), side='right'))
+
+        return i, max(i, j)
+
+    # OHLC of all bars with start <= time <= end, None if there are none
+    def window_ohlc(self, start, end):
+
+        i, j = self.window(start, end)
+        if i == j:
+            return None
+
+        return {'o': float(self._cols['o'][i]),
+                'h': float(self._cols['h'][i:j].max()),
+                'l': float(self._cols['l'][i:j].min()),
+                'c': float(self._cols['c'][j - 1])}
+
+    # Index of the bar stamped exactly at t, -1 if there is none
+    def index_at(self, t):
+
+        t = to_datetime64(t)
+        i = int(np.searchsorted(self.time, t, side='left'))
+        if i < self._n and self._time[i] == t:
+            return i
+
+        return -1
+
+    # Value of a field for the bar stamped exactly at t, None if there is none
+    def value_at(self, t, field):
+
+        i = self.index_at(t)
+        if i < 0:
+            return None
+
+        return float(self._cols[field][i])
+
+    def last_time(self):
+        return self._time[self._n - 1].astype(datetime) if self._n > 0 else None
+
+    # Sorted list of the distinct trading dates held
+    def dates(self):
+        return np.unique(self.time.astype('datetime64[D]')).tolist()
@@ -0,0 +1,161 @@
+# =============================================================================
+# Offline session benchmark
+# Drives main.run_strategy through a full session against the simulated broker
+# and feed (simulation.py) on an accelerated clock and reports throughput and
+# latency percentiles per stage. Results can be saved and compared against a
+# saved baseline to catch regressions
+#
+# Usage: python benchmark.py [--speed 600] [--extra-symbols 0] [--end 15:30]
+#                            [--broker-latency 0] [--history-latency 0] [--reject-rate 0]
+#                            [--day YYYY-MM-DD] [--data-dir DIR]
+#                            [--replay session.log] [--replay-speed 0] [--feed-stall HH:MM-HH:MM]
+#                            [--save results.json] [--compare baseline.json] [--tolerance 0.25]
+# =============================================================================
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# Stages whose p99 is compared against the baseline
+COMPARED_STAGES = ['run_strategy_eval', 'run_strategy_monitor', 'positions', 'orderbook', 'sl_order', 'limit_order', 'delete_orders']
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description='Run a simulated session and report latency and throughput')
+    parser.add_argument('--speed', type=float, default=600, help='Simulated seconds per real second')
+    parser.add_argument('--extra-symbols', type=int, default=0, help='Synthetic underlyings traded in addition to SYMBOLS')
+    parser.add_argument('--start', default='09:00', help='Simulated start time HH:MM, early enough to leave room for startup')
+    parser.add_argument('--end', default=None, help='Session end time HH:MM, default 15:30 or where the replayed recording ends')
+    parser.add_argument('--day', default=None, help='Simulated trading day YYYY-MM-DD')
+    parser.add_argument('--data-dir', default=None, help='Recorded bars in the backtest layout')
+    parser.add_argument('--broker-latency', type=float, default=0, help='Seconds added to every broker call')
+    parser.add_argument('--history-latency', type=float, default=0, help='Seconds added to every history request')
+    parser.add_argument('--reject-rate', type=float, default=0, help='Share of orders rejected by the broker')
+    parser.add_argument('--feed-stall', default=None, help='HH:MM-HH:MM in which the primary feed session stops updating')
+    parser.add_argument('--replay', default=None, help='Replay this session recording instead of simulating a session')
+    parser.add_argument('--replay-speed', type=float, default=0, help='Replay speed, 0 for as fast as possible')
+    parser.add_argument('--save', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Baseline JSON file to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative p99 increase over the baseline')
+
+    return parser.parse_args(argv)
+
+# The simulated session is configured through environment variables read when main starts up
+def configure(args):
+
+    if args.replay is not None:
+        os.environ['INTRADAY_BACKEND'] = 'replay'
+        os.environ['INTRADAY_REPLAY_LOG'] = args.replay
+        os.environ['INTRADAY_REPLAY_SPEED'] = str(args.replay_speed)
+        return
+
+    os.environ['INTRADAY_BACKEND'] = 'sim'
+    os.environ['INTRADAY_SIM_SPEED'] = str(args.speed)
+    os.environ['INTRADAY_SIM_START'] = args.start
+    os.environ['INTRADAY_SIM_EXTRA_SYMBOLS'] = str(args.extra_symbols)
+    os.environ['INTRADAY_SIM_BROKER_LATENCY'] = str(args.broker_latency)
+    os.environ['INTRADAY_SIM_HISTORY_LATENCY'] = str(args.history_latency)
+    os.environ['INTRADAY_SIM_REJECT_RATE'] = str(args.reject_rate)
+    if args.day is not None:
+        os.environ['INTRADAY_SIM_DAY'] = args.day
+    if args.data_dir is not None:
+        os.environ['INTRADAY_SIM_DATA_DIR'] = args.data_dir
+    if args.feed_stall is not None:
+        os.environ['INTRADAY_SIM_FEED_STALL'] = args.feed_stall
+
+def run(args):
+
+    configure(args)
+
+    started = time.perf_counter()
+    import main
+    main.startup()
+    startup = time.perf_counter() - started
+
+    if args.end is not None:
+        main.TRACKING_END_TIME = args.end
+    else:
+        main.TRACKING_END_TIME = main.sim.end.strftime('%H:%M') if args.replay is not None else '15:30'
+    main.METRICS_FILE = 'benchmark_metrics.prom'
+    started = time.perf_counter()
+    scheduler = main.main()
+    elapsed = time.perf_counter() - started
+
+    stages = {}
+    for stage, hist in main.recorder.stages().items():
+        stages[stage] = {'count': hist.count, 'mean_ms': hist.sum / hist.count * 1000,
+                         'p50_ms': hist.quantile(0.5) * 1000, 'p99_ms': hist.quantile(0.99) * 1000, 'max_ms': hist.max * 1000}
+
+    passes = sum(stages.get(x, {}).get('count', 0) for x in ['run_strategy_eval', 'run_strategy_monitor'])
+    orders = list(main.sim.fyers.book.values())
+
+    return {'symbols': len(main.SYMBOLS), 'speed': args.speed if args.replay is None else args.replay_speed, 'startup_s': startup, 'session_s': elapsed,
+            'passes': passes, 'passes_per_s': passes / elapsed if elapsed > 0 else 0.0,
+            'symbol_passes_per_s': passes * len(main.SYMBOLS) / elapsed if elapsed > 0 else 0.0,
+            'prefetch_hits': main.option_prefetch.hits, 'prefetch_misses': main.option_prefetch.misses,
+            'trail_modifications': main.trailing.modifications,
+            'broker_calls': main.sim.fyers.calls, 'orders': len(orders), 'fills': sum(1 for x in orders if x['status'] == 2),
+            'replay_divergences': getattr(main.sim.fyers, 'divergences', 0),
+            'replay_mismatches': main.sim.fyers.count_mismatches() if args.replay is not None else {},
+            'feed_failovers': main.feed_supervisor.failovers if main.feed_supervisor is not None else 0,
+            # Evaluation jitter is measured on the simulated clock
+            'eval_jitter_ms': {k: v * 1000 for k, v in scheduler.jitter.items()},
+            'stages': stages}
+
+# Stages whose p99 exceeds the baseline p99 by more than tolerance
+def regressions(results, baseline, tolerance):
+
+    found = []
+    for stage in COMPARED_STAGES:
+        if stage not in results['stages'] or stage not in baseline['stages']:
+            continue
+        current, previous = results['stages'][stage]['p99_ms'], baseline['stages'][stage]['p99_ms']
+        if current > previous * (1 + tolerance):
+            found.append(stage + ': p99 ' + str(round(previous, 2)) + 'ms -> ' + str(round(current, 2)) + 'ms')
+
+    return found
+
+def report(results):
+
+    print('\nSymbols: ' + str(results['symbols']) + ', speed: ' + str(results['speed']) + 'x')
+    print('Startup: ' + str(round(results['startup_s'], 2)) + 's, session: ' + str(round(results['session_s'], 2)) + 's')
+    print('Strategy passes: ' + str(results['passes']) + ' (' + str(round(results['passes_per_s'], 1)) + '/s, ' +
+          str(round(results['symbol_passes_per_s'], 1)) + ' symbol passes/s)')
+    print('Option prefetch hits: ' + str(results['prefetch_hits']) + ', misses: ' + str(results['prefetch_misses']))
+    print('Broker calls: ' + str(results['broker_calls']) + ', orders: ' + str(results['orders']) + ', fills: ' + str(results['fills']))
+    print('Trailing stop modifications: ' + str(results.get('trail_modifications', 0)))
+    print('Feed failovers: ' + str(results.get('feed_failovers', 0)))
+    if results.get('replay_divergences'):
+        print('Replay divergences: ' + str(results['replay_divergences']))
+    for method, (recorded, replayed) in sorted(results.get('replay_mismatches', {}).items()):
+        print('Replay ' + method + ': ' + str(replayed) + ' sent, ' + str(recorded) + ' recorded')
+    for stage, x in sorted(results['stages'].items()):
+        print(stage + ': n=' + str(x['count']) + ' mean=' + str(round(x['mean_ms'], 2)) + 'ms p50<=' + str(round(x['p50_ms'], 2)) +
+              'ms p99<=' + str(round(x['p99_ms'], 2)) + 'ms max=' + str(round(x['max_ms'], 2)) + 'ms')
+    for time_now, jitter in sorted(results['eval_jitter_ms'].items()):
+        print(time_now + ' evaluation jitter: ' + str(round(jitter, 2)) + 'ms')
+
+if __name__ == '__main__':
+
+    args = parse_args(sys.argv[1:])
+    results = run(args)
+    report(results)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    # A replay that sends a different number of orders, modifications or cancels does not reproduce the session
+    if len(results.get('replay_mismatches', {})) > 0:
+        print('\nReplay does not match the recording')
+        sys.exit(1)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        if len(found) > 0:
+            print('\nRegressions against ' + args.compare + ':\n' + '\n'.join(found))
+            sys.exit(1)
+        print('\nNo regressions against ' + args.compare)
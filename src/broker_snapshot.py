@@ -0,0 +1,95 @@
+# =============================================================================
+# Consolidated broker snapshot
+# Fetches positions and the order book once per cycle, indexes them by
+# underlying and option type and publishes only what changed since the last
+# cycle (fills, cancels, rejects, positions opening or closing). Broker calls
+# per cycle stay constant however many orders are being tracked
+# =============================================================================
+
+from latency import recorder
+
+# Fyers order status codes
+ORDER_CANCELLED = 1
+ORDER_FILLED = 2
+ORDER_TRANSIT = 4
+ORDER_REJECTED = 5
+ORDER_PENDING = 6
+
+class BrokerSnapshot:
+
+    # Positions are indexed for the symbols of symbol_table, by the underlying
+    # their contract is written on
+    def __init__(self, fyers, token, symbol_table):
+
+        self.fyers = fyers
+        self.token = token
+        self.symbol_table = symbol_table
+        self.ok = False # True if the last poll got both positions and orders
+        self.message = None
+        self.positions = {} # (underlying, opt_type) -> open net positions
+        self.orders = {} # order id -> order book entry
+        self.events = [] # changes found by the last poll
+
+    # Fetch positions and the order book and work out what changed.
+    # Returns the list of events, each a dict with a 'type' key
+    def poll(self):
+
+        with recorder.timed('positions'):
+            positions = self.fyers.positions(self.token)
+        with recorder.timed('orderbook'):
+            orders = self.fyers.orders(self.token)
+
+        if positions.get('code') != 200 or orders.get('code') != 200:
+            self.ok = False
+            self.message = positions.get('message') if positions.get('code') != 200 else orders.get('message')
+            self.events = []
+            return self.events
+
+        new_positions = self._index_positions(positions['data']['netPositions'])
+        new_orders = {x['id']: x for x in orders['data']['orderBook']}
+
+        events = []
+        for order_id, order in new_orders.items():
+            status = order.get('status')
+            prev_status = self.orders[order_id].get('status') if order_id in self.orders else None
+            if status == prev_status:
+                continue
+            if status == ORDER_FILLED:
+                events.append({'type': 'fill', 'id': order_id, 'order': order})
+            elif status == ORDER_CANCELLED:
+                events.append({'type': 'cancel', 'id': order_id, 'order': order})
+            elif status == ORDER_REJECTED:
+                events.append({'type': 'reject', 'id': order_id, 'order': order})
+
+        for key in set(new_positions) | set(self.positions):
+            if key in new_positions and key not in self.positions:
+                events.append({'type': 'position_open', 'underlying': key[0], 'opt_type': key[1]})
+            elif key in self.positions and key not in new_positions:
+                events.append({'type': 'position_close', 'underlying': key[0], 'opt_type': key[1]})
+
+        self.ok = True
+        self.message = None
+        self.positions = new_positions
+        self.orders = new_orders
+        self.events = events
+
+        return events
+
+    def _index_positions(self, net_positions):
+
+        indexed = {}
+        for x in net_positions:
+            if x['qty'] == 0 or x['symbol'][-2:] not in ('CE', 'PE'):
+                continue
+            st = self.symbol_table.for_contract(x['symbol'])
+            if st is not None:
+                indexed.setdefault((st.symbol, x['symbol'][-2:]), []).append(x)
+
+        return indexed
+
+    def has_position(self, underlying, opt_type):
+        return (underlying, opt_type) in self.positions
+
+    def order_status(self, order_id):
+        order = self.orders.get(order_id)
+        return order.get('status') if order is not None else None
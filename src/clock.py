@@ -0,0 +1,16 @@
+# =============================================================================
+# Wall clock used by the session scheduler
+# Kept behind a small object so the scheduler can be driven by other clocks
+# =============================================================================
+
+import time
+from datetime import datetime
+
+class SystemClock:
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
@@ -4,3 +4,10 @@ APPID = 'U0SQURUIPL'
 SECRETID = 'G4ZMCQA6ZA'
 TD_USERNAME = 'FYERS375'
 TD_PASSWORD = 'oX2sP78n'
+
+# Login of the warm standby market data session. Many TrueData plans allow only
+# one live session per login and a second session on the same login disconnects
+# the first, so the standby needs a login of its own. Left as None, there is no
+# warm standby and a stalled feed is replaced by a new session on TD_USERNAME
+TD_STANDBY_USERNAME = None
+TD_STANDBY_PASSWORD = None
@@ -0,0 +1,170 @@
+# =============================================================================
+# Structured event log
+# Typed events of the trading loop (evaluations, fetches, orders, cancels,
+# fills, position changes) with microsecond timestamps, written as JSON lines
+# for post-session latency and slippage analysis. emit() only stores the event
+# in a preallocated ring buffer: a slot is claimed with an atomic counter, so
+# threads never wait on a lock or on the disk. A background writer drains the
+# ring in sequence order, echoes the human readable messages to the console,
+# writes each batch with one call and rotates the file by size. If the writer
+# falls a full ring behind, the oldest events are dropped and counted
+#
+# Usage: python events.py summary <events.jsonl>
+# =============================================================================
+
+import itertools
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+import numpy as np
+
+class EventLog:
+
+    def __init__(self, capacity=1 << 16, clock=None):
+        self.capacity = capacity
+        self.slots = [None] * capacity # (sequence, event, message), overwritten once the writer is a full ring behind
+        self._sequence = itertools.count()
+        self.next_read = 0 # sequence of the next event to write
+        self.dropped = 0
+        self.clock = clock # stamps events with the session time when set
+        self.path = None
+        self.file = None
+        self.echo = True
+        self.max_bytes = 0
+        self.backups = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+    # Record an event. message, if given, is printed to the console by the writer
+    def emit(self, kind, message=None, **fields):
+
+        now = self.clock.now() if self.clock is not None else datetime.now()
+        event = {'ts': now.isoformat(timespec='microseconds'), 'kind': kind}
+        event.update(fields)
+        sequence = next(self._sequence)
+        self.slots[sequence % self.capacity] = (sequence, event, message)
+
+    # Events written since the last drain, in sequence order. Stops at a slot that
+    # is claimed but not yet filled, which the next drain picks up
+    def _take(self, limit):
+
+        batch = []
+        while len(batch) < limit:
+            slot = self.slots[self.next_read % self.capacity]
+            if slot is None or slot[0] < self.next_read:
+                break
+            if slot[0] > self.next_read:
+                # Overwritten before it was written out
+                self.dropped += slot[0] - self.next_read
+                self.next_read = slot[0]
+                continue
+            batch.append(slot)
+            self.next_read += 1
+
+        return batch
+
+    def _rotate(self):
+
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.path + '.' + str(i)):
+                os.replace(self.path + '.' + str(i), self.path + '.' + str(i + 1))
+        os.replace(self.path, self.path + '.1')
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def drain(self, limit=4096):
+
+        while True:
+            batch = self._take(limit)
+            if len(batch) == 0:
+                return
+            if self.echo:
+                messages = [x[2] for x in batch if x[2] is not None]
+                if len(messages) > 0:
+                    print('\n'.join(messages))
+            if self.file is not None:
+                self.file.write(''.join(json.dumps(dict(x[1], seq=x[0]), default=str) + '\n' for x in batch))
+                self.file.flush()
+                if self.max_bytes and self.file.tell() >= self.max_bytes:
+                    self._rotate()
+
+    # Start the background writer. path None echoes to the console only. The file
+    # is rotated to path.1 .. path.<backups> when it reaches max_bytes
+    def start(self, path=None, interval=0.1, echo=True, max_bytes=64 << 20, backups=5):
+
+        self.path = path
+        self.echo = echo
+        self.max_bytes = max_bytes
+        self.backups = backups
+        if path is not None:
+            self.file = open(path, 'a', encoding='utf-8')
+
+        def run():
+            while not self.stopping.is_set():
+                try:
+                    self.drain()
+                except Exception as e:
+                    print('Event log write failed: ' + repr(e))
+                self.stopping.wait(interval)
+
+        self.thread = threading.Thread(target=run, name='event-log-writer', daemon=True)
+        self.thread.start()
+
+        return self.thread
+
+    # Stop the writer and write out what is left
+    def close(self):
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.drain()
+        if self.dropped:
+            print('Event log dropped ' + str(self.dropped) + ' events')
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Events of a log file (and its rotated predecessors given in order) as dicts
+def read_events(*paths):
+
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+# Order acknowledgement and cancel latencies in milliseconds and fill slippage
+# per symbol, in price points against the order price (positive is adverse)
+def summarize(events):
+
+    latencies = {}
+    slippage = {}
+    for e in events:
+        if e['kind'] in ('order_acked', 'order_rejected', 'cancel', 'modify'):
+            latencies.setdefault(e['kind'], []).append(e['latency_us'] / 1000)
+        elif e['kind'] == 'fill' and e.get('price') and e.get('fill_price'):
+            slippage.setdefault(e['symbol'], []).append((e['fill_price'] - e['price']) * e.get('side', 1))
+
+    lines = []
+    for kind, values in sorted(latencies.items()):
+        values = np.array(values)
+        lines.append(kind + ': n=' + str(len(values)) + ' p50=' + str(round(float(np.percentile(values, 50)), 2)) + 'ms' +
+                     ' p99=' + str(round(float(np.percentile(values, 99)), 2)) + 'ms max=' + str(round(float(values.max()), 2)) + 'ms')
+    for symbol, values in sorted(slippage.items()):
+        lines.append(symbol + ': fills=' + str(len(values)) + ' mean slippage=' + str(round(float(np.mean(values)), 4)) +
+                     ' worst=' + str(round(float(np.max(values)), 4)))
+
+    return lines
+
+# Process-wide event log used by the trading loop
+event_log = EventLog()
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3 or sys.argv[1] != 'summary':
+        print('Usage: python events.py summary <events.jsonl> [<events.jsonl.1> ...]')
+        sys.exit(1)
+    print('\n'.join(summarize(read_events(*sys.argv[2:]))))
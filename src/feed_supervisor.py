@@ -0,0 +1,291 @@
+# =============================================================================
+# Market data feed supervisor
+# Stands in for the TrueData session (start_live_data, stop_live_data,
+# live_data, get_historic_data, disconnect) and keeps the live feed alive:
+# - the receipt of every live tick is timed per symbol. The feed has stalled
+#   when no subscribed symbol has ticked for stall_after seconds in the session
+# - a standby session is kept connected in the background, without
+#   subscriptions, so a failover only has to subscribe: every symbol is
+#   subscribed on the standby, the standby becomes the active session and the
+#   request ids handed out before stay valid. The stalled session is
+#   disconnected and a new standby connected off the critical path
+#   Many TrueData plans allow a single live session per login, and a second
+#   session disconnects the first, so the warm standby is only kept when it can
+#   log in separately (see config.py). Without it a failover connects a new
+#   session after the stall, on the login of the stalled one
+# - the minutes missed while the feed was stalled are backfilled from history
+#   right after the failover, and again once the minute of the failover closes
+# Evaluations call ensure_fresh() first, which waits briefly for a failover in
+# progress and refreshes from history any symbol without a recent tick
+#
+# Staleness is measured in real seconds, as it is about the connection, and
+# only between session_start and session_end on the session clock. No ticks
+# come before the open, so stall detection is armed by the first tick in the
+# session, or open_grace seconds after the open if none comes at all
+# =============================================================================
+
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+from latency import recorder
+from events import event_log
+
+class SupervisedLiveData:
+
+    # Live data of the active session under the request ids handed out by the supervisor
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def __getitem__(self, req_id):
+
+        session, real_ids = self.supervisor.current
+        symbol = self.supervisor.symbols[req_id]
+
+        return session.live_data[real_ids[symbol]]
+
+class FeedSupervisor:
+
+    # primary is the connected session. connect() returns a new connected session
+    # without subscriptions, or raises. backfill(symbols, now) merges recent
+    # history into the bar store and returns the symbols it refreshed. With
+    # warm_standby False no session is connected ahead of a failover
+    def __init__(self, primary, connect, clock, backfill, session_start='09:15', session_end='15:30',
+                 stall_after=5.0, stale_after=10.0, interval=0.2, open_grace=30.0, warm_standby=True):
+
+        self.current = (primary, {}) # active session and symbol -> its request id, swapped as one
+        self.connect = connect
+        self.clock = clock
+        self.backfill = backfill
+        self.session_start = datetime.strptime(session_start, '%H:%M').time()
+        self.session_end = datetime.strptime(session_end, '%H:%M').time()
+        self.stall_after = stall_after
+        self.stale_after = stale_after
+        self.interval = interval
+        self.open_grace = open_grace
+        self.warm_standby = warm_standby
+        self.opened_at = None # monotonic time the session was first seen open
+        self.armed = False # set by the first tick in the session
+        self.standby = None
+        self.connecting = False
+        self.symbols = {} # request id handed out -> symbol
+        self.last_tick = {} # symbol -> monotonic time of its last tick, or of its subscription
+        self.switched_at = time.monotonic()
+        self.backfill_due = None # time after which the minute of the last failover is backfilled again
+        self.ready = threading.Event() # cleared while failing over and backfilling
+        self.ready.set()
+        self.stopping = threading.Event()
+        self.failovers = 0
+        self.live_data = SupervisedLiveData(self)
+        self.lock = threading.Lock()
+        self._req_ids = itertools.count(1000000)
+
+    def _hand_out(self, symbols, real_ids):
+
+        _, current_ids = self.current
+        now = time.monotonic()
+        handed = []
+        for symbol, real_id in zip(symbols, real_ids):
+            current_ids[symbol] = real_id
+            self.last_tick.setdefault(symbol, now)
+            req_id = next(self._req_ids)
+            self.symbols[req_id] = symbol
+            handed.append(req_id)
+
+        return handed
+
+    # Take over subscriptions made on the primary session before it was supervised.
+    # Returns the request ids to use in their place
+    def adopt(self, symbols, real_ids):
+        with self.lock:
+            return self._hand_out(symbols, real_ids)
+
+    def start_live_data(self, symbols):
+        with self.lock:
+            return self._hand_out(symbols, self.current[0].start_live_data(symbols))
+
+    def stop_live_data(self, symbols):
+
+        with self.lock:
+            session, current_ids = self.current
+            session.stop_live_data(symbols)
+            for symbol in symbols:
+                current_ids.pop(symbol, None)
+                self.last_tick.pop(symbol, None)
+            for req_id in [k for k, v in self.symbols.items() if v in symbols]:
+                del self.symbols[req_id]
+
+    def get_historic_data(self, symbol, duration='3 D', bar_size='1 min'):
+        return self.current[0].get_historic_data(symbol, duration=duration, bar_size=bar_size)
+
+    # Bar store tick listener
+    def on_tick(self, symbol, timestamp, ltp):
+
+        now = time.monotonic()
+        self.last_tick[symbol] = now
+        if not self.armed and self.in_session(self.clock.now()):
+            self.opened_at = self.opened_at if self.opened_at is not None else now
+            self.armed = True
+
+    def in_session(self, now):
+        return self.session_start <= now.time() < self.session_end
+
+    # True if no subscribed symbol has ticked for stall_after seconds since the
+    # open (open_grace seconds if none has ticked in the session yet)
+    def stalled(self):
+
+        _, current_ids = self.current
+        if len(current_ids) == 0 or self.opened_at is None:
+            return False
+        now = time.monotonic()
+        if not self.armed:
+            return now - max(self.opened_at, self.switched_at) > self.open_grace
+        newest = max([self.last_tick.get(x, 0) for x in current_ids] + [self.switched_at, self.opened_at])
+
+        return now - newest > self.stall_after
+
+    # Symbols without a tick for stale_after seconds since the open
+    def stale_symbols(self, symbols):
+
+        if self.opened_at is None:
+            return []
+        now = time.monotonic()
+        since = max(self.switched_at, self.opened_at)
+        grace = self.stale_after if self.armed else max(self.stale_after, self.open_grace)
+
+        return [x for x in symbols if now - max(self.last_tick.get(x, 0), since) > grace]
+
+    def _backfill(self, symbols):
+
+        started = time.perf_counter()
+        try:
+            refreshed = self.backfill(symbols, self.clock.now())
+        except Exception as e:
+            event_log.emit('feed_backfill_failed', 'Backfill after feed interruption failed: ' + repr(e), symbols=len(symbols), error=repr(e))
+            return set()
+        recorder.observe('feed_backfill', time.perf_counter() - started)
+        event_log.emit('feed_backfill', symbols=len(symbols), refreshed=len(refreshed), latency_us=round((time.perf_counter() - started) * 1e6))
+
+        return refreshed
+
+    def _connect_standby(self):
+
+        delay = 0.5
+        while not self.stopping.is_set():
+            try:
+                standby = self.connect()
+                with self.lock:
+                    self.standby = standby
+                    self.connecting = False
+                return
+            except Exception as e:
+                event_log.emit('feed_standby_failed', 'Standby market data connection failed: ' + repr(e), error=repr(e))
+            self.stopping.wait(delay)
+            delay = min(delay * 2, 30)
+
+    def _retire(self, session):
+        try:
+            session.disconnect()
+        except Exception as e:
+            event_log.emit('feed_disconnect_failed', error=repr(e))
+
+    # Move every subscription to the standby session (a new one if there is no
+    # standby yet) and backfill what was missed
+    def failover(self, reason):
+
+        started = time.perf_counter()
+        self.ready.clear()
+        try:
+            with self.lock:
+                standby, self.standby = self.standby, None
+            cold = standby is None
+            if cold:
+                try:
+                    standby = self.connect()
+                except Exception as e:
+                    event_log.emit('feed_failover_failed', 'Market data feed ' + reason + ' and no session could be connected: ' + repr(e),
+                                   reason=reason, error=repr(e))
+                    return False
+
+            with self.lock:
+                old, current_ids = self.current
+                symbols = list(current_ids)
+                real_ids = standby.start_live_data(symbols) if len(symbols) > 0 else []
+                self.current = (standby, dict(zip(symbols, real_ids)))
+                self.switched_at = time.monotonic()
+                self.failovers += 1
+            elapsed = time.perf_counter() - started
+            recorder.observe('feed_failover', elapsed)
+            event_log.emit('feed_failover', 'Market data feed ' + reason + '. Switched to the ' + ('new' if cold else 'standby') + ' session in ' +
+                           str(round(elapsed * 1000, 1)) + ' ms', reason=reason, cold=cold, symbols=len(symbols), latency_us=round(elapsed * 1e6))
+            threading.Thread(target=self._retire, args=(old,), name='feed-retire', daemon=True).start()
+
+            self._backfill(symbols)
+            now = self.clock.now()
+            self.backfill_due = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        finally:
+            self.ready.set()
+
+        return True
+
+    # Wait up to timeout seconds for a failover in progress, then backfill the
+    # symbols without recent ticks and resubscribe them. Returns the symbols that
+    # are still not fresh
+    def ensure_fresh(self, symbols, timeout=1.0):
+
+        if not self.ready.wait(timeout):
+            event_log.emit('feed_not_ready', 'Market data feed is failing over. Evaluating on the bars held', symbols=len(symbols))
+        if not self.in_session(self.clock.now()):
+            return []
+        stale = self.stale_symbols(symbols)
+        if len(stale) == 0:
+            return []
+
+        event_log.emit('feed_stale', 'No recent ticks for ' + ', '.join(stale) + '. Refreshing from history', symbols=stale)
+        with self.lock:
+            session, current_ids = self.current
+            subscribed = [x for x in stale if x in current_ids]
+            if len(subscribed) > 0:
+                session.stop_live_data(subscribed)
+                current_ids.update(zip(subscribed, session.start_live_data(subscribed)))
+        refreshed = self._backfill(stale)
+        now = time.monotonic()
+        for symbol in refreshed:
+            self.last_tick[symbol] = now
+
+        return [x for x in stale if x not in refreshed]
+
+    # Watch the feed every interval seconds in a background thread
+    def start(self):
+
+        def run():
+            while not self.stopping.is_set():
+                try:
+                    now = self.clock.now()
+                    if self.warm_standby and self.standby is None and not self.connecting:
+                        self.connecting = True
+                        threading.Thread(target=self._connect_standby, name='feed-standby', daemon=True).start()
+                    if self.in_session(now) and self.opened_at is None:
+                        self.opened_at = time.monotonic()
+                    if self.in_session(now) and self.stalled():
+                        self.failover('stalled for ' + str(self.stall_after) + 's')
+                    elif self.backfill_due is not None and now >= self.backfill_due:
+                        self.backfill_due = None
+                        self._backfill(list(self.current[1]))
+                except Exception as e:
+                    event_log.emit('feed_supervisor_failed', 'Feed supervisor failed: ' + repr(e), error=repr(e))
+                self.stopping.wait(self.interval)
+
+        thread = threading.Thread(target=run, name='feed-supervisor', daemon=True)
+        thread.start()
+
+        return thread
+
+    def disconnect(self):
+
+        self.stopping.set()
+        with self.lock:
+            sessions = [self.current[0]] + ([self.standby] if self.standby is not None else [])
+            self.standby = None
+        for session in sessions:
+            self._retire(session)
@@ -1,60 +1,119 @@
-from truedata_ws.websocket.TD import TD
 from func_timeout import func_timeout, FunctionTimedOut
 import time
-from config import TD_USERNAME, TD_PASSWORD
+import random
+from concurrent.futures import ThreadPoolExecutor
+from latency import recorder
+from events import event_log
 
 realtime_port = 8082
 history_port = 8092
+HISTORY_WORKERS = 8 # Maximum number of history requests in flight at once
 
-def connect_to_TD(SYMBOLS):
+# Connect and subscribe to SYMBOLS (none for a standby session), retrying with a
+# short capped backoff. Gives up after deadline seconds if one is given, otherwise
+# retries until connected. login is (login id, password), those in config.py if None
+def connect_to_TD(SYMBOLS, timeout=10, deadline=None, max_delay=5, login=None):
 
+    # Imported here so that importing this module for its history helpers stays cheap
+    from truedata_ws.websocket.TD import TD
+    from config import TD_USERNAME, TD_PASSWORD
+
+    login_id, password = login if login is not None else (TD_USERNAME, TD_PASSWORD)
+    deadline_at = time.monotonic() + deadline if deadline is not None else None
+    attempt = 0
     while True:
         try:
             print('Connecting to TrueData...')
-            td_app = func_timeout(10, TD, kwargs=({'login_id':TD_USERNAME, 'password':TD_PASSWORD, 'live_port':realtime_port, 'historical_port':history_port}))
-            req_ids = td_app.start_live_data(SYMBOLS)
+            td_app = func_timeout(timeout, TD, kwargs=({'login_id':login_id, 'password':password, 'live_port':realtime_port, 'historical_port':history_port}))
+            req_ids = td_app.start_live_data(SYMBOLS) if len(SYMBOLS) > 0 else []
             break
         except FunctionTimedOut:
-            pass
-        except:
-            pass
+            print('TrueData connection timed out')
+        except Exception as e:
+            print('TrueData connection failed: ' + repr(e))
+        attempt += 1
+        if deadline_at is not None and time.monotonic() >= deadline_at:
+            raise TimeoutError('Unable to connect to TrueData')
+        time.sleep(min(max_delay, 0.5 * 2 ** attempt))
         
     return td_app, req_ids
 
-def get_data_underlyings(td_app, SYMBOLS):
-    
+# Fetch history for one symbol, retrying with jittered exponential backoff until
+# max_attempts or the per-request deadline (in seconds) is exhausted
+def fetch_history(td_app, symbol, duration='3 D', bar_size='1 min', max_attempts=10, deadline=10, base_delay=0.1, max_delay=2):
+
+    deadline_at = time.monotonic() + deadline
+    last_error = None
+    for i in range(max_attempts):
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            break
+
+        try:
+            with recorder.timed('history_fetch'):
+                return func_timeout(remaining, td_app.get_historic_data, args=(symbol,), kwargs={'duration': duration, 'bar_size': bar_size})
+        except FunctionTimedOut:
+            last_error = TimeoutError(symbol + ' history request timed out')
+            break
+        except Exception as e:
+            last_error = e
+
+        # Full jitter: sleep a random time up to the capped exponential delay
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** i))
+        time.sleep(max(0, min(delay, deadline_at - time.monotonic())))
+
+    raise last_error if last_error is not None else TimeoutError(symbol + ' history request timed out')
+
+# Shared worker pool for history requests, created on first use
+_history_executor = None
+
+def _get_history_executor():
+
+    global _history_executor
+    if _history_executor is None:
+        _history_executor = ThreadPoolExecutor(max_workers=HISTORY_WORKERS, thread_name_prefix='history')
+
+    return _history_executor
+
+# Fetch history for all symbols in parallel. Returns the bars that were fetched and
+# the error for every symbol that could not be fetched
+def fetch_history_concurrent(td_app, symbols, duration='3 D', bar_size='1 min', max_attempts=10, deadline=10):
+
+    executor = _get_history_executor()
+    futures = {executor.submit(fetch_history, td_app, symbol, duration, bar_size, max_attempts, deadline): symbol for symbol in symbols}
+
     data_1min = {}
-    for symbol in SYMBOLS:
-        
-        i = 0
-        while i < 10:
-            print(symbol + ' data extraction: Attempt ' + str(i+1))
-        
-            try:
-                data_1min[symbol] = td_app.get_historic_data(symbol, duration='3 D', bar_size='1 min')
-                #data_1min[symbol] = data_1min[symbol][0]
-                break
-            except:
-                i += 1
-        
+    errors = {}
+    for future, symbol in futures.items():
+        try:
+            data_1min[symbol] = future.result()
+        except Exception as e:
+            errors[symbol] = e
+
+    return data_1min, errors
+
+def get_data_underlyings(td_app, SYMBOLS, duration='3 D'):
+
+    started = time.perf_counter()
+    with recorder.timed('get_data_underlyings'):
+        data_1min, errors = fetch_history_concurrent(td_app, SYMBOLS, duration)
+    event_log.emit('fetch', stage='underlyings', symbols=len(SYMBOLS), duration=duration, errors=len(errors),
+                   latency_us=round((time.perf_counter() - started) * 1e6))
+    for symbol, e in errors.items():
+        event_log.emit('fetch_failed', symbol + ' data extraction failed: ' + repr(e), symbol=symbol, error=repr(e))
+
     return data_1min
 
 def get_data_options(td_app, contract_symbols):
-    
-    data_1min = {}
-    for contract in contract_symbols:
-        
-        i = 0
-        while i < 10:
-            print(contract + ' data extraction: Attempt ' + str(i+1))
-            
-            try:
-                data_1min[contract] = td_app.get_historic_data(contract, duration='3 D', bar_size='1 min')
-                #data_1min[contract] = data_1min[contract][0]
-                break
-            except:
-                i += 1
-                
+
+    started = time.perf_counter()
+    with recorder.timed('get_data_options'):
+        data_1min, errors = fetch_history_concurrent(td_app, contract_symbols)
+    event_log.emit('fetch', stage='options', symbols=len(contract_symbols), errors=len(errors),
+                   latency_us=round((time.perf_counter() - started) * 1e6))
+    for contract, e in errors.items():
+        event_log.emit('fetch_failed', contract + ' data extraction failed: ' + repr(e), symbol=contract, error=repr(e))
+
     return data_1min
 
 def main():
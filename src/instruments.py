@@ -0,0 +1,185 @@
+# =============================================================================
+# Fyers NSE F&O instrument master
+# The master is downloaded at most once a day (revalidated by ETag), stored on
+# disk as NumPy arrays and loaded lazily. Lookups go through indexes built once:
+# expiries per underlying, strikes per expiry and symbol to token
+# =============================================================================
+
+import io
+import json
+import os
+from datetime import datetime
+import numpy as np
+import requests
+
+NSEFO_INSTR_URL = 'http://public.fyers.in/sym_details/NSE_FO.csv'
+CACHE_DIR = 'cache'
+
+class InstrumentMaster:
+
+    def __init__(self, url=NSEFO_INSTR_URL, cache_dir=CACHE_DIR):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.data_path = os.path.join(cache_dir, 'nse_fo.npz')
+        self.meta_path = os.path.join(cache_dir, 'nse_fo.json')
+        self._data = None
+        self._expiries = None
+        self._strikes = None
+        self._tokens = None
+        self._lot_sizes = None
+
+    # Arrays of the master, loaded on first access
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def _load(self):
+
+        meta = self._read_meta()
+        today = datetime.today().strftime('%Y-%m-%d')
+        if meta.get('date') == today and os.path.exists(self.data_path):
+            return dict(np.load(self.data_path, allow_pickle=False))
+
+        headers = {}
+        if os.path.exists(self.data_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = requests.get(self.url, headers=headers, timeout=30)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if os.path.exists(self.data_path):
+                print('Instrument master download failed, using cached copy from ' + str(meta.get('date')) + ': ' + repr(e))
+                return dict(np.load(self.data_path, allow_pickle=False))
+            raise
+
+        if response.status_code == 304:
+            data = dict(np.load(self.data_path, allow_pickle=False))
+        else:
+            data = parse_instr_csv(response.content)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write under a temporary name first so a crash never leaves a torn cache
+            tmp_path = self.data_path + '.tmp.npz'
+            np.savez(tmp_path, **data)
+            os.replace(tmp_path, self.data_path)
+
+        self._write_meta({'date': today,
+                          'etag': response.headers.get('ETag', meta.get('etag')),
+                          'last_modified': response.headers.get('Last-Modified', meta.get('last_modified'))})
+
+        return data
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_meta(self, meta):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def _build_indexes(self):
+
+        data = self.data
+        expiries = {}
+        strikes = {}
+        lot_sizes = {}
+        for underlying in np.unique(data['underlying']):
+            rows = data['underlying'] == underlying
+            expiries[underlying] = [x.tolist() for x in np.unique(data['expiry'][rows])]
+            lot_sizes[underlying] = int(data['lot_size'][rows & (data['expiry'] == data['expiry'][rows].min())][0])
+
+            opt_rows = rows & ((data['opt_type'] == 'CE') | (data['opt_type'] == 'PE'))
+            for expiry in np.unique(data['expiry'][opt_rows]):
+                strike_list = np.unique(data['strike'][opt_rows & (data['expiry'] == expiry)])
+                strikes[(underlying, expiry.tolist())] = strike_list.tolist()
+
+        self._expiries = expiries
+        self._strikes = strikes
+        self._lot_sizes = lot_sizes
+        self._tokens = dict(zip(data['ticker'].tolist(), data['token'].tolist()))
+
+    # Sorted expiry dates (datetime.date) for an underlying such as 'NIFTY'
+    def expiries(self, underlying):
+        if self._expiries is None:
+            self._build_indexes()
+        return self._expiries.get(underlying, [])
+
+    # Sorted strikes listed for an underlying and expiry
+    def strikes(self, underlying, expiry):
+        if self._strikes is None:
+            self._build_indexes()
+        return self._strikes.get((underlying, _as_date(expiry)), [])
+
+    # Lot size of the nearest expiry contracts of an underlying
+    def lot_size(self, underlying):
+        if self._lot_sizes is None:
+            self._build_indexes()
+        return self._lot_sizes.get(underlying)
+
+    # Sorted underlyings that have options listed
+    def option_underlyings(self):
+        if self._strikes is None:
+            self._build_indexes()
+        return sorted(set(x[0] for x in self._strikes))
+
+    # Fyers token for a symbol ticker such as 'NSE:NIFTY21JUL15800CE'
+    def token(self, symbol):
+        if self._tokens is None:
+            self._build_indexes()
+        return self._tokens.get(symbol)
+
+    # Fyers symbol tickers of the options listed for an underlying and expiry,
+    # keyed by (strike, option type)
+    def option_tickers(self, underlying, expiry):
+
+        data = self.data
+        rows = (data['underlying'] == underlying) & (data['expiry'] == np.datetime64(_as_date(expiry), 'D')) & \
+               ((data['opt_type'] == 'CE') | (data['opt_type'] == 'PE'))
+
+        return dict(zip(zip(data['strike'][rows].tolist(), data['opt_type'][rows].tolist()), data['ticker'][rows].tolist()))
+
+    # Sorted list of all expiries in the master as datetimes
+    def all_expiries(self):
+        return [datetime.combine(x.tolist(), datetime.min.time()) for x in np.unique(self.data['expiry'])]
+
+    # An expiry is the month end expiry when no other expiry falls in the same month
+    def is_monthend_expiry(self, expiry):
+        expiry = np.datetime64(_as_date(expiry), 'D')
+        months = np.unique(self.data['expiry']).astype('datetime64[M]')
+        return int((months == expiry.astype('datetime64[M]')).sum()) == 1
+
+def _as_date(x):
+    return x.date() if isinstance(x, datetime) else x
+
+# Parse the raw NSE_FO.csv into column arrays. Expiry is read from the fytoken as
+# before, underlying/strike/option type from the symbol details column
+def parse_instr_csv(content):
+
+    # Only needed when a new master is downloaded, not for the cached copy
+    import pandas as pd
+
+    fo_instr = pd.read_csv(io.StringIO(content.decode('utf-8')), header=None)
+    details = fo_instr[1].astype(str).str.upper().str.split()
+
+    opt_type = details.str[-1]
+    is_option = opt_type.isin(['CE', 'PE'])
+
+    data = {'token': fo_instr[0].astype(str).to_numpy(dtype='U'),
+            'ticker': fo_instr[9].astype(str).to_numpy(dtype='U'),
+            'underlying': details.str[0].to_numpy(dtype='U'),
+            'expiry': pd.to_datetime(fo_instr[0].astype(str).str[4:10], format='%y%m%d').to_numpy().astype('datetime64[D]'),
+            'strike': pd.to_numeric(details.str[-2].where(is_option), errors='coerce').to_numpy(dtype=np.float64),
+            'opt_type': opt_type.where(is_option, 'XX').to_numpy(dtype='U'),
+            'lot_size': fo_instr[3].to_numpy(dtype=np.int64),
+            'tick_size': fo_instr[4].to_numpy(dtype=np.float64)}
+
+    return data
@@ -0,0 +1,169 @@
+# =============================================================================
+# Latency instrumentation
+# Timing hooks around the data, broker and strategy stages collect latency
+# histograms per stage and per label. Labels are underlyings or other small
+# fixed sets (startup steps), never option contracts, so the number of series
+# stays bounded; contracts are in the event log. Histograms are exported in the
+# Prometheus text format, to a local file and optionally over HTTP
+# =============================================================================
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+METRIC_NAME = 'intraday_stage_latency_seconds'
+
+class LatencyHistogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    # Add the observations of another histogram with the same buckets
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    # Upper bound of the bucket holding quantile q
+    def quantile(self, q):
+
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+
+        return self.max
+
+class LatencyRecorder:
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets if buckets is not None else DEFAULT_BUCKETS
+        self.histograms = {} # (stage, symbol) -> LatencyHistogram
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, symbol=''):
+
+        key = (stage, symbol or '')
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram(self.buckets)
+            self.histograms[key].observe(seconds)
+
+    # Time the enclosed block as one observation of stage
+    @contextmanager
+    def timed(self, stage, symbol=''):
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, symbol)
+
+    # Histogram of each stage over all symbols
+    def stages(self):
+
+        stages = {}
+        with self.lock:
+            for (stage, _), hist in self.histograms.items():
+                if stage not in stages:
+                    stages[stage] = LatencyHistogram(self.buckets)
+                stages[stage].merge(hist)
+
+        return stages
+
+    # Histograms in the Prometheus text exposition format
+    def prometheus_text(self):
+
+        lines = ['# HELP ' + METRIC_NAME + ' Latency of strategy, data and broker stages',
+                 '# TYPE ' + METRIC_NAME + ' histogram']
+        with self.lock:
+            for (stage, symbol), hist in sorted(self.histograms.items()):
+                labels = 'stage="' + stage + '",symbol="' + symbol + '"'
+                cumulative = 0
+                for bound, n in zip(self.buckets + ['+Inf'], hist.counts):
+                    cumulative += n
+                    lines.append(METRIC_NAME + '_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(cumulative))
+                lines.append(METRIC_NAME + '_sum{' + labels + '} ' + repr(hist.sum))
+                lines.append(METRIC_NAME + '_count{' + labels + '} ' + str(hist.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path):
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(path + '.tmp', path)
+
+    # Write the metrics file every interval seconds in a background thread
+    def start_file_writer(self, path, interval=10):
+
+        def write():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_file(path)
+                except IOError as e:
+                    print('Unable to write metrics file: ' + repr(e))
+
+        thread = threading.Thread(target=write, name='metrics-writer', daemon=True)
+        thread.start()
+
+        return thread
+
+    # Serve the metrics at http://<host>:<port>/metrics in a background thread
+    def start_http_server(self, port, host='127.0.0.1'):
+
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = recorder.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+        thread.start()
+
+        return server
+
+    # One line per stage with count, p50, p99 and max in milliseconds
+    def summary(self):
+
+        lines = []
+        for stage, hist in sorted(self.stages().items()):
+            lines.append(stage + ': n=' + str(hist.count) +
+                         ' p50<=' + str(round(hist.quantile(0.5) * 1000, 1)) + 'ms' +
+                         ' p99<=' + str(round(hist.quantile(0.99) * 1000, 1)) + 'ms' +
+                         ' max=' + str(round(hist.max * 1000, 1)) + 'ms')
+
+        return lines
+
+# Process-wide recorder used by the instrumented modules
+recorder = LatencyRecorder()
@@ -43,6 +43,24 @@ ENTRY_BUFFER = 0.02 # Entry order will be placed at 75 min High + this percentag
 TARGET = 0.02 # Percentage from entry price at which profit is taken
 STOP_LOSS = 0.05 # Percentage from entry price at which stop loss may be placed
 SL_BUFFER = 0.025 # Stop loss may be placed at 75 min Low - this percentage
+MONITOR_INTERVAL = 3 # Seconds between position monitoring passes
+METRICS_FILE = 'metrics.prom' # File the latency histograms are written to
+METRICS_PORT = 0 # Port serving the latency histograms in Prometheus format, 0 to disable
+UNIVERSE = 'INDEX' # 'INDEX' trades the indices in SYMBOLS, 'FNO_STOCKS' also every stock with listed options
+SHARD = '' # 'index/count' to trade one shard of the symbols in this process (see shards.py), overridden by INTRADAY_SHARD
+PREFETCH_LEAD_MINUTES = 5 # Minutes before an evaluation in which options around the developing reference bar are prefetched
+PREFETCH_STRIKES = 3 # Strikes prefetched either side of the developing reference high (calls) and low (puts)
+STATE_DIR = 'state' # Directory of the state journal used to resume after a restart, '' to disable (overridden by INTRADAY_STATE_DIR)
+BACKEND = 'live' # 'live' for Fyers and TrueData, 'sim' for the local stand-ins in simulation.py, 'replay' to play back a recording (replay.py) (overridden by INTRADAY_BACKEND)
+TRAIL_MIN_INTERVAL = 1 # Minimum seconds between modifications of one trailing stop order
+ARCHIVE_DIR = 'bars' # Directory of the local 1 min bar archive, '' to disable (overridden by INTRADAY_ARCHIVE_DIR)
+RECORD_DIR = 'recordings' # Directory the feed and broker traffic of each session is recorded to for replay, '' to disable (overridden by INTRADAY_RECORD_DIR)
+LOG_DIR = 'logs' # Directory of the structured event log (events.py), '' for console output only (overridden by INTRADAY_LOG_DIR)
+FEED_STALL_SECONDS = 5 # Seconds without a tick from any symbol after which the feed fails over to the standby session (overridden by INTRADAY_FEED_STALL_SECONDS)
+FEED_STALE_SECONDS = 10 # Seconds without a tick after which a symbol is refreshed from history before an evaluation
+FEED_READY_TIMEOUT = 1 # Seconds an evaluation waits for a feed failover in progress
+FEED_CONNECT_DEADLINE = 30 # Seconds a standby connection attempt may take
+MARKET_CLOSE_TIME = '15:30' # End of the ticks the feed supervisor expects
 
 # =============================================================================
 # SCRIPT
@@ -55,6 +73,8 @@ lotsize_mapping = {'NIFTY 50': 75,
                    'NIFTY BANK': 25}
 min_strike_incr_mapping = {'NIFTY 50': 50,
                            'NIFTY BANK': 100}
+# F&O codes of indices, never picked up as stocks in the FNO_STOCKS universe
+INDEX_UNDERLYINGS = ['NIFTY', 'BANKNIFTY', 'FINNIFTY', 'MIDCPNIFTY']
 
 # Define strategy evaluation times - every 75 min
 strat_eval_times = ['09:16', '10:30', '11:45', '13:15', '14:54']
@@ -63,453 +83,743 @@ reference_bar_end_times = ['15:29', '10:29', '11:44', '12:59', '14:14']
 
 from datetime import datetime, timedelta
 import time
-import math
-import pandas as pd
 import numpy as np
-import requests
-import io
 import os
 import sys
-from fyers_api import fyersModel 
 
 # Load custom functions and variables
 # import get_access_token
 from get_latest_data import connect_to_TD, get_data_underlyings, get_data_options
+from bar_store import BarStore, seed_bar_store, start_live_updates
+from bar_archive import BarArchive, archived_history
+from bars import Bars
+from window_aggregator import WindowAggregator
+from option_prefetch import OptionPrefetcher
+from instruments import InstrumentMaster
+from option_chain import OptionChain
+from scheduler import SessionScheduler
+from clock import SystemClock
+from broker_snapshot import BrokerSnapshot, ORDER_FILLED
+from order_gateway import OrderGateway
+from strategy_rules import is_gap, call_put_strikes, entry_levels
+from latency import recorder
+from symbol_state import SymbolTable, isnull
+from shards import parse_shard, shard_symbols
+from state_journal import StateJournal, reconcile
+from trailing import TrailingEngine
+from startup import StartupPipeline
+from session_plan import SessionPlan
+from recording import FeedLog, RecordingTD, RecordingFyers
+from events import event_log
+from feed_supervisor import FeedSupervisor
 # Function to authenticate fyers
 def authenticate_fyers():
     # get_access_token.main()
     token = open('fyers_token.txt', 'r').read()
     return token
 
-# Function to get fyers instruments list for cash and FO markets
-def get_instr_list():
-    
-    #nsecm_instr_url = 'http://public.fyers.in/sym_details/NSE_CM.csv'
-    nsefo_instr_url = 'http://public.fyers.in/sym_details/NSE_FO.csv'
-    #s=requests.get(nsecm_instr_url).content
-    #cm_instr=pd.read_csv(io.StringIO(s.decode('utf-8')), header=None)
-    s=requests.get(nsefo_instr_url).content
-    fo_instr=pd.read_csv(io.StringIO(s.decode('utf-8')), header=None)
-    fo_instr[1] = fo_instr[1].apply(lambda x: x.upper())
-    
-    return fo_instr
+# =============================================================================
+# STARTUP
+# Components are built by the steps of a startup pipeline (startup.py) when
+# main() runs, not when this file is imported. The instrument master, the broker
+# session and the data feed are brought up in parallel, and artifacts saved
+# earlier in the day are reused: the instrument master cache, the Fyers token,
+# past days of bars from the bar archive and the state journal
+# =============================================================================
 
-fo_instr_list = get_instr_list()
-all_expiries = sorted(list(set([datetime.strptime(str(x)[4:10], '%y%m%d') for x in fo_instr_list[0].tolist()])))
-nearest_expiry = all_expiries[0]
-monthend_expiry = 'YES' if len([x for x in all_expiries if x.year == nearest_expiry.year and x.month == nearest_expiry.month]) == 1 else 'NO'
+BACKEND = os.environ.get('INTRADAY_BACKEND', BACKEND)
+eval_completion_times = []
+stock_expiries = {} # Nearest expiry of each stock in the FNO_STOCKS universe
+BROKER_EVENT_KINDS = {'fill': 'fill', 'cancel': 'cancelled', 'reject': 'rejected'} # broker_snapshot change -> event log kind
+startup_pipeline = None
+session_plan = None
+feed_log = None
+feed_supervisor = None
 
-def get_options_contract(underlying, opt_type, strike, nearest_expiry, monthend_expiry):
+# Fyers F&O instrument master, cached on disk for the day, and the nearest expiry
+def load_instruments():
     
-    if monthend_expiry == 'YES':
-        fyers_symbol = 'NSE:' + underlying_mapping[underlying] + str(nearest_expiry.year - 2000) + nearest_expiry.strftime('%b').upper() + str(strike)
-    else:
-        fyers_symbol = 'NSE:' + underlying_mapping[underlying] + str(nearest_expiry.year - 2000) + str(int(nearest_expiry.strftime('%m'))) + nearest_expiry.strftime('%d') + str(strike)
-    td_symbol = underlying_mapping[underlying] + str(nearest_expiry.year - 2000) + nearest_expiry.strftime('%m') + nearest_expiry.strftime('%d') + str(strike)
+    global instrument_master, nearest_expiry, monthend_expiry
     
-    if opt_type == 'CE':
-        fyers_symbol = fyers_symbol + 'CE'
-        td_symbol = td_symbol + 'CE'
-    else:
-        fyers_symbol = fyers_symbol + 'PE'
-        td_symbol = td_symbol + 'PE'
-        
-    return fyers_symbol, td_symbol
+    instrument_master = sim.instrument_master if BACKEND != 'live' else InstrumentMaster()
+    all_expiries = instrument_master.all_expiries()
+    nearest_expiry = all_expiries[0]
+    monthend_expiry = 'YES' if instrument_master.is_monthend_expiry(nearest_expiry) else 'NO'
+    
+    return instrument_master
 
-def limit_order(fyers, token, symbol, qty, direction, price):
+# Symbols traded by this process. Only the FNO_STOCKS universe needs the instrument master
+def resolve_symbols(instrument_master=None):
+    
+    global SYMBOLS, shard_index, shard_count, METRICS_FILE, METRICS_PORT
+    
+    # Stock options universe: every stock with listed options, traded on its own nearest expiry
+    if UNIVERSE == 'FNO_STOCKS':
+        for fo_underlying in instrument_master.option_underlyings():
+            if fo_underlying in INDEX_UNDERLYINGS or fo_underlying in underlying_mapping.values():
+                continue
+            expiries = [x for x in instrument_master.expiries(fo_underlying) if x >= clock.now().date()]
+            strikes = instrument_master.strikes(fo_underlying, expiries[0]) if len(expiries) > 0 else []
+            if len(strikes) < 2:
+                continue
+            SYMBOLS.append(fo_underlying)
+            underlying_mapping[fo_underlying] = fo_underlying
+            lotsize_mapping[fo_underlying] = instrument_master.lot_size(fo_underlying)
+            min_strike_incr_mapping[fo_underlying] = float(np.diff(strikes).min())
+            stock_expiries[fo_underlying] = datetime.combine(expiries[0], datetime.min.time())
     
-    side = 1 if direction == 'BUY' else -1
+    # Trade only the symbols of this process's shard
+    shard_index, shard_count = parse_shard(os.environ.get('INTRADAY_SHARD', SHARD))
+    SYMBOLS = shard_symbols(SYMBOLS, shard_index, shard_count)
+    if shard_count > 1:
+        METRICS_FILE = METRICS_FILE.replace('.prom', '_' + str(shard_index) + '.prom')
+        METRICS_PORT = METRICS_PORT + shard_index if METRICS_PORT else 0
+    
+    return SYMBOLS
 
-    order = fyers.place_orders(token, data={'symbol': symbol, "qty": qty, "type": 1, "side": side, 
-                                            "productType": "INTRADAY", "limitPrice": price, "stopPrice": 0, "disclosedQty": 0, "validity": "DAY",
-                                            "offlineOrder": "False", "stopLoss": 0, "takeProfit": 0})
+# Option contracts listed for the nearest expiry, resolved once per session
+def build_option_chain(instrument_master, symbols):
     
-    time_now = datetime.today().strftime('%H:%M')
-    print(time_now + ' - Order placed: ' + symbol + ' ' + direction + ' ' + str(qty) + ' ' + str(price))
+    global option_chain
     
-    try:
-        return order['data']['id']
-    except:
-        print('Order placement error: ' + order['message'])
-        return np.nan
+    option_expiries = {s: stock_expiries.get(s, nearest_expiry) for s in symbols}
+    option_chain = OptionChain(instrument_master, {s: underlying_mapping[s] for s in symbols}, option_expiries)
+    
+    return option_chain
 
-def sl_order(fyers, token, symbol, qty, direction, price):
+# Fyers access token, authenticated again if the saved one is from before 06:00 today
+def load_token():
+    
+    if BACKEND != 'live':
+        return ''
+    if os.path.exists('fyers_token.txt') == False or datetime.fromtimestamp(os.path.getmtime('fyers_token.txt')) < datetime.combine(datetime.today().date(), datetime.strptime('06:00:00', '%H:%M:%S').time()):
+        return authenticate_fyers()
     
-    side = 1 if direction == 'BUY' else -1
+    return open('fyers_token.txt', 'r').read()
 
-    order = fplace_ordersyers.place_orders(token, data={'symbol': symbol, "qty": qty, "type": 3, "side": side,
-                                            "productType": "INTRADAY", "limitPrice": 0, "stopPrice": price, "disclosedQty": 0, "validity": "DAY",
-                                            "offlineOrder": "False", "stopLoss": 0, "takeProfit": 0})
+# Broker session, order gateway and trailing stops
+def connect_broker(token):
     
-    time_now = datetime.today().strftime('%H:%M')
-    print(time_now + ' - Order placed: ' + symbol + ' ' + direction + ' ' + str(qty) + ' ' + str(price))
+    global fyers, order_gateway, trailing
     
-    try:
-        return order['data']['id']
-    except:
-        print('Order placement error: ' + order['message'])
-        return np.nan
+    if BACKEND != 'live':
+        fyers = sim.fyers
+    else:
+        from fyers_api import fyersModel
+        is_async = False
+        fyers = fyersModel.FyersModel(is_async)
+    if feed_log is not None:
+        fyers = RecordingFyers(fyers, feed_log, clock)
+    
+    # Orders go through a pool of workers so independent calls run concurrently
+    order_gateway = OrderGateway(fyers, token, clock=clock)
+    
+    # Trailing stops follow the live option ticks and move their order with a broker modify
+    trailing = TrailingEngine(order_gateway, TRAIL_MIN_INTERVAL, clock=clock)
+    
+    return fyers
 
-if os.path.exists('fyers_token.txt') == False or datetime.fromtimestamp(os.path.getmtime('fyers_token.txt')) < datetime.combine(datetime.today().date(), datetime.strptime('06:00:00', '%H:%M:%S').time()):
-    token = authenticate_fyers()
-else:
-    token = open('fyers_token.txt', 'r').read()
-td_app, req_ids = connect_to_TD(SYMBOLS)
+def connect_feed(symbols):
+    
+    global td_app, req_ids, feed_supervisor, FEED_STALL_SECONDS
+    
+    FEED_STALL_SECONDS = float(os.environ.get('INTRADAY_FEED_STALL_SECONDS', FEED_STALL_SECONDS))
+    if BACKEND == 'replay':
+        td_app = sim.td
+        req_ids = td_app.start_live_data(symbols)
+        return td_app
+    
+    # The supervisor fails over to a warm standby session when the feed stalls
+    # and backfills the minutes missed
+    if BACKEND == 'sim':
+        feed_supervisor = FeedSupervisor(sim.td, sim.connect_td, clock, backfill_bars, TRACKING_START_TIME, MARKET_CLOSE_TIME,
+                                         FEED_STALL_SECONDS, FEED_STALE_SECONDS)
+        td_app = RecordingTD(feed_supervisor, feed_log, clock) if feed_log is not None else feed_supervisor
+        req_ids = td_app.start_live_data(symbols)
+    else:
+        # One live session per TrueData login: a new session takes the login the active
+        # session is not on. Without a standby login there is no warm standby (see config.py)
+        from config import TD_USERNAME, TD_PASSWORD, TD_STANDBY_USERNAME, TD_STANDBY_PASSWORD
+        logins = [(TD_USERNAME, TD_PASSWORD)] + ([(TD_STANDBY_USERNAME, TD_STANDBY_PASSWORD)] if TD_STANDBY_USERNAME else [])
+        session_logins = {} # id of a session -> its login
+        
+        def connect_session():
+            active = session_logins.get(id(feed_supervisor.current[0]), logins[0])
+            login = next((x for x in logins if x != active), logins[0])
+            session = connect_to_TD([], deadline=FEED_CONNECT_DEADLINE, login=login)[0]
+            session_logins[id(session)] = login
+            return session
+        
+        primary, primary_req_ids = connect_to_TD(symbols, login=logins[0])
+        session_logins[id(primary)] = logins[0]
+        feed_supervisor = FeedSupervisor(primary, connect_session, clock, backfill_bars, TRACKING_START_TIME, MARKET_CLOSE_TIME,
+                                         FEED_STALL_SECONDS, FEED_STALE_SECONDS, warm_standby=len(logins) > 1)
+        req_ids = feed_supervisor.adopt(symbols, primary_req_ids)
+        td_app = feed_supervisor
+        if feed_log is not None:
+            feed_log.event('S', clock.now(), {'symbols': list(symbols), 'req_ids': list(req_ids)})
+            td_app = RecordingTD(td_app, feed_log, clock)
+    
+    return td_app
+
+# 1 min bars seeded once, read from the archive where it has them, and kept current from the live feed
+def load_bars(td_app, symbols):
+    
+    global window_aggregator, bar_archive, bar_store, live_updates, ARCHIVE_DIR
+    
+    # Reference windows (the 75 min bars and the 09:15-09:24 gap bar) kept current tick by tick
+    window_aggregator = WindowAggregator(list(zip(reference_bar_start_times, reference_bar_end_times)) + [('09:15', '09:24')])
+    
+    # Local bar archive: past days are read from disk at startup and bars closed by the live feed are
+    # appended to it. Simulated sessions do not archive unless a directory is given
+    ARCHIVE_DIR = os.environ.get('INTRADAY_ARCHIVE_DIR', ARCHIVE_DIR if BACKEND == 'live' else '')
+    bar_archive = BarArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None
+    
+    bar_store = BarStore(window_aggregator)
+    if bar_archive is not None:
+        seed_bar_store(bar_store, td_app, symbols, lambda td_app, symbols: archived_history(bar_archive, td_app, symbols, clock.now(), get_data_underlyings), clock.now())
+        bar_store.bar_listeners.append(bar_archive.append)
+    else:
+        seed_bar_store(bar_store, td_app, symbols, get_data_underlyings, clock.now())
+    if BACKEND == 'replay':
+        live_updates = sim.attach(bar_store)
+    else:
+        live_updates = start_live_updates(td_app, req_ids, bar_store, clock=clock)
+    
+    return bar_store
 
-is_async = False
-fyers = fyersModel.FyersModel(is_async)
+# Merge the current day's history into the bar store and the archive for symbols
+# whose live ticks were missed. Returns the symbols refreshed
+def backfill_bars(symbols, now):
+    
+    data_1min = get_data_underlyings(td_app, symbols, duration='1 D')
+    curr_minute = now.replace(second=0, microsecond=0)
+    for symbol, history in data_1min.items():
+        bar_store.backfill(symbol, history, now)
+        if bar_archive is not None:
+            bar_archive.write(symbol, [x for x in history if x['time'] < curr_minute])
+    
+    return set(data_1min)
 
-eval_completion_times = []
+# Strategy state of every traded symbol, resumed from today's journal after a restart
+def restore_state(symbols, token, fyers):
+    
+    global symbol_table, state_journal, broker_snapshot, STATE_DIR
+    
+    # Strategy state of every traded symbol, indexed by symbol id
+    symbol_table = SymbolTable(symbols, underlying_mapping, lotsize_mapping, min_strike_incr_mapping)
+    
+    # Positions of the traded symbols and the order book, fetched once per pass
+    broker_snapshot = BrokerSnapshot(fyers, token, symbol_table)
+    
+    # Resume today's state after a restart and journal every change from here on.
+    # Simulated sessions start fresh unless a directory is given
+    STATE_DIR = os.environ.get('INTRADAY_STATE_DIR', STATE_DIR if BACKEND == 'live' else '')
+    state_journal = None
+    if STATE_DIR:
+        state_journal = StateJournal(STATE_DIR, clock.now().date(), 'state' if shard_count == 1 else 'state_' + str(shard_index))
+        replayed = state_journal.restore(symbol_table, eval_completion_times)
+        if replayed > 0 or len(eval_completion_times) > 0:
+            print('Restored strategy state, evaluations completed: ' + ', '.join(eval_completion_times))
+            for message in reconcile(symbol_table, broker_snapshot):
+                print(message)
+    
+    return symbol_table
 
-CE_entry_orderid = {s: None for s in SYMBOLS}
-CE_tp_orderid = {s: None for s in SYMBOLS}
-CE_sl_orderid = {s: None for s in SYMBOLS}
-CE_trailtp_orderid = {s: None for s in SYMBOLS}
-PE_entry_orderid = {s: None for s in SYMBOLS}
-PE_tp_orderid = {s: None for s in SYMBOLS}
-PE_sl_orderid = {s: None for s in SYMBOLS}
-PE_trailtp_orderid = {s: None for s in SYMBOLS}
+# Symbols whose evaluation is due within PREFETCH_LEAD_MINUTES, with the reference window it will use.
+# The band is held for a minute past the boundary so it is not dropped before the evaluation reads it
+def prefetch_targets(now):
+    
+    if session_plan is None:
+        return []
+    for time_now, boundary in session_plan.boundaries.items():
+        if boundary - timedelta(minutes=PREFETCH_LEAD_MINUTES) <= now < boundary + timedelta(minutes=1):
+            break
+    else:
+        return []
+    
+    targets = []
+    for st in symbol_table:
+        if time_now == GAP_TRADE_TIME:
+            if st.trade_scheduled == GAP_TRADE_TIME:
+                targets.append((st.symbol,) + session_plan.gap_window)
+            continue
+        if isnull(st.trade_scheduled) == False:
+            continue
+        # The first evaluation uses the previous trading day's window unless there is a gap, which is only known at 9:15
+        window = session_plan.reference_window(st.symbol, time_now)
+        if window is not None:
+            targets.append((st.symbol,) + window)
+    
+    return targets
 
-CE_entry_price = {s: np.nan for s in SYMBOLS}
-CE_tp_price = {s: np.nan for s in SYMBOLS}
-CE_sl_price = {s: np.nan for s in SYMBOLS}
-PE_entry_price = {s: np.nan for s in SYMBOLS}
-PE_tp_price = {s: np.nan for s in SYMBOLS}
-PE_sl_price = {s: np.nan for s in SYMBOLS}
+# Pre-market stage: the day's schedule as datetimes and each symbol's previous close, from the bars
+# already in memory, so the gap check and the choice of reference window at the open are lookups
+def prepare_session():
+    
+    global session_plan
+    
+    with recorder.timed('premarket'):
+        plan = SessionPlan(clock.now().date(), strat_eval_times, reference_bar_start_times, reference_bar_end_times, GAP_TRADE_TIME,
+                           expiry=nearest_expiry, monthend_expiry=monthend_expiry == 'YES')
+        plan.load_previous_session({s: bar_store.get_bars(s, clock.now()) for s in SYMBOLS})
+    
+    for s in SYMBOLS:
+        if s not in plan.prev_close:
+            print(s + ': No bars of a previous trading day. The 9:16 evaluation will skip it')
+    session_plan = plan
+    
+    return plan
 
-CE_ticker = {s: None for s in SYMBOLS}
-PE_ticker = {s: None for s in SYMBOLS}
+# Bring up every component through the startup pipeline and report how long it took
+def startup():
+    
+    global sim, clock, option_prefetch, startup_pipeline, feed_log, RECORD_DIR, LOG_DIR
+    
+    if BACKEND == 'sim':
+        # Simulated broker, feed and instruments on an accelerated clock, configured
+        # through INTRADAY_SIM_* environment variables
+        from simulation import SimSession
+        sim = SimSession.from_env(SYMBOLS, underlying_mapping, lotsize_mapping, min_strike_incr_mapping)
+        clock = sim.clock
+    elif BACKEND == 'replay':
+        # A recorded session played back, configured through INTRADAY_REPLAY_* environment variables
+        from replay import ReplaySession
+        sim = ReplaySession.from_env(SYMBOLS, underlying_mapping, lotsize_mapping, min_strike_incr_mapping)
+        clock = sim.clock
+    else:
+        clock = SystemClock()
+    started_at = clock.now()
+    shard = os.environ.get('INTRADAY_SHARD', SHARD).replace('/', 'of')
+    
+    # Trading loop events go through the event log's background writer, stamped with the session clock
+    LOG_DIR = os.environ.get('INTRADAY_LOG_DIR', LOG_DIR)
+    event_log.clock = clock
+    if LOG_DIR:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        event_log.start(os.path.join(LOG_DIR, 'events_' + started_at.strftime('%Y-%m-%d') + ('_' + shard if shard else '') + '.jsonl'))
+    else:
+        event_log.start()
+    
+    # Every tick, history response and broker call of the session, for replay.py.
+    # Simulated sessions are recorded only if a directory is given, replays never
+    RECORD_DIR = os.environ.get('INTRADAY_RECORD_DIR', RECORD_DIR if BACKEND == 'live' else '')
+    if RECORD_DIR and BACKEND != 'replay':
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        feed_log = FeedLog(os.path.join(RECORD_DIR, 'session_' + started_at.strftime('%Y-%m-%d_%H%M%S') + ('_' + shard if shard else '') + '.log'))
+    
+    pipeline = StartupPipeline()
+    pipeline.add('instruments', load_instruments)
+    pipeline.add('symbols', resolve_symbols, ('instruments',) if UNIVERSE == 'FNO_STOCKS' else ())
+    pipeline.add('option_chain', build_option_chain, ('instruments', 'symbols'))
+    pipeline.add('token', load_token)
+    pipeline.add('broker', connect_broker, ('token',))
+    pipeline.add('feed', connect_feed, ('symbols',))
+    pipeline.add('bars', load_bars, ('feed', 'symbols'))
+    pipeline.add('state', restore_state, ('symbols', 'token', 'broker'))
+    pipeline.join()
+    
+    bar_store.tick_listeners.append(trailing.on_tick)
+    if feed_supervisor is not None:
+        bar_store.tick_listeners.append(feed_supervisor.on_tick)
+    
+    # What a replay needs besides the traffic: the symbols, their mappings and the option chain
+    if feed_log is not None:
+        feed_log.event('M', clock.now(), {'start': started_at, 'symbols': SYMBOLS, 'underlying_mapping': underlying_mapping,
+                                          'lotsize_mapping': lotsize_mapping, 'min_strike_incr_mapping': min_strike_incr_mapping,
+                                          'nearest_expiry': nearest_expiry, 'monthend_expiry': monthend_expiry == 'YES',
+                                          'option_expiries': option_chain.expiry,
+                                          'option_tickers': {s: [[k, t, x[0]] for (u, k, t), x in option_chain.contracts.items() if u == s] for s in SYMBOLS}})
+    
+    # Options around the developing reference bars, subscribed and seeded ahead of each evaluation
+    option_prefetch = OptionPrefetcher(td_app, req_ids, bar_store, option_chain, prefetch_targets, window_aggregator.ohlc, clock, PREFETCH_STRIKES,
+                                       archive=bar_archive)
+    if feed_log is not None:
+        option_prefetch.step_listeners.append(lambda now: feed_log.event('P', now, {'task': 'option_prefetch'}))
+    
+    startup_pipeline = pipeline
+    print('\n'.join(pipeline.report()))
+    
+    return pipeline
+
+# Record the latency from the evaluation boundary to the broker's response for an order
+def track_ack(future, symbol, eval_boundary):
+    
+    future.add_done_callback(lambda f: recorder.observe('eval_to_order_ack', (clock.now() - eval_boundary).total_seconds(), symbol))
+    return future
 
-trade_scheduled = {s: None for s in SYMBOLS}
+# Take back a leg's entry, SL, TP and trailing orders, returned as (order id, symbol) for
+# the caller to cancel. The trailing stop ends and the contract is no longer pinned
+def release_leg(st, opt_type, time_now):
+    
+    s = st.symbol
+    leg = st.leg(opt_type)
+    cancels = []
+    if isnull(leg.entry_orderid) == False:
+        event_log.emit('cancel_requested', time_now + ' - ' + s + ': Cancelling previous entry order.', symbol=s, opt_type=opt_type,
+                       order_id=leg.entry_orderid, role='entry')
+        cancels.append((leg.entry_orderid, leg.ticker)) ### user specific
+    
+    if isnull(leg.sl_orderid) == False:
+        event_log.emit('cancel_requested', time_now + ' - ' + s + ': ' + opt_type + ' position has exited. Cancelling existing SL order.',
+                       symbol=s, opt_type=opt_type, order_id=leg.sl_orderid, role='sl')
+        cancels.append((leg.sl_orderid, leg.ticker))   ### user specific
+    
+    if isnull(leg.tp_orderid) == False:
+        event_log.emit('cancel_requested', time_now + ' - ' + s + ': ' + opt_type + ' position has exited. Cancelling existing TP order.',
+                       symbol=s, opt_type=opt_type, order_id=leg.tp_orderid, role='tp')
+        cancels.append((leg.tp_orderid, leg.ticker))   ### user specific
+        
+    if isnull(leg.trailtp_orderid) == False:
+        event_log.emit('cancel_requested', time_now + ' - ' + s + ': ' + opt_type + ' position has exited. Cancelling existing Trailing TP order.',
+                       symbol=s, opt_type=opt_type, order_id=leg.trailtp_orderid, role='trail')
+        cancels.append((leg.trailtp_orderid, leg.ticker))  ### user specific
+    
+    if isnull(leg.td_ticker) == False:
+        trailing.stop(s + ' ' + opt_type)
+        option_prefetch.unpin(leg.td_ticker)
+        
+    leg.entry_orderid = None
+    leg.tp_orderid = None
+    leg.sl_orderid = None
+    leg.trailtp_orderid = None
+    return cancels
 
-reference_period_start_time = {s: None for s in SYMBOLS}
-reference_period_end_time = {s: None for s in SYMBOLS}
+# A symbol or leg skipped in an evaluation it was due in still gives up the orders of the
+# previous window, which would otherwise stay live at the old levels
+def cancel_stale_orders(st, positions, time_now):
+    
+    for opt_type, existing_position in positions:
+        if existing_position == 'NO':
+            for order_id, ticker in release_leg(st, opt_type, time_now):
+                order_gateway.cancel(order_id, ticker, label=st.symbol)
 
-def run_strategy(time_now):
+# Track the open positions of one symbol and take back the exit orders of closed ones
+def monitor_symbol(st, positions, time_now):
     
-    global CE_entry_orderid, CE_tp_orderid, CE_sl_orderid, CE_trailtp_orderid, PE_entry_orderid, PE_tp_orderid, PE_sl_orderid, PE_trailtp_orderid
-    global CE_entry_price, CE_tp_price, CE_sl_price, PE_entry_price, PE_tp_price, PE_sl_price
-    global CE_ticker, PE_ticker
-    global eval_completion_times
-    global trade_scheduled
-    global reference_period_start_time, reference_period_end_time
+    s = st.symbol
+    
+    for opt_type, existing_position in positions:
+        
+        leg = st.leg(opt_type)
+        
+        # Track open positions
+        if existing_position == 'YES':
+            
+            # The SL and first profit orders are sent together, then both are waited for
+            sl_future = tp_future = None
+            if isnull(leg.sl_orderid):
+                event_log.emit('exit_order', '{} - {} {}: Placing SL order'.format(time_now, s, leg.ticker), symbol=s, opt_type=opt_type,
+                               contract=leg.ticker, role='sl', price=leg.sl_price)
+                sl_future = order_gateway.sl_order(leg.ticker, st.lot_size*LOTS_SCALE_FACTOR*2, 'SELL', leg.sl_price, label=s)
+            
+            if isnull(leg.tp_orderid):
+                # Place take profit order for 1 lot if entry order is executed
+                event_log.emit('exit_order', '{} - {} {}: {} Entry order has been executed. Placing first profit order'.format(time_now, s, leg.ticker, opt_type),
+                               symbol=s, opt_type=opt_type, contract=leg.ticker, role='tp', price=leg.tp_price)
+                tp_future = order_gateway.limit_order(leg.ticker, st.lot_size*LOTS_SCALE_FACTOR*1, 'SELL', leg.tp_price, label=s)
+            
+            # A failed placement leaves its order id empty to be placed again on the next pass
+            for role, future in [('sl', sl_future), ('tp', tp_future)]:
+                if future is None:
+                    continue
+                try:
+                    setattr(leg, role + '_orderid', future.result())
+                except Exception as e:
+                    event_log.emit('order_failed', '{} - {} {}: {} order failed: {!r}'.format(time_now, s, leg.ticker, role.upper(), e),
+                                   symbol=s, contract=leg.ticker, role=role, error=repr(e))
+                
+            if tp_future is None and broker_snapshot.order_status(leg.tp_orderid) == ORDER_FILLED and isnull(leg.trailtp_orderid):
+                # First profit taken: protect the second lot with a stop at the target that the
+                # trailing engine moves up tick by tick, and cut the SL to the lot still held
+                event_log.emit('exit_order', '{} - {} {}: Placing second {} profit order'.format(time_now, s, leg.ticker, opt_type),
+                               symbol=s, opt_type=opt_type, contract=leg.ticker, role='trail', price=leg.tp_price)
+                trail_future = order_gateway.sl_order(leg.ticker, st.lot_size*LOTS_SCALE_FACTOR*1, 'SELL', leg.tp_price, label=s)
+                if isnull(leg.sl_orderid) == False:
+                    order_gateway.modify(leg.sl_orderid, qty=st.lot_size*LOTS_SCALE_FACTOR*1, symbol=leg.ticker, label=s)
+                leg.trailtp_orderid = trail_future.result()
+                if isnull(leg.trailtp_orderid) == False:
+                    trailing.start(s + ' ' + opt_type, leg.td_ticker, leg.trailtp_orderid, leg.tp_price, ticker=leg.ticker, label=s)
+            
+            if isnull(leg.trailtp_orderid) == False and not trailing.active(s + ' ' + opt_type):
+                # Restored after a restart: resume trailing from the order's stop price at the broker
+                option_prefetch.pin(leg.td_ticker)
+                trailing.start(s + ' ' + opt_type, leg.td_ticker, leg.trailtp_orderid, leg.tp_price,
+                               broker_snapshot.orders.get(leg.trailtp_orderid, {}).get('stopPrice') or None, ticker=leg.ticker, label=s)
+                        
+        else:
+            
+            if isnull(leg.sl_orderid) == False:
+                event_log.emit('cancel_requested', '{} - {} {}: {} position has exited. Cancelling existing SL order.'.format(time_now, s, leg.ticker, opt_type),
+                               symbol=s, opt_type=opt_type, order_id=leg.sl_orderid, role='sl')
+                order_gateway.cancel(leg.sl_orderid, leg.ticker, label=s)
+            
+            if isnull(leg.tp_orderid) == False:
+                event_log.emit('cancel_requested', '{} - {} {}: {} position has exited. Cancelling existing TP order.'.format(time_now, s, leg.ticker, opt_type),
+                               symbol=s, opt_type=opt_type, order_id=leg.tp_orderid, role='tp')
+                order_gateway.cancel(leg.tp_orderid, leg.ticker, label=s)
+                
+            if isnull(leg.trailtp_orderid) == False:
+                event_log.emit('cancel_requested', '{} - {} {}: {} position has exited. Cancelling existing Trailing TP order.'.format(time_now, s, leg.ticker, opt_type),
+                               symbol=s, opt_type=opt_type, order_id=leg.trailtp_orderid, role='trail')
+                order_gateway.cancel(leg.trailtp_orderid, leg.ticker, label=s)
+                
+            if isnull(leg.td_ticker) == False:
+                trailing.stop(s + ' ' + opt_type)
+                option_prefetch.unpin(leg.td_ticker)
+                
+            leg.tp_orderid = None
+            leg.sl_orderid = None
+            leg.trailtp_orderid = None
+
+def run_strategy(time_now, evaluate=True):
     
     # Check if CE or PE position exists
     existing_CE_position = {s: 'NO' for s in SYMBOLS}
     existing_PE_position = {s: 'NO' for s in SYMBOLS}
-    curr_positions = fyers.positions(token) ##### strategy specific
+    broker_snapshot.poll() ##### strategy specific
     
-    if curr_positions['code'] == 200:
-        curr_positions = curr_positions['data']['netPositions']    
-        curr_positions = [x for x in curr_positions if x['qty'] != 0]
+    # Fills, cancels, rejects and position changes since the last pass
+    for e in broker_snapshot.events:
+        if e['type'] in ('position_open', 'position_close'):
+            event_log.emit(e['type'], symbol=e['underlying'], opt_type=e['opt_type'])
+        else:
+            order = e['order']
+            event_log.emit(BROKER_EVENT_KINDS[e['type']], order_id=e['id'], symbol=order.get('symbol'), side=order.get('side'), qty=order.get('qty'),
+                           price=order.get('limitPrice') or order.get('stopPrice'), fill_price=order.get('tradedPrice'))
+    
+    if broker_snapshot.ok:
         for s in SYMBOLS:
-            if len(curr_positions) > 0:
-                existing_CE_position[s] = [x for x in curr_positions if x['symbol'].startswith('NSE:' + underlying_mapping[s]) and x['symbol'].endswith('CE')]
-                existing_CE_position[s] = 'YES' if len(existing_CE_position[s]) > 0 else 'NO'
-                existing_PE_position[s] = [x for x in curr_positions if x['symbol'].startswith('NSE:' + underlying_mapping[s]) and x['symbol'].endswith('PE')]
-                existing_PE_position[s] = 'YES' if len(existing_PE_position[s]) > 0 else 'NO'
+            existing_CE_position[s] = 'YES' if broker_snapshot.has_position(s, 'CE') else 'NO'
+            existing_PE_position[s] = 'YES' if broker_snapshot.has_position(s, 'PE') else 'NO'
             
     else:
-        print(curr_positions['message'])
-        print(time_now + '- Unable to retrieve current position')    
+        event_log.emit('broker_unavailable', str(broker_snapshot.message) + '\n' + time_now + '- Unable to retrieve current position', error=broker_snapshot.message)
         for s in SYMBOLS:
             existing_CE_position[s] = ''
             existing_PE_position[s] = ''
-        time.sleep(3)
+        clock.sleep(3)
     
-    if time_now not in eval_completion_times:
+    if evaluate and time_now not in eval_completion_times:
         
         eval_completion_times.append(time_now)
+        if state_journal is not None:
+            state_journal.record_eval(time_now)
         
-        # Get latest 1 min data df
-        # time.sleep(1)
-        data_1min = get_data_underlyings(td_app, SYMBOLS)
-        date_curr = datetime.today().date()
-        #date_curr = datetime(2021, 2, 17).date()
+        # Entries of this evaluation are collected and sent together, each after the cancels of its leg
+        entry_orders = []
         
-        for s in SYMBOLS:
+        # Never evaluate on a frozen feed: symbols without recent ticks are refreshed from
+        # history first, and those that could not be are not traded in this evaluation
+        unrefreshed = set(feed_supervisor.ensure_fresh(SYMBOLS, FEED_READY_TIMEOUT)) if feed_supervisor is not None else set()
+        
+        # Get latest 1 min bars from the live bar store
+        data_1min = {s: bar_store.get_bars(s, clock.now()) for s in SYMBOLS}
+        eval_boundary = session_plan.boundaries[time_now]
+        
+        # Symbols that trade in this evaluation, with their call and put contracts
+        trades_due = []
+        
+        for st in symbol_table:
             
+            s = st.symbol
             data_1min_select = data_1min[s]
+            positions = [('CE', existing_CE_position[s]), ('PE', existing_PE_position[s])]
+            
+            if s in unrefreshed:
+                event_log.emit('entry_skipped', time_now + ' - ' + s + ': No recent market data. No new entry is taken.', symbol=s, reason='stale_feed')
+                if (isnull(st.trade_scheduled) == True and time_now in strat_eval_times) or (isnull(st.trade_scheduled) == False and time_now == st.trade_scheduled):
+                    cancel_stale_orders(st, positions, time_now)
+                continue
             
             # If it is 9:16 evaluation, check for gap 
             if time_now == strat_eval_times[0]:
-                # If there is a gap, consider bar from 9:15 to 9:25, else, consider the 75 min bar
-                date_prev = sorted(list(set([x['time'].date() for x in data_1min_select])))
-                date_prev = date_prev[date_prev.index(date_curr) - 1]
-                
-                prev_close = [x['c'] for x in data_1min_select if x['time'] == datetime(date_prev.year, date_prev.month, date_prev.day, 15, 29, 0)][0]
-                curr_open = [x['o'] for x in data_1min_select if x['time'] == datetime(date_prev.year, date_prev.month, date_prev.day, 9, 15, 0)][0]
-                gap_abs = (curr_open - prev_close) / prev_close
-                gap = 'YES' if abs(gap_abs) >= GAP_THRESHOLD else 'NO'
+                # If there is a gap, consider bar from 9:15 to 9:25, else, consider the 75 min bar.
+                # The previous close comes from the pre-market stage, the open is today's 9:15 bar
+                prev_close = session_plan.prev_close.get(s)
+                curr_open = data_1min_select.value_at(session_plan.open_time, 'o')
+                if prev_close is None or curr_open is None:
+                    event_log.emit('gap_check', time_now + ' - ' + s + ': Previous close or current open is not available. No gap check is possible.',
+                                   symbol=s, prev_close=prev_close, open=curr_open, gap=None)
+                    cancel_stale_orders(st, positions, time_now)
+                    continue
+                gap = 'YES' if is_gap(prev_close, curr_open, GAP_THRESHOLD) else 'NO'
+                event_log.emit('gap_check', time_now + ' - ' + s + ': There is a sizeable gap from the previous trading day. Trade will be taken at 9:30' if gap == 'YES' else None,
+                               symbol=s, prev_close=prev_close, open=curr_open, gap=gap == 'YES')
                 
                 if gap == 'YES':
-                    print(time_now + ' - ' + s + ': There is a sizeable gap from the previous trading day. Trade will be taken at 9:30')
-                    trade_scheduled[s] = GAP_TRADE_TIME                
-                    reference_period_start_time[s] = datetime(date_curr.year, date_curr.month, date_curr.day, 9, 15, 0)
-                    reference_period_end_time[s] = datetime(date_curr.year, date_curr.month, date_curr.day, 9, 24, 0)
+                    st.trade_scheduled = GAP_TRADE_TIME                
+                    st.reference_period_start_time, st.reference_period_end_time = session_plan.gap_window
                 else:
-                    trade_scheduled[s] = None
-                    reference_period_start_time[s] = datetime.combine(date_prev, datetime.strptime(reference_bar_start_times[0], '%H:%M').time())
-                    reference_period_end_time[s] = datetime.combine(date_prev, datetime.strptime(reference_bar_end_times[0], '%H:%M').time())
+                    st.trade_scheduled = None
+                    st.reference_period_start_time, st.reference_period_end_time = session_plan.reference_window(s, time_now)
             
             elif time_now in strat_eval_times:
                 # If it is not the 9:16 evaluation, consider the 75 min bar
-                reference_period_start_time[s] = datetime.combine(date_curr, datetime.strptime(reference_bar_start_times[strat_eval_times.index(time_now)], '%H:%M').time())
-                reference_period_end_time[s] = datetime.combine(date_curr, datetime.strptime(reference_bar_end_times[strat_eval_times.index(time_now)], '%H:%M').time())
+                st.reference_period_start_time, st.reference_period_end_time = session_plan.reference_window(s, time_now)
             
-            # Check if CE or PE position exists
-            # existing_CE_position = 'NO'
-            # existing_PE_position = 'NO'
-            # curr_positions = fyers.positions(token)
-            # if curr_positions['code'] == 200:
-            #     curr_positions = curr_positions['data']['netPositions']
+            if (isnull(st.trade_scheduled) == True and time_now in strat_eval_times) or (isnull(st.trade_scheduled) == False and time_now == st.trade_scheduled):
                 
-            #     if len(curr_positions) > 0:
-            #         existing_CE_position = [x for x in curr_positions if x['symbol'].startswith('NSE:' + underlying_mapping[s]) and x['symbol'].endswith('CE')]
-            #         existing_CE_position = 'YES' if len(existing_CE_position) > 0 else 'NO'
-            #         existing_PE_position = [x for x in curr_positions if x['symbol'].startswith('NSE:' + underlying_mapping[s]) and x['symbol'].endswith('PE')]
-            #         existing_PE_position = 'YES' if len(existing_PE_position) > 0 else 'NO'
-                    
-            # else:
-            #     print(time_now + ' - ' + s + ': Unable to retrieve current position')
-            #     existing_CE_position = 'YES'
-            #     existing_PE_position = 'YES'
-            
-            if (pd.isnull(trade_scheduled[s]) == True and time_now in strat_eval_times) or (pd.isnull(trade_scheduled[s]) == False and time_now == trade_scheduled[s]):
-                
-                trade_scheduled[s] = None
+                st.trade_scheduled = None
                 
                 # Identify bar high/low and call/put strikes - Call strike: Round down high to nearest 50, Put strike: Round up low to nearest 50                                        
-                reference_period_data = [x for x in data_1min_select if x['time'] >= reference_period_start_time[s] and x['time'] <= reference_period_end_time[s]]
-                reference_period_ohlc = {'o': reference_period_data[0]['o'], 
-                                         'h': max([x['h'] for x in reference_period_data]),
-                                         'l': min([x['l'] for x in reference_period_data]),
-                                         'c': reference_period_data[-1]['c']}
+                reference_period_ohlc = window_aggregator.ohlc(s, st.reference_period_start_time, st.reference_period_end_time)
+                if reference_period_ohlc is None:
+                    reference_period_ohlc = data_1min_select.window_ohlc(st.reference_period_start_time, st.reference_period_end_time)
+                if reference_period_ohlc is None:
+                    event_log.emit('entry_skipped', time_now + ' - ' + s + ': No bars in the reference window. No new entry is taken.',
+                                   symbol=s, reason='no_reference_bars')
+                    cancel_stale_orders(st, positions, time_now)
+                    continue
                 
-                call_strike = int(math.floor(reference_period_ohlc['h'] / float(min_strike_incr_mapping[s])))*min_strike_incr_mapping[s]
-                put_strike = int(math.ceil(reference_period_ohlc['l'] / float(min_strike_incr_mapping[s])))*min_strike_incr_mapping[s]
+                call_strike, put_strike = call_put_strikes(reference_period_ohlc['h'], reference_period_ohlc['l'], st.strike_incr)
+                # Rounded so that floating point noise does not move a strike off a fractional step (e.g. 2.5)
+                call_strike, put_strike = round(float(call_strike), 6), round(float(put_strike), 6)
                 
-                call_fyers_symbol, call_td_symbol = get_options_contract(s, 'CE', call_strike, nearest_expiry, monthend_expiry)
-                put_fyers_symbol, put_td_symbol = get_options_contract(s, 'PE', put_strike, nearest_expiry, monthend_expiry)
+                # Snap to listed strikes so no request goes out for a contract that does not exist
+                call_contract = option_chain.resolve_nearest(s, 'CE', call_strike, 'down')
+                put_contract = option_chain.resolve_nearest(s, 'PE', put_strike, 'up')
+                if call_contract is None or put_contract is None:
+                    event_log.emit('entry_skipped', time_now + ' - ' + s + ': No listed option contract for the reference bar strikes. No new entry is taken.',
+                                   symbol=s, reason='no_contract', call_strike=call_strike, put_strike=put_strike)
+                    cancel_stale_orders(st, positions, time_now)
+                    continue
                 
-                # if s == 'NIFTY 50':
-                #     call_fyers_symbol, call_td_symbol = 'NSE:SBIN-EQ', 'SBIN'
-                #     put_fyers_symbol, put_td_symbol = 'NSE:ITC-EQ', 'ITC'
-                # else:
-                #     call_fyers_symbol, call_td_symbol = 'NSE:HINDALCO-EQ', 'HINDALCO'
-                #     put_fyers_symbol, put_td_symbol = 'NSE:VEDL-EQ', 'VEDL'
-                
-                # Get latest 1 min data for the call and put strike options and convert to 75 min bars
-                data_1min_opt = get_data_options(td_app, [call_td_symbol, put_td_symbol])
+                trades_due.append((st, call_contract, put_contract))
+        
+        # Get latest 1 min data for the call and put strike options of all trading symbols.
+        # Prefetched options are already in the bar store, the rest is fetched in one batch
+        opt_symbols = sorted(set(x[1][2] for x in trades_due) | set(x[2][2] for x in trades_due))
+        prefetched = set(x for x in opt_symbols if option_prefetch.ready(x))
+        data_1min_opt = {k: bar_store.get_bars(k, clock.now()) for k in prefetched}
+        missing = [x for x in opt_symbols if x not in prefetched]
+        event_log.emit('option_data', eval=time_now, prefetched=len(prefetched), fetched=len(missing))
+        if len(missing) > 0:
+            data_1min_opt.update({k: Bars.from_records(v) for k, v in get_data_options(td_app, missing).items()})
+        
+        for st, call_contract, put_contract in trades_due:
+            
+            s = st.symbol
+            
+            for opt_type, (strike, fyers_symbol, td_symbol), existing_position in [('CE', call_contract, existing_CE_position[s]),
+                                                                                     ('PE', put_contract, existing_PE_position[s])]:
                 
-                reference_period_data_optCE = [x for x in data_1min_opt[call_td_symbol] if x['time'] >= reference_period_start_time[s] and x['time'] <= reference_period_end_time[s]]
-                reference_period_ohlc_optCE = {'o': reference_period_data_optCE[0]['o'], 
-                                               'h': max([x['h'] for x in reference_period_data_optCE]),
-                                               'l': min([x['l'] for x in reference_period_data_optCE]),
-                                               'c': reference_period_data_optCE[-1]['c']}
-                reference_period_data_optPE = [x for x in data_1min_opt[put_td_symbol] if x['time'] >= reference_period_start_time[s] and x['time'] <= reference_period_end_time[s]]
-                reference_period_ohlc_optPE = {'o': reference_period_data_optPE[0]['o'], 
-                                               'h': max([x['h'] for x in reference_period_data_optPE]),
-                                               'l': min([x['l'] for x in reference_period_data_optPE]),
-                                               'c': reference_period_data_optPE[-1]['c']}
+                leg = st.leg(opt_type)
                 
-                # If there is no call position, place entry order for CE option at 75 Min High + 10%
-                if existing_CE_position[s] == 'NO':  
-                    if pd.isnull(CE_entry_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': Cancelling previous entry order.')
-                        fyers.delete_orders(token, data={'id': CE_entry_orderid[s]}) ### user specific
+                # If there is no position, place entry order for the option at 75 Min High + 10%
+                if existing_position == 'NO':
+                    if td_symbol not in data_1min_opt:
+                        event_log.emit('entry_skipped', time_now + ' - ' + s + ': No data for ' + td_symbol + '. No new ' + opt_type + ' entry is taken.',
+                                       symbol=s, opt_type=opt_type, contract=td_symbol, reason='no_data')
+                        cancel_stale_orders(st, [(opt_type, existing_position)], time_now)
+                        continue
+                    reference_period_ohlc_opt = window_aggregator.ohlc(td_symbol, st.reference_period_start_time, st.reference_period_end_time) if td_symbol in prefetched else None
+                    if reference_period_ohlc_opt is None:
+                        reference_period_ohlc_opt = data_1min_opt[td_symbol].window_ohlc(st.reference_period_start_time, st.reference_period_end_time)
+                    if reference_period_ohlc_opt is None:
+                        event_log.emit('entry_skipped', time_now + ' - ' + s + ': No bars of ' + td_symbol + ' in the reference window. No new ' + opt_type + ' entry is taken.',
+                                       symbol=s, opt_type=opt_type, contract=td_symbol, reason='no_reference_bars')
+                        cancel_stale_orders(st, [(opt_type, existing_position)], time_now)
+                        continue
                     
-                    if pd.isnull(CE_sl_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': CE position has exited. Cancelling existing SL order.')
-                        fyers.delete_orders(token, data={'id': CE_sl_orderid[s]})   ### user specific
-                    
-                    if pd.isnull(CE_tp_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': CE position has exited. Cancelling existing TP order.')
-                        fyers.delete_orders(token, data={'id': CE_tp_orderid[s]})   ### user specific
-                        
-                    if pd.isnull(CE_trailtp_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': CE position has exited. Cancelling existing Trailing TP order.')
-                        fyers.delete_orders(token, data={'id': CE_trailtp_orderid[s]})  ### user specific
-                        
-                    CE_entry_orderid[s] = None
-                    CE_tp_orderid[s] = None
-                    CE_sl_orderid[s] = None
-                    CE_trailtp_orderid[s] = None
+                    # The previous window's orders are cancelled before the new entry goes out
+                    cancels = release_leg(st, opt_type, time_now)
 
-                    CE_entry_price[s] = round(reference_period_ohlc_optCE['h']*(1+ENTRY_BUFFER) / 0.05) * 0.05
-                    CE_tp_price[s] = round(CE_entry_price[s]*(1+TARGET) / 0.05) * 0.05
-                    CE_sl_price[s] = round(max(CE_entry_price[s]*(1-STOP_LOSS), reference_period_ohlc_optCE['l']*(1+SL_BUFFER)) / 0.05) * 0.05
-                    
-                    print(time_now + ' - ' + s + ': No CE position. Placing fresh entry order')
-                    
-                    # Place exit order for 1 lot at Entry + 60% and stop loss for 2 lots at max(Entry - 60%, 75 Min Low - 10%)
-                    CE_entry_orderid[s] = sl_order(fyers, token, call_fyers_symbol, lotsize_mapping[s]*LOTS_SCALE_FACTOR*2, 'BUY', CE_entry_price[s])
-                    #CE_sl_orderid[s] = sl_order(fyers, token, call_fyers_symbol, lotsize_mapping[s]*LOTS_SCALE_FACTOR*2, 'SELL', CE_sl_price[s])
-                    CE_ticker[s] = call_fyers_symbol
-                    
+                    leg.entry_price, leg.tp_price, leg.sl_price = [float(x) for x in entry_levels(reference_period_ohlc_opt['h'], reference_period_ohlc_opt['l'],
+                                                                                                  ENTRY_BUFFER, TARGET, STOP_LOSS, SL_BUFFER)]
                     
-                    time.sleep(1)
-                    
-                else:
-                    print(time_now + ' - ' + s + ': CE position already exists. No new entry is taken.')
-                    
-                # If there is no put position, place entry order for PE option at 75 Min High + 10%
-                if existing_PE_position[s] == 'NO':
-                    if pd.isnull(PE_entry_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': Cancelling previous entry order.')
-                        fyers.delete_orders(token, data={'id': PE_entry_orderid[s]})
-                    
-                    if pd.isnull(PE_sl_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': PE position has exited. Cancelling existing SL order.')
-                        fyers.delete_orders(token, data={'id': PE_sl_orderid[s]})
-                    
-                    if pd.isnull(PE_tp_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': PE position has exited. Cancelling existing TP order.')
-                        fyers.delete_orders(token, data={'id': PE_tp_orderid[s]})
-                        
-                    if pd.isnull(PE_trailtp_orderid[s]) == False:
-                        print(time_now + ' - ' + s + ': PE position has exited. Cancelling existing Trailing TP order.')
-                        fyers.delete_orders(token, data={'id': PE_trailtp_orderid[s]})
-                        
-                    PE_entry_orderid[s] = None
-                    PE_tp_orderid[s] = None
-                    PE_sl_orderid[s] = None
-                    PE_trailtp_orderid[s] = None
-                    
-                    PE_entry_price[s] = round(reference_period_ohlc_optPE['h']*(1+ENTRY_BUFFER) / 0.05) * 0.05
-                    PE_tp_price[s] = round(PE_entry_price[s]*(1+TARGET) / 0.05) * 0.05
-                    PE_sl_price[s] = round(max(PE_entry_price[s]*(1-STOP_LOSS), reference_period_ohlc_optPE['l']*(1+SL_BUFFER)) / 0.05) * 0.05
-                    
-                    print(time_now + ' - ' + s + ': No PE position. Placing fresh entry order')
+                    event_log.emit('entry', time_now + ' - ' + s + ': No ' + opt_type + ' position. Placing fresh entry order', symbol=s, opt_type=opt_type,
+                                   contract=fyers_symbol, entry_price=leg.entry_price, tp_price=leg.tp_price, sl_price=leg.sl_price)
                     
                     # Place exit order for 1 lot at Entry + 60% and stop loss for 2 lots at max(Entry - 60%, 75 Min Low - 10%)
-                    PE_entry_orderid[s] = sl_order(fyers, token, put_fyers_symbol, lotsize_mapping[s]*LOTS_SCALE_FACTOR*2, 'BUY', PE_entry_price[s])
-                    #PE_sl_orderid[s] = sl_order(fyers, token, put_fyers_symbol, lotsize_mapping[s]*LOTS_SCALE_FACTOR*2, 'SELL', PE_sl_price[s])
-                    PE_ticker[s] = put_fyers_symbol
-                    
-                    time.sleep(1)
+                    entry_orders.append((s, leg, track_ack(order_gateway.sl_order_after(cancels, fyers_symbol, st.lot_size*LOTS_SCALE_FACTOR*2, 'BUY', leg.entry_price, label=s),
+                                                           s, eval_boundary)))
+                    leg.ticker = fyers_symbol
+                    leg.td_ticker = td_symbol
+                    # Keep the traded contract's ticks coming for the trailing stop
+                    option_prefetch.pin(td_symbol)
                     
                 else:
-                    print(time_now + ' - ' + s + ': PE position already exists. No new entry is taken.')
-    
-    for s in SYMBOLS:            
+                    event_log.emit('entry_skipped', time_now + ' - ' + s + ': ' + opt_type + ' position already exists. No new entry is taken.',
+                                   symbol=s, opt_type=opt_type, reason='position_exists')
+        
+        # Wait for the order ids. A failed placement leaves its leg without an entry order
+        for s, leg, future in entry_orders:
+            try:
+                leg.entry_orderid = future.result()
+            except Exception as e:
+                leg.entry_orderid = None
+                event_log.emit('order_failed', '{} - {} {}: Entry order failed: {!r}'.format(time_now, s, leg.ticker, e), symbol=s, contract=leg.ticker, error=repr(e))
     
-        # Track open positions
-        if existing_CE_position[s] == 'YES':
-            
-            if pd.isnull(CE_sl_orderid[s]):
-                print(time_now + ' - ' + s + ' ' + CE_ticker[s] + ': Placing SL order')
-                CE_sl_orderid[s] = sl_order(fyers, token, CE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*2, 'SELL', CE_sl_price[s])
-            
-            if pd.isnull(CE_tp_orderid[s]):
-                # Place take profit order for 1 lot if entry order is executed
-                print(time_now + ' - ' + s + ' ' + CE_ticker[s] + ': CE Entry order has been executed. Placing first profit order')
-                CE_tp_orderid[s] = limit_order(fyers, token, CE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*1, 'SELL', CE_tp_price[s])
-                
-            else:
-                # Track if exit profit order for the 1 lot is executed.
-                tp_order_status = fyers.order_status(token, data={'id': CE_tp_orderid[s]})
-                if tp_order_status == 2:
-                    print(time_now + ' - ' + s + ' ' + CE_ticker[s] + ': Placing / modifying second CE profit order')
-                    # If yes, place or modify stop tp order
-                    if data_1min_opt[call_td_symbol][-1]['c'] > CE_tp_price[s]:
-                        trail_price = round(CE_tp_price[s] + (data_1min_opt[call_td_symbol][-1]['c'] - CE_tp_price[s])*0.5 / 0.05) * 0.05
-                        CE_trailtp_orderid[s] = sl_order(fyers, token, CE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*1, 'SELL', trail_price)
-                    else:
-                        trail_price = CE_tp_price[s]
-                        CE_trailtp_orderid[s] = sl_order(fyers, token, CE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*1, 'SELL', trail_price)
-                        
-        else:
-            
-            if pd.isnull(CE_sl_orderid[s]) == False:
-                print(time_now + ' - ' + s + ' ' + CE_ticker[s] + ': CE position has exited. Cancelling existing SL order.')
-                fyers.delete_orders(token, data={'id': CE_sl_orderid[s]})
-            
-            if pd.isnull(CE_tp_orderid[s]) == False:
-                print(time_now + ' - ' + s + ' ' + CE_ticker[s] + ': CE position has exited. Cancelling existing TP order.')
-                fyers.delete_orders(token, data={'id': CE_tp_orderid[s]})
-                
-            if pd.isnull(CE_trailtp_orderid[s]) == False:
-                print(time_now + ' - ' + s + ' ' + CE_ticker[s] + ': CE position has exited. Cancelling existing Trailing TP order.')
-                fyers.delete_orders(token, data={'id': CE_trailtp_orderid[s]})
-                
-            CE_tp_orderid[s] = None
-            CE_sl_orderid[s] = None
-            CE_trailtp_orderid[s] = None
+    for st in symbol_table:
         
-        if existing_PE_position[s] == 'YES':
-            
-            if pd.isnull(PE_sl_orderid[s]):
-                print(time_now + ' - ' + s + ' ' + PE_ticker[s] + ': Placing SL order')
-                PE_sl_orderid[s] = sl_order(fyers, token, PE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*2, 'SELL', PE_sl_price[s])
-            
-            if pd.isnull(PE_tp_orderid[s]):
-                # Place take profit order for 1 lot if entry order is executed
-                print(time_now + ' - ' + s + ' ' + PE_ticker[s] + ': PE Entry order has been executed. Placing first profit order')
-                PE_tp_orderid[s] = limit_order(fyers, token, PE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*1, 'SELL', PE_tp_price[s])
-                
-            else:
-                # Track if exit profit order for the 1 lot is executed.
-                tp_order_status = fyers.order_status(token, data={'id': PE_tp_orderid[s]})
-                if tp_order_status == 2:
-                    print(time_now + ' - ' + s + ' ' + PE_ticker[s] + ': Placing / modifying second PE profit order')
-                    # If yes, place or modify stop tp order
-                    if data_1min_opt[put_td_symbol][-1]['c'] > PE_tp_price[s]:
-                        trail_price = PE_tp_price[s] + (data_1min_opt[put_td_symbol][-1]['c'] - PE_tp_price[s])*0.5
-                        PE_trailtp_orderid[s] = sl_order(fyers, token, PE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*1, 'SELL', trail_price)
-                    else:
-                        trail_price = PE_tp_price[s]
-                        PE_trailtp_orderid[s] = sl_order(fyers, token, PE_ticker[s], lotsize_mapping[s]*LOTS_SCALE_FACTOR*1, 'SELL', trail_price)
-                        
-        else:
-            
-            if pd.isnull(PE_sl_orderid[s]) == False:
-                print(time_now + ' - ' + s + ' ' + PE_ticker[s] + ': PE position has exited. Cancelling existing SL order.')
-                fyers.delete_orders(token, data={'id': PE_sl_orderid[s]})
-            
-            if pd.isnull(PE_tp_orderid[s]) == False:
-                print(time_now + ' - ' + s + ' ' + PE_ticker[s] + ': PE position has exited. Cancelling existing TP order.')
-                fyers.delete_orders(token, data={'id': PE_tp_orderid[s]})
-                
-            if pd.isnull(PE_trailtp_orderid[s]) == False:
-                print(time_now + ' - ' + s + ' ' + PE_ticker[s] + ': PE position has exited. Cancelling existing Trailing TP order.')
-                fyers.delete_orders(token, data={'id': PE_trailtp_orderid[s]})
-                
-            PE_tp_orderid[s] = None
-            PE_sl_orderid[s] = None
-            PE_trailtp_orderid[s] = None
+        s = st.symbol
+        
+        # Nothing to track for a symbol without positions or orders
+        if existing_CE_position[s] != 'YES' and existing_PE_position[s] != 'YES' and st.is_idle():
+            continue
+        
+        # A failure on one symbol must not stop the others from being tracked
+        try:
+            monitor_symbol(st, [('CE', existing_CE_position[s]), ('PE', existing_PE_position[s])], time_now)
+        except Exception as e:
+            event_log.emit('error', '{} - {}: Monitoring failed: {!r}'.format(time_now, s, e), eval=time_now, symbol=s, error=repr(e))
+    
+    # Send trailing levels held back by the rate limit
+    trailing.flush()
             
+# Run one strategy pass, reporting instead of raising any error
+def run_strategy_safely(time_now, evaluate):
+    
+    started = time.perf_counter()
+    try:
+        with recorder.timed('run_strategy_eval' if evaluate else 'run_strategy_monitor'):
+            run_strategy(time_now, evaluate)
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        event_log.emit('error', str(exc_tb.tb_lineno) + ' ' + str(e), eval=time_now, line=exc_tb.tb_lineno, error=repr(e))
+    if evaluate:
+        event_log.emit('eval_end', eval=time_now, duration_us=round((time.perf_counter() - started) * 1e6))
+
 # Main function to control all operations
 def main():
-            
-    time_now = datetime.today().strftime('%H:%M')
     
-    print_cnt = 0
-    while True:
+    if startup_pipeline is None:
+        startup()
+    if session_plan is None:
+        prepare_session()
     
-        while (time_now >= TRACKING_START_TIME) and (time_now <= TRACKING_END_TIME):
-            try:
-                run_strategy(time_now)
-                time.sleep(3)
-            except Exception as e:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                print(str(exc_tb.tb_lineno), e)
-                time.sleep(1)
-            time_now = datetime.today().strftime('%H:%M')
-        
-        time_now = datetime.today().strftime('%H:%M')
-        if time_now >= TRACKING_END_TIME:
-            break
-        elif time_now < TRACKING_START_TIME:
-            if print_cnt == 0:
-                print('Waiting for market to open...')
-                print_cnt += 1
-        else:
-            print('Market is open')
+    # Latency histograms go to a local file and optionally to a Prometheus endpoint
+    recorder.start_file_writer(METRICS_FILE)
+    if METRICS_PORT:
+        recorder.start_http_server(METRICS_PORT)
+    
+    option_prefetch.start()
+    if feed_supervisor is not None:
+        feed_supervisor.start()
+    if bar_archive is not None:
+        bar_archive.start_writer()
+    
+    # Evaluations fire on their boundaries, position monitoring runs in between
+    scheduler = SessionScheduler(TRACKING_START_TIME, TRACKING_END_TIME, strat_eval_times + [GAP_TRADE_TIME], MONITOR_INTERVAL, clock)
+    scheduler.run(lambda time_now: run_strategy_safely(time_now, True),
+                  lambda time_now: run_strategy_safely(time_now, False))
     
     td_app.disconnect()
+    if state_journal is not None:
+        state_journal.close()
+    if bar_archive is not None:
+        bar_store.roll(clock.now())
+        bar_archive.flush()
+    if feed_log is not None:
+        feed_log.close()
+    event_log.close()
+    recorder.write_file(METRICS_FILE)
+    print('\n'.join(recorder.summary()))
     print('\nTracking successfully completed for the day!')
     
+    return scheduler
+    
 if __name__ == '__main__':
     main()
     #pass
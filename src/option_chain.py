@@ -0,0 +1,83 @@
+# =============================================================================
+# Option chain resolver
+# Built once per session from the instrument master for the traded expiry.
+# Maps (underlying, strike, CE/PE) to the Fyers and TrueData symbols in O(1),
+# snaps requested strikes to listed ones and resolves whole strike ladders, so
+# no order or history request goes out for a contract that does not exist
+# =============================================================================
+
+import bisect
+
+class OptionChain:
+
+    # underlying_mapping maps the traded index/stock (e.g. 'NIFTY 50') to its
+    # F&O underlying code (e.g. 'NIFTY'). expiry is the traded expiry, or a dict
+    # of expiry per underlying when they differ (weekly index, monthly stock options)
+    def __init__(self, instrument_master, underlying_mapping, expiry):
+
+        self.expiry = expiry
+        self.strikes = {} # underlying -> sorted listed strikes
+        self.contracts = {} # (underlying, strike, opt_type) -> (fyers_symbol, td_symbol)
+
+        for underlying, fo_underlying in underlying_mapping.items():
+            underlying_expiry = expiry[underlying] if isinstance(expiry, dict) else expiry
+            expiry_code = underlying_expiry.strftime('%y%m%d')
+            tickers = instrument_master.option_tickers(fo_underlying, underlying_expiry)
+            strikes = set()
+            for (strike, opt_type), fyers_symbol in tickers.items():
+                strike = int(strike) if float(strike).is_integer() else strike
+                td_symbol = fo_underlying + expiry_code + str(strike) + opt_type
+                self.contracts[(underlying, strike, opt_type)] = (fyers_symbol, td_symbol)
+                strikes.add(strike)
+            self.strikes[underlying] = sorted(strikes)
+
+    # Listed strike nearest to price. direction 'down' takes the highest listed strike
+    # at or below price, 'up' the lowest at or above it (falling back to the nearest
+    # when there is none on that side). None if nothing is listed
+    def nearest_strike(self, underlying, price, direction=None):
+
+        strikes = self.strikes.get(underlying, [])
+        if len(strikes) == 0:
+            return None
+
+        i = bisect.bisect_left(strikes, price)
+        if i < len(strikes) and strikes[i] == price:
+            return strikes[i]
+        if direction == 'down' and i > 0:
+            return strikes[i - 1]
+        if direction == 'up' and i < len(strikes):
+            return strikes[i]
+
+        candidates = strikes[max(i - 1, 0):i + 1]
+        return min(candidates, key=lambda x: abs(x - price))
+
+    # (fyers_symbol, td_symbol) for a listed contract, None if it is not listed
+    def resolve(self, underlying, opt_type, strike):
+        return self.contracts.get((underlying, strike, opt_type))
+
+    # Snap strike to a listed one and resolve it. Returns (strike, fyers_symbol, td_symbol)
+    def resolve_nearest(self, underlying, opt_type, strike, direction=None):
+
+        strike = self.nearest_strike(underlying, strike, direction)
+        contract = self.contracts.get((underlying, strike, opt_type))
+        if contract is None:
+            return None
+
+        return (strike,) + contract
+
+    # Resolve the listed strikes within n_strikes either side of price for the given
+    # option types. Returns {(strike, opt_type): (fyers_symbol, td_symbol)}
+    def resolve_ladder(self, underlying, price, n_strikes, opt_types=('CE', 'PE')):
+
+        strikes = self.strikes.get(underlying, [])
+        i = bisect.bisect_left(strikes, price)
+        ladder = strikes[max(i - n_strikes, 0):i + n_strikes]
+
+        contracts = {}
+        for strike in ladder:
+            for opt_type in opt_types:
+                contract = self.contracts.get((underlying, strike, opt_type))
+                if contract is not None:
+                    contracts[(strike, opt_type)] = contract
+
+        return contracts
@@ -0,0 +1,144 @@
+# =============================================================================
+# Speculative option prefetch
+# In the minutes before an evaluation, subscribes to the options in a band of
+# strikes around the developing reference window high (calls) and low (puts) of
+# every symbol about to trade, and seeds their 1 min bars in the bar store. When
+# the evaluation fixes the strikes, the option bars and reference OHLC are
+# already in memory and no history request sits on the critical path. The band
+# follows the underlying as it moves; contracts that leave it are unsubscribed
+# unless pinned, as traded contracts are for the trailing stop engine
+#
+# History for a new contract is fetched once the minute in which it was
+# subscribed has closed, so history and live ticks overlap and no minute is lost
+# between them. The history is also merged into the bar archive when one is given
+# =============================================================================
+
+import threading
+from latency import recorder
+from get_latest_data import fetch_history_concurrent
+from events import event_log
+
+class OptionPrefetcher:
+
+    # targets(now) returns [(symbol, window_start, window_end)] for the symbols
+    # whose evaluation falls within the lead time, empty otherwise. ohlc(symbol,
+    # start, end) returns the developing reference OHLC or None
+    def __init__(self, td_app, req_ids, bar_store, option_chain, targets, ohlc, clock, n_strikes=3, interval=5, archive=None):
+
+        self.td_app = td_app
+        self.req_ids = req_ids
+        self.bar_store = bar_store
+        self.option_chain = option_chain
+        self.targets = targets
+        self.ohlc = ohlc
+        self.clock = clock
+        self.n_strikes = n_strikes
+        self.interval = interval
+        self.archive = archive
+        self.subscribed = {} # td symbol -> (req id, subscription time)
+        self.seeded = set() # td symbols with history in the bar store
+        self.pinned = set() # td symbols kept subscribed whether in the band or not
+        self.step_listeners = [] # called as listener(now) at the start of every step
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Contracts in the band around the developing reference high and low
+    def wanted(self, now):
+
+        contracts = set()
+        for symbol, start, end in self.targets(now):
+            ohlc = self.ohlc(symbol, start, end)
+            if ohlc is None:
+                continue
+            for opt_type, price in (('CE', ohlc['h']), ('PE', ohlc['l'])):
+                for _, td_symbol in self.option_chain.resolve_ladder(symbol, price, self.n_strikes, (opt_type,)).values():
+                    contracts.add(td_symbol)
+
+        return contracts
+
+    def step(self):
+
+        now = self.clock.now()
+        for listener in self.step_listeners:
+            listener(now)
+        wanted = self.wanted(now)
+
+        with self.lock:
+            wanted |= self.pinned
+            new = sorted(wanted - set(self.subscribed))
+            stale = sorted(set(self.subscribed) - wanted)
+            due = sorted(x for x, (_, subscribed_at) in self.subscribed.items()
+                         if x not in self.seeded and now.replace(second=0, microsecond=0) > subscribed_at)
+
+        if len(new) > 0:
+            for td_symbol, req_id in zip(new, self.td_app.start_live_data(new)):
+                self.req_ids.append(req_id)
+                with self.lock:
+                    self.subscribed[td_symbol] = (req_id, now)
+
+        if len(stale) > 0:
+            self.td_app.stop_live_data(stale)
+            with self.lock:
+                for td_symbol in stale:
+                    req_id, _ = self.subscribed.pop(td_symbol)
+                    if req_id in self.req_ids:
+                        self.req_ids.remove(req_id)
+                    self.seeded.discard(td_symbol)
+
+        if len(due) > 0:
+            with recorder.timed('option_prefetch'):
+                data_1min, errors = fetch_history_concurrent(self.td_app, due)
+            seeded_at = self.clock.now()
+            curr_minute = seeded_at.replace(second=0, microsecond=0)
+            for td_symbol, history in data_1min.items():
+                self.bar_store.seed(td_symbol, history, seeded_at)
+                if self.archive is not None:
+                    self.archive.write(td_symbol, [x for x in history if x['time'] < curr_minute])
+            with self.lock:
+                self.seeded.update(x for x in data_1min if x in self.subscribed)
+
+    def _step(self):
+        try:
+            self.step()
+        except Exception as e:
+            event_log.emit('fetch_failed', 'Option prefetch failed: ' + repr(e), stage='prefetch', error=repr(e))
+
+    # Run step every interval seconds in a background thread. A stepped clock
+    # (replay.py) runs it inline instead, at the times of the recorded steps
+    def start(self):
+
+        if getattr(self.clock, 'stepped', False):
+            self.clock.every(self.interval, self._step, 'option_prefetch')
+            return None
+
+        def run():
+            while True:
+                self._step()
+                self.clock.sleep(self.interval)
+
+        thread = threading.Thread(target=run, name='option-prefetch', daemon=True)
+        thread.start()
+
+        return thread
+
+    # True if the contract's bars are in the bar store and kept current
+    def ready(self, td_symbol):
+
+        with self.lock:
+            ready = td_symbol in self.seeded
+        if ready:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return ready
+
+    # Keep a contract subscribed from the next step on, in or out of the band
+    def pin(self, td_symbol):
+        with self.lock:
+            self.pinned.add(td_symbol)
+
+    def unpin(self, td_symbol):
+        with self.lock:
+            self.pinned.discard(td_symbol)
@@ -0,0 +1,113 @@
+# =============================================================================
+# Asynchronous order gateway
+# Order placement, modification and cancellation calls go to a bounded pool of
+# worker threads and return futures, so independent cancels and entries are in
+# flight at the same time instead of one after another. Every call's latency is
+# recorded under its stage and a label given by the caller (the underlying, so
+# the label values stay few), and every request and response goes to the event
+# log with the order's contract
+# =============================================================================
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from latency import recorder
+from clock import SystemClock
+from events import event_log
+
+ORDER_TYPE_LIMIT = 1
+ORDER_TYPE_STOP = 3
+
+class OrderGateway:
+
+    def __init__(self, fyers, token, max_workers=8, clock=None):
+
+        self.fyers = fyers
+        self.token = token
+        self.clock = clock if clock is not None else SystemClock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='orders')
+
+    def _timed(self, call, label, fn, *args, **kwargs):
+
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            recorder.observe(call, time.perf_counter() - started, label)
+
+    # Modifications and cancels, logged with their latency and the broker's answer
+    def _change(self, kind, call, order_id, symbol, label, fn, data):
+
+        started = time.perf_counter()
+        response = self._timed(call, label, fn, self.token, data=data)
+        ok = isinstance(response, dict) and response.get('code') == 200
+        event_log.emit(kind, order_id=order_id, symbol=symbol, data=data, ok=ok, latency_us=round((time.perf_counter() - started) * 1e6),
+                       error=None if ok else (response.get('message') if isinstance(response, dict) else str(response)))
+
+        return response
+
+    def _place(self, symbol, qty, direction, order_type, price, label):
+
+        side = 1 if direction == 'BUY' else -1
+        data = {'symbol': symbol, "qty": qty, "type": order_type, "side": side,
+                "productType": "INTRADAY", "limitPrice": price if order_type == ORDER_TYPE_LIMIT else 0,
+                "stopPrice": price if order_type == ORDER_TYPE_STOP else 0, "disclosedQty": 0, "validity": "DAY",
+                "offlineOrder": "False", "stopLoss": 0, "takeProfit": 0}
+        call = 'limit_order' if order_type == ORDER_TYPE_LIMIT else 'sl_order'
+        time_now = self.clock.now().strftime('%H:%M')
+        event_log.emit('order_placed', time_now + ' - Order placed: ' + symbol + ' ' + direction + ' ' + str(qty) + ' ' + str(price),
+                       symbol=symbol, side=side, qty=qty, type=order_type, price=price)
+        started = time.perf_counter()
+        order = self._timed(call, label, self.fyers.place_orders, self.token, data=data)
+        latency_us = round((time.perf_counter() - started) * 1e6)
+
+        try:
+            order_id = order['data']['id']
+        except (KeyError, TypeError):
+            message = str(order.get('message') if isinstance(order, dict) else order)
+            event_log.emit('order_rejected', 'Order placement error: ' + message, symbol=symbol, side=side, qty=qty, type=order_type,
+                           price=price, latency_us=latency_us, error=message)
+            return np.nan
+        event_log.emit('order_acked', symbol=symbol, order_id=order_id, side=side, qty=qty, type=order_type, price=price, latency_us=latency_us)
+
+        return order_id
+
+    # Future of the order id (nan if rejected) of a limit order. label is the latency label
+    # of the call, here and below
+    def limit_order(self, symbol, qty, direction, price, label=''):
+        return self.executor.submit(self._place, symbol, qty, direction, ORDER_TYPE_LIMIT, price, label)
+
+    # Future of the order id (nan if rejected) of a stop order
+    def sl_order(self, symbol, qty, direction, price, label=''):
+        return self.executor.submit(self._place, symbol, qty, direction, ORDER_TYPE_STOP, price, label)
+
+    # Future of the order id (nan if rejected) of a stop order placed only once the
+    # orders it replaces, given as (order id, symbol), have been cancelled, so the two
+    # are never live together. Replacements for different orders still go out in parallel
+    def sl_order_after(self, cancels, symbol, qty, direction, price, label=''):
+
+        def replace():
+            for order_id, order_symbol in cancels:
+                self._change('cancel', 'delete_orders', order_id, order_symbol, label, self.fyers.delete_orders, {'id': order_id})
+            return self._place(symbol, qty, direction, ORDER_TYPE_STOP, price, label)
+
+        return self.executor.submit(replace)
+
+    # Future of the broker response to changing a pending order's stop price, limit
+    # price or quantity. symbol is the order's contract, for the event log
+    def modify(self, order_id, stop_price=None, limit_price=None, qty=None, symbol='', label=''):
+
+        data = {'id': order_id}
+        if stop_price is not None:
+            data['type'] = ORDER_TYPE_STOP
+            data['stopPrice'] = stop_price
+        if limit_price is not None:
+            data['type'] = ORDER_TYPE_LIMIT
+            data['limitPrice'] = limit_price
+        if qty is not None:
+            data['qty'] = qty
+
+        return self.executor.submit(self._change, 'modify', 'modify_orders', order_id, symbol, label, self.fyers.modify_orders, data)
+
+    def cancel(self, order_id, symbol='', label=''):
+        return self.executor.submit(self._change, 'cancel', 'delete_orders', order_id, symbol, label, self.fyers.delete_orders, {'id': order_id})
@@ -0,0 +1,235 @@
+# =============================================================================
+# Session recording
+# Captures what the strategy sees from the outside world to a compact binary
+# log, so a session can be replayed later (replay.py): every live tick, every
+# history response and every broker request with its response, each stamped
+# with the session clock. The feed and broker objects are wrapped by proxies
+# with the same interface, so nothing else changes when recording is on
+#
+# Log: the magic b'IDRL1' followed by frames of <kind char><time float64>
+# <payload length uint32><payload>. time is the session clock in seconds since
+# 1970-01-01 (naive). Kinds:
+#   N  symbol name for an id: <id uint16><utf-8 name>
+#   T  tick: <symbol id uint16><req id uint32><timestamp float64><ltp float64><ttq float64, nan if none>
+#   H  history response: <symbol id uint16><header length uint32><JSON header><bars as bar_archive.BAR_DTYPE>
+#   B  broker call: zlib compressed JSON {method, data, response, elapsed}
+#   S, U  live data subscribed / unsubscribed: JSON {symbols, req_ids}
+#   P  step of a periodic background task: JSON {task}
+#   M  session metadata: JSON
+# A frame cut short by a crash ends the log
+# =============================================================================
+
+import json
+import math
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+import numpy as np
+from bar_archive import BAR_DTYPE, to_array, to_records
+from bar_store import tick_key
+
+MAGIC = b'IDRL1'
+FRAME = struct.Struct('<cdI')
+TICK = struct.Struct('<HIddd')
+HISTORY = struct.Struct('<HI')
+NAME = struct.Struct('<H')
+EPOCH = datetime(1970, 1, 1)
+
+def to_seconds(t):
+    return (t - EPOCH).total_seconds()
+
+def from_seconds(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+class FeedLog:
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.file = open(path, 'wb', buffering=1 << 20)
+        self.file.write(MAGIC)
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.symbol_ids = {}
+        self.lock = threading.Lock()
+
+    def _write(self, kind, now, payload):
+
+        self.file.write(FRAME.pack(kind, to_seconds(now), len(payload)))
+        self.file.write(payload)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = time.monotonic()
+
+    def _symbol_id(self, symbol, now):
+
+        sid = self.symbol_ids.get(symbol)
+        if sid is None:
+            sid = len(self.symbol_ids)
+            self.symbol_ids[symbol] = sid
+            self._write(b'N', now, NAME.pack(sid) + symbol.encode('utf-8'))
+
+        return sid
+
+    def tick(self, now, symbol, req_id, timestamp, ltp, ttq=None):
+        with self.lock:
+            self._write(b'T', now, TICK.pack(self._symbol_id(symbol, now), req_id, to_seconds(timestamp), ltp,
+                                             float(ttq) if ttq is not None else math.nan))
+
+    def history(self, now, symbol, duration, bar_size, elapsed, records=None, error=None):
+
+        header = json.dumps({'duration': duration, 'bar_size': bar_size, 'elapsed': elapsed, 'error': error}).encode('utf-8')
+        bars = to_array(list(records)).tobytes() if records is not None else b''
+        with self.lock:
+            self._write(b'H', now, HISTORY.pack(self._symbol_id(symbol, now), len(header)) + header + bars)
+
+    def broker(self, now, method, data, response, elapsed):
+
+        payload = zlib.compress(json.dumps({'method': method, 'data': data, 'response': response, 'elapsed': elapsed}, default=str).encode('utf-8'), 1)
+        with self.lock:
+            self._write(b'B', now, payload)
+
+    # Subscription changes ('S', 'U'), background task steps ('P') and session metadata ('M')
+    def event(self, kind, now, value):
+        with self.lock:
+            self._write(kind.encode('ascii'), now, json.dumps(value, default=str).encode('utf-8'))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# (kind, time, value) of every complete frame in a log. Ticks are (symbol, req id,
+# timestamp, ltp, ttq) with times in seconds, history responses (symbol, header,
+# list of bar dicts), the others the decoded JSON
+def read_log(path):
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(path + ' is not a session recording')
+
+    names = {}
+    offset = len(MAGIC)
+    while offset + FRAME.size <= len(data):
+        kind, t, length = FRAME.unpack_from(data, offset)
+        start = offset + FRAME.size
+        if start + length > len(data):
+            return
+        payload = data[start:start + length]
+        offset = start + length
+
+        if kind == b'N':
+            names[NAME.unpack_from(payload)[0]] = payload[NAME.size:].decode('utf-8')
+        elif kind == b'T':
+            sid, req_id, timestamp, ltp, ttq = TICK.unpack(payload)
+            yield 'T', t, (names[sid], req_id, timestamp, ltp, None if ttq != ttq else ttq)
+        elif kind == b'H':
+            sid, header_length = HISTORY.unpack_from(payload)
+            header = json.loads(payload[HISTORY.size:HISTORY.size + header_length])
+            bars = np.frombuffer(payload[HISTORY.size + header_length:], dtype=BAR_DTYPE)
+            yield 'H', t, (names[sid], header, to_records(bars))
+        elif kind == b'B':
+            yield 'B', t, json.loads(zlib.decompress(payload))
+        else:
+            yield kind.decode('ascii'), t, json.loads(payload)
+
+# =============================================================================
+# Recording proxies
+# =============================================================================
+
+class RecordingLiveData:
+
+    def __init__(self, live_data, log, clock):
+        self.live_data = live_data
+        self.log = log
+        self.clock = clock
+        self.last_seen = {} # req id -> identity of the last tick recorded (bar_store.tick_key)
+
+    # Ticks are recorded the first time they are seen, not on every poll
+    def __getitem__(self, req_id):
+
+        tick = self.live_data[req_id]
+        timestamp = getattr(tick, 'timestamp', None)
+        key = tick_key(tick) if timestamp is not None else None
+        if timestamp is not None and tick.ltp is not None and self.last_seen.get(req_id) != key:
+            self.last_seen[req_id] = key
+            self.log.tick(self.clock.now(), tick.symbol, req_id, timestamp, tick.ltp, getattr(tick, 'ttq', None))
+
+        return tick
+
+class RecordingTD:
+
+    def __init__(self, td_app, log, clock):
+        self.td_app = td_app
+        self.log = log
+        self.clock = clock
+        self.live_data = RecordingLiveData(td_app.live_data, log, clock)
+
+    def get_historic_data(self, symbol, duration='3 D', bar_size='1 min'):
+
+        now = self.clock.now()
+        started = time.perf_counter()
+        try:
+            records = self.td_app.get_historic_data(symbol, duration=duration, bar_size=bar_size)
+        except Exception as e:
+            self.log.history(now, symbol, duration, bar_size, time.perf_counter() - started, error=repr(e))
+            raise
+        self.log.history(now, symbol, duration, bar_size, time.perf_counter() - started, records)
+
+        return records
+
+    def start_live_data(self, symbols):
+
+        req_ids = self.td_app.start_live_data(symbols)
+        self.log.event('S', self.clock.now(), {'symbols': list(symbols), 'req_ids': list(req_ids)})
+
+        return req_ids
+
+    def stop_live_data(self, symbols):
+
+        self.td_app.stop_live_data(symbols)
+        self.log.event('U', self.clock.now(), {'symbols': list(symbols)})
+
+    def __getattr__(self, name):
+        return getattr(self.td_app, name)
+
+BROKER_METHODS = ['place_orders', 'modify_orders', 'delete_orders', 'order_status', 'orders', 'positions']
+
+class RecordingFyers:
+
+    def __init__(self, fyers, log, clock):
+        self.fyers = fyers
+        self.log = log
+        self.clock = clock
+
+    def _call(self, method, token, data=None):
+
+        now = self.clock.now()
+        started = time.perf_counter()
+        fn = getattr(self.fyers, method)
+        response = fn(token, data=data) if data is not None else fn(token)
+        self.log.broker(now, method, data, response, time.perf_counter() - started)
+
+        return response
+
+    def place_orders(self, token, data):
+        return self._call('place_orders', token, data)
+
+    def modify_orders(self, token, data):
+        return self._call('modify_orders', token, data)
+
+    def delete_orders(self, token, data):
+        return self._call('delete_orders', token, data)
+
+    def order_status(self, token, data):
+        return self._call('order_status', token, data)
+
+    def orders(self, token):
+        return self._call('orders', token)
+
+    def positions(self, token):
+        return self._call('positions', token)
+
+    def __getattr__(self, name):
+        return getattr(self.fyers, name)
@@ -0,0 +1,416 @@
+# =============================================================================
+# Session replay
+# Plays a session recording (recording.py) back through main.py in place of
+# the live feed and broker, to debug an incident or to benchmark the strategy
+# on a real market day, repeatably:
+# - ticks are pushed into the bar store in their recorded order, each with its
+#   recorded receive time
+# - history requests for a symbol are answered with its recorded responses in
+#   order, skipping to the last one recorded before the current time
+# - broker queries (positions, order book, order status) return the response
+#   recorded last before the current time, or the next one not yet served if it
+#   was recorded within QUERY_LOOKAHEAD seconds, and orders, modifications and
+#   cancels take the recorded responses in order. A request that differs from
+#   the recorded one is reported as a divergence, and the number of each action
+#   sent is compared with the number recorded (ReplayFyers.count_mismatches)
+# - the option chain and symbol mappings come from the session metadata
+#
+# speed > 0 replays on an accelerated clock (1 for real time) with the recorded
+# response times scaled down by the same factor. speed 0 replays as fast as
+# possible on a stepped clock that only moves when the session loop sleeps, so
+# every tick up to a point is in the bar store before the strategy reads it.
+# Periodic work (the option prefetch) runs inline on the clock's timers rather
+# than in its own thread, at the times it ran in the recorded session, so a
+# replay gives the same passes on every run. At speed > 0 background threads
+# run as in the session and their timing varies
+#
+# main.py uses this when INTRADAY_BACKEND=replay (see ReplaySession.from_env)
+# =============================================================================
+
+import bisect
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+import numpy as np
+from recording import read_log, to_seconds, from_seconds
+from simulation import AcceleratedClock
+
+# =============================================================================
+# Clock
+# =============================================================================
+
+class SteppedClock:
+
+    stepped = True # never spun on by the scheduler, it only moves when slept on
+
+    # The thread that creates the clock drives it: its sleeps move the time
+    # forward, other threads' sleeps wait for it to get there
+    def __init__(self, start):
+        self.time = start
+        self.driver = threading.current_thread()
+        self.listeners = [] # called as listener(target) before the time moves to target
+        self.timers = [] # [next time, later times, callback] run by the driver as the time passes them
+        self.recorded_steps = {} # task -> times its steps ran at in the recorded session
+        self.condition = threading.Condition()
+
+    def now(self):
+        return self.time
+
+    # Run callback() every interval seconds from now, or at the recorded times of
+    # task if there are any, in the driver thread in place of a background thread
+    # sleeping on the clock
+    def every(self, interval, callback, task=None):
+
+        if task in self.recorded_steps:
+            times = iter([x for x in self.recorded_steps[task] if x >= self.time])
+        else:
+            times = (self.time + timedelta(seconds=interval * i) for i in itertools.count())
+        first = next(times, None)
+        if first is not None:
+            self.timers.append([first, times, callback])
+
+    # Move the time forward to t from a listener, so what it delivers on the way
+    # to the target sees the time it was recorded at
+    def reach(self, t):
+        with self.condition:
+            if t > self.time:
+                self.time = t
+                self.condition.notify_all()
+
+    def _move(self, target):
+
+        if target <= self.time:
+            return
+        for listener in self.listeners:
+            listener(target)
+        with self.condition:
+            self.time = target
+            self.condition.notify_all()
+
+    def advance(self, target):
+
+        while len(self.timers) > 0:
+            timer = min(self.timers, key=lambda x: x[0])
+            if timer[0] > target:
+                break
+            self._move(timer[0])
+            following = next(timer[1], None)
+            if following is None:
+                self.timers.remove(timer)
+            else:
+                timer[0] = following
+            timer[2]()
+        self._move(target)
+
+    def sleep(self, seconds):
+
+        if seconds <= 0:
+            return
+        target = self.time + timedelta(seconds=seconds)
+        if threading.current_thread() is self.driver:
+            self.advance(target)
+            return
+        with self.condition:
+            while self.time < target:
+                self.condition.wait(1.0)
+
+# =============================================================================
+# Feed
+# =============================================================================
+
+class ReplayTD:
+
+    def __init__(self, ticks, history, clock, latency_scale=0.0):
+
+        self.clock = clock
+        self.latency_scale = latency_scale
+        # ticks: (receive time, symbol, req id, timestamp, ltp, ttq) in recorded order, kept as columns
+        self.times = np.array([x[0] for x in ticks], dtype=np.float64)
+        self.symbols = [x[1] for x in ticks]
+        self.timestamps = [x[3] for x in ticks]
+        self.ltps = [x[4] for x in ticks]
+        self.ttqs = [x[5] for x in ticks]
+        self.position = 0 # next tick to deliver
+        self.history = history # symbol -> [(time, header, records)] in recorded order
+        self.served = {} # symbol -> index of the next history response not yet served
+        self.subscribed = set()
+        self.on_tick = None # called as on_tick(symbol, timestamp, ltp, volume, now)
+        self.lock = threading.Lock()
+        self._req_ids = itertools.count(3000)
+
+    # The response recorded last before now, or the next one not yet served if that
+    # is later: a request replayed at its recorded time comes before its response
+    def get_historic_data(self, symbol, duration='3 D', bar_size='1 min'):
+
+        entries = self.history.get(symbol)
+        if not entries:
+            raise KeyError('No recorded history for ' + symbol)
+        now = to_seconds(self.clock.now())
+        with self.lock:
+            i = min(max(bisect.bisect_right([x[0] for x in entries], now) - 1, self.served.get(symbol, 0)), len(entries) - 1)
+            self.served[symbol] = i + 1
+        _, header, records = entries[i]
+        if self.latency_scale > 0:
+            time.sleep(header['elapsed'] * self.latency_scale)
+        if header['error'] is not None:
+            raise RuntimeError(header['error'])
+
+        return [dict(x) for x in records]
+
+    def start_live_data(self, symbols):
+        with self.lock:
+            self.subscribed.update(symbols)
+        return [next(self._req_ids) for _ in symbols]
+
+    def stop_live_data(self, symbols):
+        with self.lock:
+            self.subscribed.difference_update(symbols)
+
+    def disconnect(self):
+        with self.lock:
+            self.subscribed.clear()
+
+    # Push the recorded ticks received up to target for the subscribed symbols
+    def deliver_until(self, target):
+
+        limit = to_seconds(target)
+        with self.lock:
+            end = int(np.searchsorted(self.times, limit, side='right'))
+            stepped = getattr(self.clock, 'stepped', False)
+            for i in range(self.position, end):
+                if self.symbols[i] in self.subscribed and self.on_tick is not None:
+                    if stepped:
+                        self.clock.reach(from_seconds(self.times[i]))
+                    self.on_tick(self.symbols[i], from_seconds(self.timestamps[i]), self.ltps[i], self.ttqs[i], from_seconds(self.times[i]))
+            self.position = max(self.position, end)
+
+# =============================================================================
+# Broker
+# =============================================================================
+
+QUERY_METHODS = ['orders', 'positions', 'order_status']
+MATCH_WINDOW = 16 # recorded actions searched for the request, as concurrent requests may go out in another order
+QUERY_LOOKAHEAD = 1.0 # seconds a recorded query may come after the replayed one, as the session clock moved on during the live pass
+
+class ReplayFyers:
+
+    def __init__(self, calls, clock, latency_scale=0.0):
+
+        self.clock = clock
+        self.latency_scale = latency_scale
+        self.queries = {} # method (order_status: (method, id)) -> ([time], [call])
+        self.actions = {} # method -> deque of calls in recorded order
+        self.recorded = {} # method -> times of the actions recorded
+        self.replayed = {} # method -> number of actions sent in the replay
+        for t, call in calls:
+            if call['method'] in QUERY_METHODS:
+                key = call['method'] if call['method'] != 'order_status' else (call['method'], (call['data'] or {}).get('id'))
+                times, entries = self.queries.setdefault(key, ([], []))
+                times.append(t)
+                entries.append(call)
+            else:
+                self.actions.setdefault(call['method'], deque()).append(call)
+                self.recorded.setdefault(call['method'], []).append(t)
+        self.served = {} # query key -> index of the next recorded response not yet served
+        self.book = {} # id -> order as in the last order book served
+        self.calls = 0
+        self.divergences = 0
+        self.lock = threading.Lock()
+
+    def _query(self, key, missing):
+
+        self.calls += 1
+        times, entries = self.queries.get(key, ([], []))
+        now = to_seconds(self.clock.now())
+        with self.lock:
+            i = bisect.bisect_right(times, now) - 1
+            following = self.served.get(key, 0)
+            if i < following < len(times) and times[following] <= now + QUERY_LOOKAHEAD:
+                i = following
+            if i < 0:
+                return missing
+            self.served[key] = i + 1
+        if self.latency_scale > 0:
+            time.sleep(entries[i]['elapsed'] * self.latency_scale)
+
+        return entries[i]['response']
+
+    def _action(self, method, data):
+
+        with self.lock:
+            self.calls += 1
+            self.replayed[method] = self.replayed.get(method, 0) + 1
+            queue = self.actions.get(method)
+            call = None
+            if queue:
+                i = next((i for i, x in enumerate(itertools.islice(queue, MATCH_WINDOW)) if x['data'] == data), 0)
+                call = queue[i]
+                del queue[i]
+            if call is None or call['data'] != data:
+                self.divergences += 1
+                print('Replay divergence: ' + method + ' ' + str(data) + (' was not recorded' if call is None else ', recorded ' + str(call['data'])))
+        if call is None:
+            return {'code': -1, 's': 'error', 'message': 'No recorded response'}
+        if self.latency_scale > 0:
+            time.sleep(call['elapsed'] * self.latency_scale)
+
+        return call['response']
+
+    # Actions sent a different number of times than recorded up to now: method -> (recorded, replayed)
+    def count_mismatches(self):
+
+        now = to_seconds(self.clock.now())
+        recorded = {k: bisect.bisect_right(v, now) for k, v in self.recorded.items()}
+        methods = sorted(set(recorded) | set(self.replayed))
+
+        return {x: (recorded.get(x, 0), self.replayed.get(x, 0)) for x in methods if recorded.get(x, 0) != self.replayed.get(x, 0)}
+
+    def place_orders(self, token, data):
+        return self._action('place_orders', data)
+
+    def modify_orders(self, token, data):
+        return self._action('modify_orders', data)
+
+    def delete_orders(self, token, data):
+        return self._action('delete_orders', data)
+
+    def order_status(self, token, data):
+        return self._query(('order_status', data.get('id')), {'code': -52, 's': 'error', 'message': 'Unknown order'})
+
+    def orders(self, token):
+
+        response = self._query('orders', {'code': 200, 's': 'ok', 'data': {'orderBook': []}})
+        if isinstance(response, dict) and response.get('code') == 200:
+            self.book = {x.get('id'): x for x in response['data']['orderBook']}
+
+        return response
+
+    def positions(self, token):
+        return self._query('positions', {'code': 200, 's': 'ok', 'data': {'netPositions': []}})
+
+# =============================================================================
+# Instrument master
+# =============================================================================
+
+class ReplayInstrumentMaster:
+
+    # meta: the session metadata recorded by main.py
+    def __init__(self, meta):
+
+        self.nearest_expiry = datetime.fromisoformat(meta['nearest_expiry'])
+        self.monthend_expiry = meta['monthend_expiry']
+        self.underlyings = {} # F&O code -> (expiry date, lot size, {(strike, opt_type): fyers_symbol})
+        for s, fo_underlying in meta['underlying_mapping'].items():
+            if s not in meta['option_tickers']:
+                continue
+            tickers = {(float(k), t): x for k, t, x in meta['option_tickers'][s]}
+            self.underlyings[fo_underlying] = (datetime.fromisoformat(meta['option_expiries'][s]).date(), meta['lotsize_mapping'][s], tickers)
+
+    def all_expiries(self):
+        return [self.nearest_expiry]
+
+    def is_monthend_expiry(self, expiry):
+        return self.monthend_expiry
+
+    def expiries(self, fo_underlying):
+        return [self.underlyings[fo_underlying][0]] if fo_underlying in self.underlyings else []
+
+    def strikes(self, fo_underlying, expiry):
+        return sorted(set(k for k, _ in self.underlyings[fo_underlying][2])) if fo_underlying in self.underlyings else []
+
+    def option_tickers(self, fo_underlying, expiry):
+        return dict(self.underlyings[fo_underlying][2]) if fo_underlying in self.underlyings else {}
+
+    def option_underlyings(self):
+        return sorted(self.underlyings)
+
+    def lot_size(self, fo_underlying):
+        return self.underlyings[fo_underlying][1] if fo_underlying in self.underlyings else None
+
+# =============================================================================
+# Session
+# =============================================================================
+
+class ReplaySession:
+
+    def __init__(self, clock, td, fyers, instrument_master, meta, speed, end=None):
+        self.clock = clock
+        self.end = end # time of the last frame recorded
+        self.td = td
+        self.fyers = fyers
+        self.instrument_master = instrument_master
+        self.meta = meta
+        self.speed = speed
+
+    # start is 'HH:MM' on the recorded day, None for the recorded start
+    @classmethod
+    def load(cls, path, speed=0.0, start=None):
+
+        ticks, history, calls, steps, meta = [], {}, [], {}, None
+        end = None
+        for kind, t, value in read_log(path):
+            end = t
+            if kind == 'T':
+                ticks.append((t,) + value)
+            elif kind == 'H':
+                history.setdefault(value[0], []).append((t, value[1], value[2]))
+            elif kind == 'B':
+                calls.append((t, value))
+            elif kind == 'P':
+                steps.setdefault(value['task'], []).append(from_seconds(t))
+            elif kind == 'M' and meta is None:
+                meta = value
+        if meta is None:
+            raise ValueError(path + ' has no session metadata')
+
+        recorded_start = datetime.fromisoformat(meta['start'])
+        start = datetime.combine(recorded_start.date(), datetime.strptime(start, '%H:%M').time()) if start is not None else recorded_start
+        clock = AcceleratedClock(start, speed) if speed > 0 else SteppedClock(start)
+        if speed <= 0:
+            clock.recorded_steps = steps
+        latency_scale = 1.0 / speed if speed > 0 else 0.0
+        td = ReplayTD(ticks, history, clock, latency_scale)
+        fyers = ReplayFyers(calls, clock, latency_scale)
+
+        return cls(clock, td, fyers, ReplayInstrumentMaster(meta), meta, speed, from_seconds(end))
+
+    # Build a session from environment variables: INTRADAY_REPLAY_LOG (the
+    # recording), INTRADAY_REPLAY_SPEED (default 0, as fast as possible) and
+    # INTRADAY_REPLAY_START (HH:MM, default the recorded start). SYMBOLS and the
+    # mappings passed in are replaced by the recorded ones
+    @classmethod
+    def from_env(cls, SYMBOLS, underlying_mapping, lotsize_mapping, min_strike_incr_mapping):
+
+        env = os.environ
+        session = cls.load(env['INTRADAY_REPLAY_LOG'], float(env.get('INTRADAY_REPLAY_SPEED', 0)), env.get('INTRADAY_REPLAY_START'))
+
+        meta = session.meta
+        SYMBOLS[:] = meta['symbols']
+        for mapping, recorded in ((underlying_mapping, meta['underlying_mapping']), (lotsize_mapping, meta['lotsize_mapping']),
+                                  (min_strike_incr_mapping, meta['min_strike_incr_mapping'])):
+            mapping.clear()
+            mapping.update(recorded)
+
+        return session
+
+    # Push the recorded ticks into the bar store: from the clock's steps when
+    # replaying as fast as possible, from a thread following the clock otherwise
+    def attach(self, bar_store, interval=0.01):
+
+        self.td.on_tick = bar_store.on_tick
+        if isinstance(self.clock, SteppedClock):
+            self.clock.listeners.append(self.td.deliver_until)
+            return None
+
+        def run():
+            while True:
+                self.td.deliver_until(self.clock.now())
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name='replay-feed', daemon=True)
+        thread.start()
+
+        return thread
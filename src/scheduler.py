@@ -0,0 +1,79 @@
+# =============================================================================
+# Event-driven session scheduler
+# Sleeps until the next evaluation boundary or monitoring tick instead of
+# polling the clock. Evaluations fire on the boundary (coarse sleep followed by
+# a short spin) and their start jitter is measured. Monitoring runs on its own
+# cadence
+# =============================================================================
+
+from datetime import datetime, timedelta
+from clock import SystemClock
+from events import event_log
+
+class SessionScheduler:
+
+    # eval_times and the session bounds are 'HH:MM' strings for the current day
+    def __init__(self, session_start, session_end, eval_times, monitor_interval=3, clock=None, spin_seconds=0.002):
+
+        self.clock = clock if clock is not None else SystemClock()
+        self.session_start = session_start
+        self.session_end = session_end
+        self.eval_times = sorted(set(eval_times))
+        self.monitor_interval = timedelta(seconds=monitor_interval)
+        # A stepped clock (replay.py) only moves when slept on, so it is never spun on
+        self.spin = timedelta(seconds=spin_seconds if not getattr(self.clock, 'stepped', False) else 0)
+        self.jitter = {} # 'HH:MM' -> seconds between the boundary and the start of its evaluation
+
+    def _at(self, day, hhmm):
+        return datetime.combine(day, datetime.strptime(hhmm, '%H:%M').time())
+
+    # Sleep until target, spinning over the last moments
+    def _sleep_until(self, target):
+
+        remaining = (target - self.clock.now() - self.spin).total_seconds()
+        if remaining > 0:
+            self.clock.sleep(remaining)
+
+        while self.clock.now() < target:
+            pass
+
+    # Run the session. on_eval(time_now) is called at each evaluation boundary and
+    # on_monitor(time_now) on every monitoring tick, with time_now as 'HH:MM'
+    def run(self, on_eval, on_monitor):
+
+        now = self.clock.now()
+        day = now.date()
+        start = self._at(day, self.session_start)
+        end = self._at(day, self.session_end) + timedelta(minutes=1)
+        boundaries = [self._at(day, x) for x in self.eval_times]
+        # A boundary of the current minute is still due, so a restart just after it does not skip it
+        boundaries = [x for x in boundaries if x + timedelta(minutes=1) > now and start <= x < end]
+
+        if now < start:
+            event_log.emit('session_wait', 'Waiting for market to open...', start=start)
+            self._sleep_until(start)
+
+        next_monitor = self.clock.now()
+        while True:
+            now = self.clock.now()
+            if now >= end:
+                break
+
+            next_eval = boundaries[0] if len(boundaries) > 0 else None
+            if next_eval is not None and next_eval <= next_monitor:
+                self._sleep_until(next_eval)
+                started = self.clock.now()
+                boundaries.pop(0)
+                time_now = next_eval.strftime('%H:%M')
+                self.jitter[time_now] = (started - next_eval).total_seconds()
+                event_log.emit('eval_start', time_now + ' - Evaluation started ' + str(round(self.jitter[time_now] * 1000, 2)) + ' ms after the boundary',
+                               eval=time_now, boundary=next_eval, jitter_us=round(self.jitter[time_now] * 1e6))
+                on_eval(time_now)
+                next_monitor = self.clock.now() + self.monitor_interval
+                continue
+
+            self._sleep_until(min(next_monitor, end))
+            if self.clock.now() >= end:
+                break
+            on_monitor(self.clock.now().strftime('%H:%M'))
+            next_monitor = self.clock.now() + self.monitor_interval
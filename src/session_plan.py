@@ -0,0 +1,65 @@
+# =============================================================================
+# Pre-market session plan
+# Everything about the trading day that is known before the open, materialised
+# once as datetimes: evaluation boundaries, the reference window of each
+# evaluation, the gap window, the expiry flags, and per symbol the previous
+# trading day and its close. At the open the gap check is the day's 09:15 open
+# against a stored close, and picking a reference window is a dict lookup
+# =============================================================================
+
+from datetime import datetime
+
+def _at(day, hhmm):
+    return datetime.combine(day, datetime.strptime(hhmm, '%H:%M').time())
+
+class SessionPlan:
+
+    # Times are 'HH:MM' strings. The first evaluation's reference window is taken
+    # from the previous trading day, the others from day
+    def __init__(self, day, strat_eval_times, reference_bar_start_times, reference_bar_end_times,
+                 gap_trade_time, gap_window=('09:15', '09:24'), close_time='15:29', expiry=None, monthend_expiry=False):
+
+        self.day = day
+        self.first_eval = strat_eval_times[0]
+        self.gap_trade_time = gap_trade_time
+        self.open_time = _at(day, gap_window[0])
+        self.close_time = close_time
+        self.boundaries = {x: _at(day, x) for x in strat_eval_times + [gap_trade_time]}
+        self.windows = {x: (_at(day, a), _at(day, b)) for x, a, b in zip(strat_eval_times, reference_bar_start_times, reference_bar_end_times)}
+        self.first_window = (reference_bar_start_times[0], reference_bar_end_times[0])
+        self.gap_window = (_at(day, gap_window[0]), _at(day, gap_window[1]))
+        self.expiry = expiry
+        self.is_expiry_day = expiry is not None and expiry.date() == day
+        self.monthend_expiry = monthend_expiry
+        self.prev_day = {} # symbol -> previous trading day
+        self.prev_close = {} # symbol -> close of the previous trading day
+        self.prev_windows = {} # symbol -> first evaluation's reference window on the previous trading day
+
+    # Record the previous trading day and its close for each symbol from its bars
+    # (bars.Bars). The close is the close_time bar, or the day's last bar if that
+    # one is missing
+    def load_previous_session(self, bars_by_symbol):
+
+        for symbol, bars in bars_by_symbol.items():
+            days = [x for x in bars.dates() if x < self.day]
+            if len(days) == 0:
+                continue
+            prev_day = days[-1]
+            close = bars.value_at(_at(prev_day, self.close_time), 'c')
+            if close is None:
+                i, j = bars.window(_at(prev_day, '00:00'), _at(prev_day, self.close_time))
+                close = float(bars.c[j - 1]) if j > i else None
+            self.prev_day[symbol] = prev_day
+            self.prev_close[symbol] = close
+            self.prev_windows[symbol] = (_at(prev_day, self.first_window[0]), _at(prev_day, self.first_window[1]))
+
+    # Reference window (start, end) used by the evaluation at time_now for symbol,
+    # None if it is not known
+    def reference_window(self, symbol, time_now, gap=False):
+
+        if gap or time_now == self.gap_trade_time:
+            return self.gap_window
+        if time_now == self.first_eval:
+            return self.prev_windows.get(symbol)
+
+        return self.windows.get(time_now)
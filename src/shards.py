@@ -0,0 +1,48 @@
+# =============================================================================
+# Symbol sharding
+# Splits the traded underlyings across worker processes. Each shard runs main.py
+# as its own process with INTRADAY_SHARD=<index>/<count> and trades only the
+# symbols assigned to it, with its own feed connection, bar store and broker
+# snapshot. Assignment hashes the symbol name, so it does not change when
+# symbols are added to or dropped from the universe
+#
+# Usage: python shards.py <count>
+# =============================================================================
+
+import os
+import subprocess
+import sys
+import zlib
+
+def shard_of(symbol, count):
+    return zlib.crc32(symbol.encode('utf-8')) % count
+
+def shard_symbols(SYMBOLS, index, count):
+    return [s for s in SYMBOLS if shard_of(s, count) == index]
+
+# Parse 'index/count', e.g. '0/4'. Empty means a single unsharded process
+def parse_shard(spec):
+
+    if not spec:
+        return 0, 1
+    index, count = [int(x) for x in spec.split('/')]
+    if not 0 <= index < count:
+        raise ValueError('Invalid shard ' + spec)
+
+    return index, count
+
+# Start count shard processes of main.py and wait for all of them
+def run_shards(count, script=None):
+
+    script = script if script is not None else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    processes = []
+    for index in range(count):
+        env = dict(os.environ, INTRADAY_SHARD=str(index) + '/' + str(count))
+        processes.append(subprocess.Popen([sys.executable, script], env=env))
+
+    return [x.wait() for x in processes]
+
+if __name__ == '__main__':
+
+    codes = run_shards(int(sys.argv[1]))
+    sys.exit(max(codes) if len(codes) > 0 else 0)
@@ -0,0 +1,502 @@
+# =============================================================================
+# Local stand-ins for the Fyers broker and the TrueData feed
+# Lets the strategy run end to end without live accounts or market hours:
+# - AcceleratedClock runs a trading day faster than real time
+# - SimMarket serves 1 min bars, either recorded (a bar archive, as read by
+#   the backtest) or synthetic, and a tick path inside each minute
+# - SimTD answers history requests and exposes live ticks like truedata_ws
+# - SimFyers matches orders against the simulated prices and keeps positions,
+#   with configurable latency and rejection rate
+# - SimInstrumentMaster lists an option chain for the simulated underlyings
+#
+# main.py uses these when INTRADAY_BACKEND=sim (see SimSession.from_env)
+# =============================================================================
+
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from bar_archive import BarArchive
+
+SESSION_START = '09:15'
+SESSION_MINUTES = 375
+
+# =============================================================================
+# Clock
+# =============================================================================
+
+class AcceleratedClock:
+
+    # Simulated time starts at start and runs speed times faster than real time
+    def __init__(self, start, speed=1.0):
+        self.start = start
+        self.speed = float(speed)
+        self.started = time.monotonic()
+
+    def now(self):
+        return self.start + timedelta(seconds=(time.monotonic() - self.started) * self.speed)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+# =============================================================================
+# Market
+# =============================================================================
+
+def _session_times(day):
+    start = datetime.combine(day, datetime.strptime(SESSION_START, '%H:%M').time())
+    return np.array([start + timedelta(minutes=i) for i in range(SESSION_MINUTES)], dtype='datetime64[s]')
+
+class SimMarket:
+
+    # underlyings maps each underlying symbol (e.g. 'NIFTY 50') to its F&O code,
+    # strike increment and starting price. Bars are served for `days` (oldest first,
+    # the last one being the simulated session). data_dir, if given, is searched for
+    # recorded bars first
+    def __init__(self, underlyings, days, expiry, data_dir=None, seed=0):
+
+        self.underlyings = underlyings
+        self.days = days
+        self.expiry = expiry
+        self.data_dir = data_dir
+        self.rng = np.random.default_rng(seed)
+        self.bars = {} # symbol -> dict of time/o/h/l/c/v arrays over all days
+        self.lock = threading.RLock() # option bars are derived from underlying bars under the lock
+        self.fo_codes = {v['fo_underlying']: k for k, v in underlyings.items()}
+        self.option_re = re.compile(r'^(\d{6})(\d+(?:\.\d+)?)(CE|PE)$')
+
+        for symbol, spec in underlyings.items():
+            self.bars[symbol] = self._load_recorded(symbol) or self._synthetic_underlying(spec['price'])
+
+    def _load_recorded(self, symbol):
+
+        if self.data_dir is None:
+            return None
+        archive = BarArchive(self.data_dir)
+        parts = []
+        for day in self.days:
+            bars = archive.read_day(symbol, day)
+            if len(bars) == 0:
+                return None
+            parts.append(bars)
+
+        bars = np.concatenate(parts)
+        return {f: np.array(bars[f]) for f in ['time', 'o', 'h', 'l', 'c', 'v']}
+
+    def _synthetic_underlying(self, price):
+
+        times = np.concatenate([_session_times(d) for d in self.days])
+        returns = self.rng.normal(0, 0.0006, len(times))
+        # Overnight moves between days
+        returns[SESSION_MINUTES::SESSION_MINUTES] += self.rng.normal(0, 0.005, len(self.days) - 1)
+        c = price * np.exp(np.cumsum(returns))
+        o = np.concatenate([[price], c[:-1]])
+        spread = np.abs(self.rng.normal(0, 0.0004, len(times))) * c
+
+        return {'time': times, 'o': o, 'h': np.maximum(o, c) + spread, 'l': np.minimum(o, c) - spread, 'c': c,
+                'v': self.rng.integers(1000, 5000, len(times)).astype(np.float64)}
+
+    # Option premium from the underlying price: intrinsic value plus a time value
+    # that decays away from the strike
+    def _premium(self, underlying_price, strike, opt_type, base):
+        intrinsic = np.maximum(underlying_price - strike, 0) if opt_type == 'CE' else np.maximum(strike - underlying_price, 0)
+        return np.round((intrinsic + base * 0.006 * np.exp(-np.abs(underlying_price - strike) / (base * 0.01)) + 0.5) / 0.05) * 0.05
+
+    def _synthetic_option(self, symbol):
+
+        # TrueData option symbols are <F&O underlying><YYMMDD><strike><CE|PE>
+        fo_underlying = max([x for x in self.fo_codes if symbol.startswith(x)], key=len, default=None)
+        m = self.option_re.match(symbol[len(fo_underlying):]) if fo_underlying is not None else None
+        if m is None:
+            return None
+        underlying = self.fo_codes[fo_underlying]
+        strike, opt_type = float(m.group(2)), m.group(3)
+        u = self.get_bars(underlying)
+        base = self.underlyings[underlying]['price']
+        o, c = self._premium(u['o'], strike, opt_type, base), self._premium(u['c'], strike, opt_type, base)
+        high_source, low_source = (u['h'], u['l']) if opt_type == 'CE' else (u['l'], u['h'])
+
+        return {'time': u['time'], 'o': o, 'h': np.maximum(self._premium(high_source, strike, opt_type, base), np.maximum(o, c)),
+                'l': np.minimum(self._premium(low_source, strike, opt_type, base), np.minimum(o, c)), 'c': c,
+                'v': self.rng.integers(100, 1000, len(u['time'])).astype(np.float64)}
+
+    # Bars of an underlying or option, by TrueData symbol or Fyers symbol
+    def get_bars(self, symbol):
+
+        symbol = self.fyers_to_td(symbol)
+        with self.lock:
+            if symbol not in self.bars:
+                bars = self._load_recorded(symbol) or self._synthetic_option(symbol)
+                if bars is None:
+                    raise KeyError('Unknown symbol ' + symbol)
+                self.bars[symbol] = bars
+            return self.bars[symbol]
+
+    # Fyers option symbols are the TrueData ones with an exchange prefix
+    def fyers_to_td(self, symbol):
+        return symbol.split(':', 1)[1] if ':' in symbol else symbol
+
+    # Completed bars (time < minute of now) of the last n_days trading days as the
+    # list of dicts get_historic_data returns
+    def history(self, symbol, now, n_days=None):
+
+        bars = self.get_bars(symbol)
+        n = int(np.searchsorted(bars['time'], np.datetime64(now.replace(second=0, microsecond=0), 's')))
+        first = 0
+        if n_days is not None:
+            days = [d for d in self.days if d <= now.date()][-n_days:]
+            first = int(np.searchsorted(bars['time'], np.datetime64(days[0], 's'))) if len(days) > 0 else n
+
+        return [{'time': bars['time'][i].astype(datetime), 'o': float(bars['o'][i]), 'h': float(bars['h'][i]),
+                 'l': float(bars['l'][i]), 'c': float(bars['c'][i]), 'v': float(bars['v'][i]), 'oi': 0} for i in range(first, n)]
+
+    # Prices along the tick path between t0 and t1 at one second steps. Inside a
+    # minute the path runs open -> high -> low -> close (or open -> low -> high ->
+    # close on a down bar)
+    def price_path(self, symbol, t0, t1):
+
+        bars = self.get_bars(symbol)
+        seconds = np.arange(np.datetime64(t0, 's'), np.datetime64(t1, 's') + np.timedelta64(1, 's'), np.timedelta64(1, 's'))
+        i = np.searchsorted(bars['time'], seconds, side='right') - 1
+        inside = (i >= 0) & (seconds < bars['time'][np.maximum(i, 0)] + np.timedelta64(60, 's'))
+        if not inside.any():
+            return np.array([])
+        i, seconds = i[inside], seconds[inside]
+
+        frac = (seconds - bars['time'][i]).astype(np.float64) / 59.0
+        up = bars['c'][i] >= bars['o'][i]
+        p1 = np.where(up, bars['h'][i], bars['l'][i])
+        p2 = np.where(up, bars['l'][i], bars['h'][i])
+        leg = np.minimum((frac * 3).astype(int), 2)
+        w = frac * 3 - leg
+        start = np.choose(leg, [bars['o'][i], p1, p2])
+        end = np.choose(leg, [p1, p2, bars['c'][i]])
+
+        return start + (end - start) * w
+
+    def price_at(self, symbol, t):
+        path = self.price_path(symbol, t, t)
+        return float(path[-1]) if len(path) > 0 else None
+
+    def cumulative_volume(self, symbol, t):
+        bars = self.get_bars(symbol)
+        if 'cv' not in bars:
+            bars['cv'] = np.cumsum(bars['v'])
+        i = int(np.searchsorted(bars['time'], np.datetime64(t, 's'), side='right'))
+        return float(bars['cv'][i - 1]) if i > 0 else 0.0
+
+# =============================================================================
+# TrueData stand-in
+# =============================================================================
+
+class SimTick:
+
+    def __init__(self, symbol, timestamp, ltp, ttq):
+        self.symbol = symbol
+        self.timestamp = timestamp
+        self.ltp = ltp
+        self.ttq = ttq
+
+class SimLiveData:
+
+    # Mapping of request id to the latest tick, computed from the clock on access
+    def __init__(self, td):
+        self.td = td
+
+    def __getitem__(self, req_id):
+
+        symbol = self.td.subscriptions[req_id]
+        now = self.td.clock.now().replace(microsecond=0)
+        # A stalled feed keeps serving the last tick before the stall
+        for start, end in self.td.stalls:
+            if start <= now < end:
+                now = start
+                break
+        ltp = self.td.market.price_at(symbol, now)
+        if ltp is None:
+            raise KeyError(req_id)
+
+        return SimTick(symbol, now, ltp, self.td.market.cumulative_volume(symbol, now))
+
+class SimTD:
+
+    # stalls: [(start, end)] in which the live data stops updating
+    def __init__(self, market, clock, history_latency=0.0, stalls=()):
+        self.market = market
+        self.clock = clock
+        self.history_latency = history_latency
+        self.stalls = list(stalls)
+        self.subscriptions = {}
+        self.live_data = SimLiveData(self)
+        self._req_ids = itertools.count(2000)
+
+    def get_historic_data(self, symbol, duration='3 D', bar_size='1 min'):
+        if self.history_latency > 0:
+            time.sleep(self.history_latency)
+        return self.market.history(symbol, self.clock.now(), int(duration.split()[0]) if duration.endswith(' D') else None)
+
+    def start_live_data(self, symbols):
+
+        req_ids = []
+        for symbol in symbols:
+            req_id = next(self._req_ids)
+            self.subscriptions[req_id] = symbol
+            req_ids.append(req_id)
+
+        return req_ids
+
+    def stop_live_data(self, symbols):
+        for req_id in [k for k, v in self.subscriptions.items() if v in symbols]:
+            del self.subscriptions[req_id]
+
+    def disconnect(self):
+        self.subscriptions.clear()
+
+# =============================================================================
+# Fyers stand-in
+# =============================================================================
+
+class SimFyers:
+
+    # latency: seconds added to every call; reject_rate: share of orders rejected
+    def __init__(self, market, clock, latency=0.0, reject_rate=0.0, seed=0):
+        self.market = market
+        self.clock = clock
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.rng = random.Random(seed)
+        self.book = {} # id -> order book entry
+        self.pending = set() # ids of pending orders
+        self.net = {} # symbol -> [net qty, realized profit, buy value, sell value]
+        self.last_match = None
+        self.lock = threading.Lock()
+        self._order_ids = itertools.count(1)
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _fill(self, order, price):
+
+        order['status'] = 2
+        order['filledQty'] = order['qty']
+        order['tradedPrice'] = price
+        position = self.net.setdefault(order['symbol'], [0, 0.0, 0.0, 0.0])
+        position[0] += order['qty'] * order['side']
+        if order['side'] == 1:
+            position[2] += order['qty'] * price
+        else:
+            position[3] += order['qty'] * price
+
+    # Fill pending orders whose price was touched since the last match
+    def _match(self):
+
+        now = self.clock.now().replace(microsecond=0)
+        if now == self.last_match:
+            return
+        since = self.last_match if self.last_match is not None else now
+        self.last_match = now
+
+        # Price range of each symbol with pending orders since the last match
+        ranges = {}
+        for order_id in list(self.pending):
+            order = self.book[order_id]
+            if order['status'] != 6:
+                self.pending.discard(order_id)
+                continue
+            if order['symbol'] not in ranges:
+                path = self.market.price_path(order['symbol'], since, now)
+                ranges[order['symbol']] = (path.min(), path.max()) if len(path) > 0 else None
+            if ranges[order['symbol']] is None:
+                continue
+            low, high = ranges[order['symbol']]
+            if order['type'] == 1:
+                hit = low <= order['limitPrice'] if order['side'] == 1 else high >= order['limitPrice']
+                price = order['limitPrice']
+            else:
+                hit = high >= order['stopPrice'] if order['side'] == 1 else low <= order['stopPrice']
+                price = order['stopPrice']
+            if hit:
+                self._fill(order, price)
+
+    def place_orders(self, token, data):
+
+        self._call()
+        with self.lock:
+            if self.rng.random() < self.reject_rate:
+                return {'code': -50, 's': 'error', 'message': 'Simulated rejection'}
+            self._match()
+            order_id = 'SIM' + str(next(self._order_ids))
+            self.book[order_id] = dict(data, id=order_id, status=6, filledQty=0, tradedPrice=0)
+            self.pending.add(order_id)
+
+        return {'code': 200, 's': 'ok', 'data': {'id': order_id}, 'message': ''}
+
+    def modify_orders(self, token, data):
+
+        self._call()
+        with self.lock:
+            self._match()
+            order = self.book.get(data.get('id'))
+            if order is None or order['status'] != 6:
+                return {'code': -52, 's': 'error', 'message': 'Order is not pending'}
+            for key in ('qty', 'limitPrice', 'stopPrice', 'type'):
+                if key in data:
+                    order[key] = data[key]
+
+        return {'code': 200, 's': 'ok', 'data': {'id': order['id']}, 'message': ''}
+
+    def delete_orders(self, token, data):
+
+        self._call()
+        with self.lock:
+            self._match()
+            order = self.book.get(data.get('id'))
+            if order is None or order['status'] != 6:
+                return {'code': -52, 's': 'error', 'message': 'Order is not pending'}
+            order['status'] = 1
+
+        return {'code': 200, 's': 'ok', 'data': {'id': order['id']}, 'message': ''}
+
+    def order_status(self, token, data):
+
+        self._call()
+        with self.lock:
+            self._match()
+            order = self.book.get(data.get('id'))
+
+        return {'code': 200, 's': 'ok', 'data': {'orderDetails': order}} if order is not None else {'code': -52, 's': 'error', 'message': 'Unknown order'}
+
+    def orders(self, token):
+
+        self._call()
+        with self.lock:
+            self._match()
+            book = [dict(x) for x in self.book.values()]
+
+        return {'code': 200, 's': 'ok', 'data': {'orderBook': book}}
+
+    def positions(self, token):
+
+        self._call()
+        with self.lock:
+            self._match()
+            net_positions = [{'symbol': symbol, 'qty': x[0], 'netQty': x[0], 'buyVal': x[2], 'sellVal': x[3]} for symbol, x in self.net.items()]
+
+        return {'code': 200, 's': 'ok', 'data': {'netPositions': net_positions}}
+
+# =============================================================================
+# Instrument master
+# =============================================================================
+
+class SimInstrumentMaster:
+
+    def __init__(self, market, n_strikes=60):
+        self.market = market
+        self.n_strikes = n_strikes
+
+    def all_expiries(self):
+        return [datetime.combine(self.market.expiry, datetime.min.time())]
+
+    def is_monthend_expiry(self, expiry):
+        return False
+
+    def expiries(self, fo_underlying):
+        return [self.market.expiry]
+
+    def strikes(self, fo_underlying, expiry):
+
+        symbol = self.market.fo_codes[fo_underlying]
+        spec = self.market.underlyings[symbol]
+        centre = round(spec['price'] / spec['strike_incr']) * spec['strike_incr']
+
+        return [float(centre + i * spec['strike_incr']) for i in range(-self.n_strikes, self.n_strikes + 1)]
+
+    def option_tickers(self, fo_underlying, expiry):
+
+        if fo_underlying not in self.market.fo_codes:
+            return {}
+        code = expiry.strftime('%y%m%d')
+
+        return {(k, t): 'NSE:' + fo_underlying + code + str(int(k)) + t for k in self.strikes(fo_underlying, expiry) for t in ('CE', 'PE')}
+
+    def option_underlyings(self):
+        return sorted(self.market.fo_codes)
+
+    def lot_size(self, fo_underlying):
+        return self.market.underlyings[self.market.fo_codes[fo_underlying]].get('lot_size', 1)
+
+# =============================================================================
+# Session
+# =============================================================================
+
+DEFAULT_PRICES = {'NIFTY 50': 15800.0, 'NIFTY BANK': 35000.0}
+
+class SimSession:
+
+    def __init__(self, market, clock, td, fyers, instrument_master):
+        self.market = market
+        self.clock = clock
+        self.td = td
+        self.fyers = fyers
+        self.instrument_master = instrument_master
+
+    # A further feed session on the same market, as a standby connection
+    def connect_td(self):
+        return SimTD(self.market, self.clock, self.td.history_latency)
+
+    # Build a session from environment variables:
+    # INTRADAY_SIM_DAY (YYYY-MM-DD, default today), INTRADAY_SIM_START (HH:MM, default 09:10),
+    # INTRADAY_SIM_SPEED (default 60), INTRADAY_SIM_DATA_DIR (recorded bars),
+    # INTRADAY_SIM_EXTRA_SYMBOLS (number of synthetic underlyings added),
+    # INTRADAY_SIM_BROKER_LATENCY / INTRADAY_SIM_HISTORY_LATENCY (seconds),
+    # INTRADAY_SIM_REJECT_RATE, INTRADAY_SIM_FEED_STALL (HH:MM-HH:MM in which the
+    # first feed session stops updating). Extra underlyings are appended to
+    # SYMBOLS and the mappings passed in
+    @classmethod
+    def from_env(cls, SYMBOLS, underlying_mapping, lotsize_mapping, min_strike_incr_mapping):
+
+        env = os.environ
+        day = datetime.strptime(env['INTRADAY_SIM_DAY'], '%Y-%m-%d').date() if 'INTRADAY_SIM_DAY' in env else datetime.today().date()
+        start = datetime.combine(day, datetime.strptime(env.get('INTRADAY_SIM_START', '09:10'), '%H:%M').time())
+        clock = AcceleratedClock(start, float(env.get('INTRADAY_SIM_SPEED', 60)))
+
+        for i in range(int(env.get('INTRADAY_SIM_EXTRA_SYMBOLS', 0))):
+            # Letters only, so no symbol is a prefix of another followed by a digit
+            symbol = 'SIM' + ''.join(chr(65 + (i // 26 ** k) % 26) for k in (2, 1, 0))
+            SYMBOLS.append(symbol)
+            underlying_mapping[symbol] = symbol
+            lotsize_mapping[symbol] = 500
+            min_strike_incr_mapping[symbol] = 10
+
+        underlyings = {}
+        for s in SYMBOLS:
+            underlyings[s] = {'fo_underlying': underlying_mapping[s], 'strike_incr': min_strike_incr_mapping[s],
+                              'lot_size': lotsize_mapping[s], 'price': DEFAULT_PRICES.get(s, 1000.0)}
+
+        # Previous two weekdays plus the simulated day
+        days = [day]
+        while len(days) < 3:
+            prev = days[0] - timedelta(days=1)
+            while prev.weekday() >= 5:
+                prev -= timedelta(days=1)
+            days.insert(0, prev)
+        expiry = day + timedelta(days=(3 - day.weekday()) % 7)
+
+        market = SimMarket(underlyings, days, expiry, env.get('INTRADAY_SIM_DATA_DIR'))
+        stalls = []
+        if env.get('INTRADAY_SIM_FEED_STALL'):
+            start_time, end_time = env['INTRADAY_SIM_FEED_STALL'].split('-')
+            stalls.append((datetime.combine(day, datetime.strptime(start_time, '%H:%M').time()),
+                           datetime.combine(day, datetime.strptime(end_time, '%H:%M').time())))
+        td = SimTD(market, clock, float(env.get('INTRADAY_SIM_HISTORY_LATENCY', 0)), stalls)
+        fyers = SimFyers(market, clock, float(env.get('INTRADAY_SIM_BROKER_LATENCY', 0)), float(env.get('INTRADAY_SIM_REJECT_RATE', 0)))
+
+        return cls(market, clock, td, fyers, SimInstrumentMaster(market))
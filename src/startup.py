@@ -0,0 +1,66 @@
+# =============================================================================
+# Startup pipeline
+# Process startup as named steps with dependencies. Each step runs in its own
+# thread as soon as the steps it depends on have finished, so independent steps
+# (instrument master, broker session, data feed) overlap, and a step's result
+# is only waited for where it is needed. The duration of every step and of the
+# whole startup is recorded as the 'startup' stage of the latency recorder
+# =============================================================================
+
+import threading
+import time
+from concurrent.futures import Future
+from latency import recorder
+
+class StartupPipeline:
+
+    def __init__(self):
+        self.futures = {} # step name -> Future of its result
+        self.durations = {} # step name -> seconds
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    # Run fn with the results of the steps in after, once they are done. A step
+    # whose dependency failed fails with the same error
+    def add(self, name, fn, after=()):
+
+        dependencies = [self.futures[x] for x in after]
+        future = Future()
+        self.futures[name] = future
+
+        def run():
+            try:
+                results = [x.result() for x in dependencies]
+                started = time.perf_counter()
+                with recorder.timed('startup', name):
+                    result = fn(*results)
+                self.durations[name] = time.perf_counter() - started
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name='startup-' + name, daemon=True).start()
+
+        return future
+
+    # Result of a step, waiting for it if it is still running
+    def get(self, name):
+        return self.futures[name].result()
+
+    # Wait for every step and record the total startup time. Raises the first error
+    def join(self):
+
+        for future in list(self.futures.values()):
+            future.result()
+        self.elapsed = time.perf_counter() - self.started
+        recorder.observe('startup', self.elapsed)
+
+        return self.elapsed
+
+    def report(self):
+
+        lines = ['Startup: ' + str(round(self.elapsed if self.elapsed is not None else time.perf_counter() - self.started, 2)) + 's']
+        for name, seconds in sorted(self.durations.items(), key=lambda x: -x[1]):
+            lines.append('  ' + name + ': ' + str(round(seconds, 2)) + 's')
+
+        return lines
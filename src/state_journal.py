@@ -0,0 +1,223 @@
+# =============================================================================
+# Crash-safe state journal
+# Every change to the per-symbol strategy state (order ids, price levels,
+# tickers, scheduled trades, reference windows) and every completed evaluation
+# is appended as a small framed record to a memory-mapped journal file for the
+# day. A compact snapshot of the full state is written every snapshot_every
+# records, so a restarted process loads the snapshot, replays the records after
+# it and is back to its exact state in milliseconds. Records of order ids are
+# flushed to the file as they are written, so a crash cannot lose a placed or
+# cancelled order. The restored order ids are then reconciled against one broker
+# snapshot
+#
+# Record frame: <length uint32><crc32 uint32><JSON payload>. A zero length marks
+# the end of the journal and a frame whose checksum does not match (a write torn
+# by a crash) ends the replay
+# =============================================================================
+
+import json
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime
+from broker_snapshot import ORDER_CANCELLED, ORDER_REJECTED, ORDER_PENDING
+from symbol_state import LEG_FIELDS, SYMBOL_FIELDS
+
+HEADER = struct.Struct('<II')
+TIME_FIELDS = ['reference_period_start_time', 'reference_period_end_time']
+ORDER_FIELDS = ['entry_orderid', 'tp_orderid', 'sl_orderid', 'trailtp_orderid']
+
+def _encode(field, value):
+    return value.isoformat() if field in TIME_FIELDS and value is not None else value
+
+def _decode(field, value):
+    return datetime.fromisoformat(value) if field in TIME_FIELDS and value is not None else value
+
+class StateJournal:
+
+    # Files are <state_dir>/<name>_<YYYY-MM-DD>.log and .snapshot.json, so each
+    # trading day (and shard) starts from a fresh state
+    def __init__(self, state_dir, day, name='state', initial_size=1 << 20, snapshot_every=500):
+
+        os.makedirs(state_dir, exist_ok=True)
+        prefix = os.path.join(state_dir, name + '_' + day.strftime('%Y-%m-%d'))
+        self.log_path = prefix + '.log'
+        self.snapshot_path = prefix + '.snapshot.json'
+        self.snapshot_every = snapshot_every
+        self.symbol_table = None
+        self.eval_completion_times = None
+        self.records_since_snapshot = 0
+
+        if not os.path.exists(self.log_path):
+            with open(self.log_path, 'wb') as f:
+                f.truncate(initial_size)
+        self.file = open(self.log_path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.offset = self._end_offset()
+        self.flushed = self.offset # records before this offset are on disk
+
+    # Offset after the last intact record
+    def _end_offset(self):
+
+        offset = 0
+        for offset, _ in self._frames(0):
+            pass
+
+        return offset
+
+    # (offset after the frame, payload) of every intact frame from start
+    def _frames(self, start):
+
+        offset = start
+        while offset + HEADER.size <= len(self.mm):
+            length, crc = HEADER.unpack_from(self.mm, offset)
+            end = offset + HEADER.size + length
+            if length == 0 or end > len(self.mm):
+                return
+            payload = self.mm[offset + HEADER.size:end]
+            if zlib.crc32(payload) != crc:
+                return
+            offset = end
+            yield offset, payload
+
+    def _append(self, record, flush=False):
+
+        payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        frame = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        # Keep room for the zero length that marks the end
+        if self.offset + len(frame) + HEADER.size > len(self.mm):
+            self._grow(self.offset + len(frame) + HEADER.size)
+        self.mm[self.offset:self.offset + len(frame)] = frame
+        self.offset += len(frame)
+        if flush:
+            self._flush()
+
+        self.records_since_snapshot += 1
+        if self.records_since_snapshot >= self.snapshot_every and self.symbol_table is not None:
+            self.snapshot()
+
+    # Write the records not yet on disk through to the file. A flush must start on a page boundary
+    def _flush(self):
+
+        start = self.flushed - self.flushed % mmap.ALLOCATIONGRANULARITY
+        self.mm.flush(start, self.offset - start)
+        self.flushed = self.offset
+
+    def _grow(self, min_size):
+
+        size = len(self.mm)
+        while size < min_size:
+            size *= 2
+        self.mm.close()
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    # Change listener registered on the symbol table
+    def record(self, symbol, opt_type, field, value):
+        self._append(['s', symbol, opt_type, field, _encode(field, value)], flush=field in ORDER_FIELDS)
+
+    def record_eval(self, time_now):
+        self._append(['e', time_now])
+
+    # Restore the state saved for the day into symbol_table and eval_completion_times,
+    # then start journaling their changes. Returns the number of records replayed
+    def restore(self, symbol_table, eval_completion_times):
+
+        start = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            start = snapshot['offset']
+            eval_completion_times.extend(snapshot['evals'])
+            for symbol, values in snapshot['symbols'].items():
+                if symbol not in symbol_table.ids:
+                    continue
+                st = symbol_table[symbol]
+                for field in SYMBOL_FIELDS:
+                    setattr(st, field, _decode(field, values[field]))
+                for opt_type in ('CE', 'PE'):
+                    for field in LEG_FIELDS:
+                        setattr(st.leg(opt_type), field, values[opt_type][field])
+
+        replayed = 0
+        for _, payload in self._frames(start):
+            record = json.loads(payload)
+            replayed += 1
+            if record[0] == 'e':
+                if record[1] not in eval_completion_times:
+                    eval_completion_times.append(record[1])
+                continue
+            _, symbol, opt_type, field, value = record
+            if symbol not in symbol_table.ids:
+                continue
+            target = symbol_table[symbol].leg(opt_type) if opt_type else symbol_table[symbol]
+            setattr(target, field, _decode(field, value))
+
+        self.symbol_table = symbol_table
+        self.eval_completion_times = eval_completion_times
+        symbol_table.listeners.append(self.record)
+
+        return replayed
+
+    # Write the full state and the journal offset it covers, atomically
+    def snapshot(self):
+
+        symbols = {}
+        for st in self.symbol_table:
+            values = {field: _encode(field, getattr(st, field)) for field in SYMBOL_FIELDS}
+            for opt_type in ('CE', 'PE'):
+                values[opt_type] = {field: getattr(st.leg(opt_type), field) for field in LEG_FIELDS}
+            symbols[st.symbol] = values
+
+        self.mm.flush()
+        self.flushed = self.offset
+        with open(self.snapshot_path + '.tmp', 'w') as f:
+            json.dump({'offset': self.offset, 'evals': list(self.eval_completion_times), 'symbols': symbols}, f)
+        os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+        self.records_since_snapshot = 0
+
+    def close(self):
+
+        if self.symbol_table is not None:
+            self.snapshot()
+            self.symbol_table.listeners.remove(self.record)
+        self.mm.close()
+        self.file.close()
+
+# Check restored order ids against the broker. Orders the broker does not know or
+# has cancelled or rejected are dropped. A filled take profit order without a
+# trailing order needs nothing here, the next pass sees it filled and places the
+# trailing order. Pending orders at the broker that are not journaled are reported for the
+# table's own symbols only, as other shards hold the rest. Returns a list of messages
+# describing what was found
+def reconcile(symbol_table, broker_snapshot):
+
+    broker_snapshot.poll()
+    if not broker_snapshot.ok:
+        return ['Unable to reconcile restored state: ' + str(broker_snapshot.message)]
+
+    messages = []
+    known = set()
+    for st in symbol_table:
+        for opt_type in ('CE', 'PE'):
+            leg = st.leg(opt_type)
+            for field in ORDER_FIELDS:
+                order_id = getattr(leg, field)
+                if order_id is None or order_id != order_id:
+                    continue
+                status = broker_snapshot.order_status(order_id)
+                if status is None or status in (ORDER_CANCELLED, ORDER_REJECTED):
+                    messages.append(st.symbol + ' ' + opt_type + ': ' + field + ' ' + str(order_id) + ' is no longer live at the broker')
+                    setattr(leg, field, None)
+                    continue
+                known.add(order_id)
+
+            if broker_snapshot.has_position(st.symbol, opt_type) and leg.ticker is None:
+                messages.append(st.symbol + ' ' + opt_type + ': position at the broker without a journaled ticker')
+
+    for order_id, order in broker_snapshot.orders.items():
+        if order.get('status') == ORDER_PENDING and order_id not in known and symbol_table.for_contract(str(order.get('symbol'))) is not None:
+            messages.append('Pending order ' + str(order_id) + ' ' + str(order.get('symbol')) + ' is not in the journal')
+
+    return messages
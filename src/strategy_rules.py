@@ -0,0 +1,39 @@
+# =============================================================================
+# Entry and exit rules of the 75 min breakout strategy
+# Shared by the live loop in main.py and the backtest engine. Every function
+# works on scalars as well as NumPy arrays
+# =============================================================================
+
+import numpy as np
+
+TICK_SIZE = 0.05
+
+def round_to_tick(price, tick_size=TICK_SIZE):
+    return np.round(np.asarray(price) / tick_size) * tick_size
+
+# A gap day is one where the open differs from the previous close by at least the threshold
+def is_gap(prev_close, curr_open, gap_threshold):
+    return np.abs((np.asarray(curr_open) - prev_close) / prev_close) >= gap_threshold
+
+# Call strike: reference high rounded down to the strike increment.
+# Put strike: reference low rounded up to the strike increment
+def call_put_strikes(ref_high, ref_low, strike_incr):
+
+    call_strike = np.floor(np.asarray(ref_high) / float(strike_incr)) * strike_incr
+    put_strike = np.ceil(np.asarray(ref_low) / float(strike_incr)) * strike_incr
+
+    return call_strike, put_strike
+
+# Entry, take profit and stop loss prices from the option's reference bar high and low
+def entry_levels(ref_high, ref_low, entry_buffer, target, stop_loss, sl_buffer, tick_size=TICK_SIZE):
+
+    entry_price = round_to_tick(np.asarray(ref_high) * (1 + entry_buffer), tick_size)
+    tp_price = round_to_tick(entry_price * (1 + target), tick_size)
+    sl_price = round_to_tick(np.maximum(entry_price * (1 - stop_loss), np.asarray(ref_low) * (1 + sl_buffer)), tick_size)
+
+    return entry_price, tp_price, sl_price
+
+# Trailing stop for the second lot once the first lot's target is hit: half way
+# between the target and the highest price seen since, never below the target
+def trail_level(tp_price, high_since_tp, tick_size=TICK_SIZE):
+    return round_to_tick(tp_price + np.maximum(np.asarray(high_since_tp) - tp_price, 0) * 0.5, tick_size)
@@ -0,0 +1,216 @@
+# =============================================================================
+# Parameter sweep over the strategy constants
+# Runs the backtest rules for a grid or a random sample of parameter sets on a
+# process pool. Bars are loaded once and placed in shared memory that all
+# workers map instead of receiving copies. Parameter sets are ordered by the
+# parameters that decide reference windows and strikes (gap threshold and
+# schedule) and sent to the workers in chunks. Each worker keeps the per-day
+# intermediates of the keys it has seen, so they are computed once per key and
+# worker. Sampled gap thresholds are rounded to PREPARE_STEPS so random
+# parameter sets share them too. Results are written as a NumPy structured array (.npy) with one row per
+# parameter set and symbol
+#
+# Usage: python sweep.py <data_dir> <start YYYY-MM-DD> <end YYYY-MM-DD> <output.npy> [n_random_samples]
+# =============================================================================
+
+import itertools
+import math
+import os
+import random
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import shared_memory
+import numpy as np
+import backtest
+
+# Parameters that change the prepared per-day inputs rather than only the levels
+PREPARE_KEYS = ['GAP_THRESHOLD', 'GAP_TRADE_TIME', 'strat_eval_times', 'reference_bar_start_times', 'reference_bar_end_times']
+
+# Sampled values of these prepare keys are rounded to the step
+PREPARE_STEPS = {'GAP_THRESHOLD': 0.0005}
+
+PREPARED_CACHE = 8 # prepare keys whose inputs a worker keeps, per symbol
+
+# Every combination of the listed values, e.g. {'TARGET': [0.02, 0.05], 'STOP_LOSS': [0.05, 0.1]}
+def param_grid(grid):
+
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+# n random parameter sets. ranges maps a key to a (low, high) tuple sampled
+# uniformly or to a list of choices. Keys in steps are rounded to their step
+def param_sample(ranges, n, seed=0, steps=PREPARE_STEPS):
+
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(n):
+        params = {}
+        for key, spec in ranges.items():
+            params[key] = rng.uniform(*spec) if isinstance(spec, tuple) else rng.choice(spec)
+            if key in steps:
+                params[key] = round(round(params[key] / steps[key]) * steps[key], 10)
+        samples.append(params)
+
+    return samples
+
+def _prepare_key(params):
+    return tuple(tuple(params[k]) if isinstance(params[k], list) else params[k] for k in PREPARE_KEYS)
+
+# =============================================================================
+# Shared memory
+# =============================================================================
+
+def _to_shared(array):
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def _from_shared(meta):
+
+    name, shape, dtype = meta
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+# Copy a symbol's market data into shared memory. Returns the blocks (to be
+# unlinked by the caller) and a small picklable description for the workers
+def share_market(market):
+
+    under_shm, under_meta = _to_shared(market.under)
+    options_shm, options_meta = _to_shared(market.options)
+    meta = {'symbol': market.symbol, 'days': market.days, 'option_index': market.option_index,
+            'lot_size': market.lot_size, 'strike_incr': market.strike_incr,
+            'under': under_meta, 'options': options_meta}
+
+    return [under_shm, options_shm], meta
+
+_markets = {}
+_blocks = []
+_prepared = OrderedDict() # (prepare key, symbol) -> prepared inputs, least recently used first
+
+def _init_worker(metas):
+
+    for meta in metas:
+        under_shm, under = _from_shared(meta['under'])
+        options_shm, options = _from_shared(meta['options'])
+        _blocks.extend([under_shm, options_shm])
+        _markets[meta['symbol']] = backtest.MarketData(meta['symbol'], meta['days'], under, meta['option_index'],
+                                                       options, meta['lot_size'], meta['strike_incr'])
+
+def _prepare_cached(symbol, market, params):
+
+    key = (_prepare_key(params), symbol)
+    prepared = _prepared.get(key)
+    if prepared is None:
+        prepared = backtest.prepare(market, params)
+        _prepared[key] = prepared
+        if len(_prepared) > PREPARED_CACHE * len(_markets):
+            _prepared.popitem(last=False)
+    else:
+        _prepared.move_to_end(key)
+
+    return prepared
+
+# Run a chunk of parameter sets, reusing the worker's prepared inputs
+def _run_chunk(chunk):
+
+    rows = []
+    for param_id, params in chunk:
+        for symbol, market in _markets.items():
+            trades = backtest.simulate(market, _prepare_cached(symbol, market, params), params)
+            rows.append((param_id, symbol, trade_stats(trades)))
+
+    return rows
+
+def trade_stats(trades):
+
+    pnl = trades['pnl']
+    if len(pnl) == 0:
+        return {'trades': 0, 'pnl': 0.0, 'win_rate': np.nan, 'max_drawdown': 0.0}
+
+    equity = np.cumsum(pnl)
+    drawdown = np.maximum.accumulate(np.concatenate([[0.0], equity]))[1:] - equity
+
+    return {'trades': len(pnl), 'pnl': float(pnl.sum()), 'win_rate': float((pnl > 0).mean()), 'max_drawdown': float(drawdown.max())}
+
+# Result table with one row per parameter set and symbol
+def results_table(param_sets, rows):
+
+    keys = sorted(set(k for p in param_sets for k in p))
+    fields = [('param_id', 'i4'), ('symbol', 'U16')]
+    for k in keys:
+        numeric = all(isinstance(p[k], (int, float)) for p in param_sets if k in p)
+        fields.append((k, 'f8' if numeric else 'U128'))
+    fields += [('trades', 'i4'), ('pnl', 'f8'), ('win_rate', 'f8'), ('max_drawdown', 'f8')]
+
+    table = np.zeros(len(rows), dtype=fields)
+    for i, (param_id, symbol, stats) in enumerate(sorted(rows, key=lambda x: (x[0], x[1]))):
+        params = param_sets[param_id]
+        table['param_id'][i] = param_id
+        table['symbol'][i] = symbol
+        for k in keys:
+            value = params.get(k, backtest.DEFAULT_PARAMS.get(k))
+            table[k][i] = value if table.dtype[k].kind == 'f' else ','.join(value) if isinstance(value, list) else str(value)
+        for k, v in stats.items():
+            table[k][i] = v
+
+    return table
+
+# Run the strategy over [start, end] for every parameter set. Keys missing from a
+# parameter set take their value from backtest.DEFAULT_PARAMS
+def run_sweep(data_dir, start, end, param_sets, symbols=None, workers=None, chunks_per_worker=4):
+
+    symbols = symbols if symbols is not None else list(backtest.SYMBOL_SPECS)
+    full_sets = [dict(backtest.DEFAULT_PARAMS, **p) for p in param_sets]
+
+    blocks = []
+    metas = []
+    try:
+        for symbol in symbols:
+            days = [d for d in backtest.list_days(data_dir, symbol) if start <= d <= end]
+            market = backtest.load_market_data(data_dir, symbol, days)
+            symbol_blocks, meta = share_market(market)
+            blocks.extend(symbol_blocks)
+            metas.append(meta)
+            del market
+
+        # Sets sharing prepared inputs are next to each other, so most chunks need few keys
+        ordered = sorted(enumerate(full_sets), key=lambda x: repr(_prepare_key(x[1])))
+        workers = workers if workers is not None else os.cpu_count() or 1
+        size = max(1, math.ceil(len(ordered) / (workers * chunks_per_worker)))
+        chunks = [ordered[i:i + size] for i in range(0, len(ordered), size)]
+
+        rows = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(metas,)) as executor:
+            for chunk_rows in executor.map(_run_chunk, chunks):
+                rows.extend(chunk_rows)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return results_table(param_sets, rows)
+
+if __name__ == '__main__':
+
+    data_dir = sys.argv[1]
+    start = datetime.strptime(sys.argv[2], '%Y-%m-%d').date()
+    end = datetime.strptime(sys.argv[3], '%Y-%m-%d').date()
+
+    if len(sys.argv) > 5:
+        param_sets = param_sample({'GAP_THRESHOLD': (0.002, 0.01), 'ENTRY_BUFFER': (0.0, 0.1), 'TARGET': (0.01, 0.2),
+                                   'STOP_LOSS': (0.02, 0.2), 'SL_BUFFER': (0.0, 0.1), 'GAP_TRADE_TIME': ['09:25', '09:30', '09:45']},
+                                  int(sys.argv[5]))
+    else:
+        param_sets = param_grid({'GAP_THRESHOLD': [0.003, 0.0039, 0.005], 'ENTRY_BUFFER': [0.0, 0.02, 0.05],
+                                 'TARGET': [0.02, 0.05, 0.1], 'STOP_LOSS': [0.05, 0.1], 'SL_BUFFER': [0.0, 0.025]})
+
+    results = run_sweep(data_dir, start, end, param_sets)
+    np.save(sys.argv[4], results)
+    best = results[np.argsort(-results['pnl'])[:10]]
+    for row in best:
+        print(row)
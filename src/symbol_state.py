@@ -0,0 +1,113 @@
+# =============================================================================
+# Per-symbol strategy state
+# One compact record per traded underlying, with a CE and a PE leg each holding
+# its order ids, price levels and option ticker. Records are kept in a table
+# indexed by symbol id, so hundreds of underlyings cost a list of small objects
+# instead of a family of dicts that all have to be kept in step. Changes to the
+# strategy fields are reported to the table's listeners (see state_journal.py)
+# =============================================================================
+
+import numpy as np
+
+# Strategy fields, the ones journaled and restored after a restart
+LEG_FIELDS = ['entry_orderid', 'tp_orderid', 'sl_orderid', 'trailtp_orderid',
+              'entry_price', 'tp_price', 'sl_price', 'ticker', 'td_ticker']
+SYMBOL_FIELDS = ['trade_scheduled', 'reference_period_start_time', 'reference_period_end_time']
+
+# True for an unset field: None, or nan as a rejected order id or an unset price
+def isnull(x):
+    return x is None or x != x
+
+class LegState:
+
+    __slots__ = LEG_FIELDS + ['_notify']
+
+    # notify(field, value) is called after every change of a field
+    def __init__(self, notify=None):
+        object.__setattr__(self, '_notify', None)
+        self.entry_orderid = None
+        self.tp_orderid = None
+        self.sl_orderid = None
+        self.trailtp_orderid = None
+        self.entry_price = np.nan
+        self.tp_price = np.nan
+        self.sl_price = np.nan
+        self.ticker = None
+        self.td_ticker = None
+        object.__setattr__(self, '_notify', notify)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if self._notify is not None:
+            self._notify(name, value)
+
+    # Order ids currently held by the leg
+    def order_ids(self):
+        return [x for x in (self.entry_orderid, self.tp_orderid, self.sl_orderid, self.trailtp_orderid)
+                if x is not None and x == x]
+
+class SymbolState:
+
+    __slots__ = ['sid', 'symbol', 'fo_underlying', 'lot_size', 'strike_incr', 'CE', 'PE', '_notify'] + SYMBOL_FIELDS
+
+    # notify(symbol, opt_type, field, value) is called after every change of a
+    # strategy field, with opt_type '' for the symbol's own fields
+    def __init__(self, sid, symbol, fo_underlying, lot_size, strike_incr, notify=None):
+        object.__setattr__(self, '_notify', None)
+        self.sid = sid
+        self.symbol = symbol
+        self.fo_underlying = fo_underlying
+        self.lot_size = lot_size
+        self.strike_incr = strike_incr
+        self.CE = LegState((lambda field, value: notify(symbol, 'CE', field, value)) if notify is not None else None)
+        self.PE = LegState((lambda field, value: notify(symbol, 'PE', field, value)) if notify is not None else None)
+        self.trade_scheduled = None
+        self.reference_period_start_time = None
+        self.reference_period_end_time = None
+        object.__setattr__(self, '_notify', notify)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if self._notify is not None and name in SYMBOL_FIELDS:
+            self._notify(self.symbol, '', name, value)
+
+    def leg(self, opt_type):
+        return self.CE if opt_type == 'CE' else self.PE
+
+    # True when neither leg has an order working or to be tracked
+    def is_idle(self):
+        return len(self.CE.order_ids()) == 0 and len(self.PE.order_ids()) == 0
+
+class SymbolTable:
+
+    def __init__(self, SYMBOLS, underlying_mapping, lotsize_mapping, min_strike_incr_mapping):
+
+        self.listeners = [] # called as listener(symbol, opt_type, field, value) on every change
+        self.states = [SymbolState(sid, s, underlying_mapping[s], lotsize_mapping[s], min_strike_incr_mapping[s], self._changed)
+                       for sid, s in enumerate(SYMBOLS)]
+        self.ids = {x.symbol: x.sid for x in self.states} # symbol -> symbol id
+        self.fo_ids = {x.fo_underlying: x.sid for x in self.states} # F&O underlying code -> symbol id
+
+    def _changed(self, symbol, opt_type, field, value):
+        for listener in self.listeners:
+            listener(symbol, opt_type, field, value)
+
+    def __getitem__(self, symbol):
+        return self.states[self.ids[symbol]]
+
+    # State of the underlying a Fyers contract (e.g. 'NSE:NIFTY21061715700CE') is written on, or None.
+    # Expiry digits must follow the underlying, so NIFTY does not match NIFTYIT contracts
+    def for_contract(self, contract):
+
+        name = contract[contract.find(':') + 1:]
+        for i in range(1, len(name)):
+            if name[i].isdigit() and name[:i] in self.fo_ids:
+                return self.states[self.fo_ids[name[:i]]]
+
+        return None
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __len__(self):
+        return len(self.states)
@@ -0,0 +1,123 @@
+# =============================================================================
+# Tick-driven trailing stop engine
+# Once a leg's first lot has taken profit, the second lot is protected by a stop
+# order that trails half way between the target and the highest option price
+# seen since (strategy_rules.trail_level). The engine follows the option's live
+# ticks, keeps the highest price incrementally and moves the existing stop order
+# with a broker modify, only when the level has risen by at least one tick and
+# no more often than min_interval seconds of the session clock per order. A
+# level held back by the rate limit is sent with the next tick or the next flush.
+# The order's level only moves once the broker has accepted the modify; a
+# rejected level is dropped and the next higher one is tried
+# =============================================================================
+
+import threading
+from clock import SystemClock
+from strategy_rules import TICK_SIZE, trail_level
+from events import event_log
+
+class Trail:
+
+    __slots__ = ['key', 'td_symbol', 'ticker', 'label', 'order_id', 'tp_price', 'high', 'level', 'sent', 'pending', 'last_sent']
+
+    def __init__(self, key, td_symbol, order_id, tp_price, level, ticker='', label=''):
+        self.key = key
+        self.td_symbol = td_symbol
+        self.ticker = ticker # broker symbol of the order
+        self.label = label # latency label of its modifies
+        self.order_id = order_id
+        self.tp_price = tp_price
+        self.high = tp_price
+        self.level = level # stop price of the order at the broker
+        self.sent = None # level of the modify awaiting the broker's answer
+        self.pending = None # higher level waiting for the rate limit
+        self.last_sent = None # session time of the last modify
+
+class TrailingEngine:
+
+    def __init__(self, order_gateway, min_interval=1.0, tick_size=TICK_SIZE, clock=None):
+        self.order_gateway = order_gateway
+        self.min_interval = min_interval
+        self.tick_size = tick_size
+        self.clock = clock if clock is not None else SystemClock()
+        self.trails = {} # key -> Trail
+        self.by_symbol = {} # td symbol -> {key: Trail}
+        self.modifications = 0
+        self.lock = threading.RLock() # modify callbacks may run in the sending thread
+
+    # Trail the stop order order_id on td_symbol (ticker at the broker). level is the
+    # order's current stop price (the target when it was just placed)
+    def start(self, key, td_symbol, order_id, tp_price, level=None, ticker='', label=''):
+
+        trail = Trail(key, td_symbol, order_id, tp_price, tp_price if level is None else level, ticker, label)
+        with self.lock:
+            self._stop(key)
+            self.trails[key] = trail
+            self.by_symbol.setdefault(td_symbol, {})[key] = trail
+
+    def stop(self, key):
+        with self.lock:
+            self._stop(key)
+
+    def _stop(self, key):
+
+        trail = self.trails.pop(key, None)
+        if trail is not None:
+            self.by_symbol[trail.td_symbol].pop(key, None)
+            if len(self.by_symbol[trail.td_symbol]) == 0:
+                del self.by_symbol[trail.td_symbol]
+
+    def active(self, key):
+        return key in self.trails
+
+    # Tick listener registered on the bar store
+    def on_tick(self, symbol, timestamp, ltp):
+
+        if symbol not in self.by_symbol:
+            return
+        with self.lock:
+            for trail in list(self.by_symbol.get(symbol, {}).values()):
+                if ltp > trail.high:
+                    trail.high = ltp
+                    level = float(trail_level(trail.tp_price, trail.high, self.tick_size))
+                    floor = trail.level if trail.sent is None else max(trail.level, trail.sent)
+                    if level >= floor + self.tick_size - 1e-9 and (trail.pending is None or level > trail.pending):
+                        trail.pending = level
+                self._send(trail)
+
+    # Send levels held back by the rate limit
+    def flush(self):
+        with self.lock:
+            for trail in self.trails.values():
+                self._send(trail)
+
+    def _send(self, trail):
+
+        if trail.pending is None:
+            return
+        now = self.clock.now()
+        if trail.last_sent is not None and (now - trail.last_sent).total_seconds() < self.min_interval:
+            return
+        level, trail.pending = trail.pending, None
+        trail.sent = level
+        trail.last_sent = now
+        self.modifications += 1
+        future = self.order_gateway.modify(trail.order_id, stop_price=level, symbol=trail.ticker, label=trail.label)
+        future.add_done_callback(lambda f, trail=trail, level=level: self._modified(trail, level, f))
+
+    def _modified(self, trail, level, future):
+
+        try:
+            response = future.result()
+        except Exception as e:
+            response = {'message': repr(e)}
+        accepted = isinstance(response, dict) and response.get('code') == 200
+        with self.lock:
+            if trail.sent == level:
+                trail.sent = None
+            if accepted and level > trail.level:
+                trail.level = level
+        if not accepted:
+            message = str(response.get('message') if isinstance(response, dict) else response)
+            event_log.emit('trail_rejected', trail.key + ': Unable to move trailing stop to ' + str(level) + ': ' + message,
+                           key=trail.key, order_id=trail.order_id, level=level, error=message)
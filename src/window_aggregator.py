@@ -0,0 +1,109 @@
+# =============================================================================
+# Streaming reference window aggregator
+# Keeps the OHLC of every configured reference window (the 75 min bars and the
+# gap bar) per symbol and day, updated from each live tick and history bar as
+# it arrives. A minute-of-day lookup table gives the windows a tick belongs to,
+# so each tick costs O(1) whatever the number of symbols or the window length,
+# and the reference OHLC is final as soon as its window closes.
+#
+# Ticks may arrive late or out of order: open and close are kept with their
+# timestamps, so an earlier tick can still become the open and only a later one
+# the close. Ticks for a window that is already final (its end minute has been
+# passed by late_seconds) are dropped and counted. Windows are keyed by trading
+# day, so the previous day's 14:15-15:29 window survives the session boundary,
+# and days older than keep_days are pruned
+# =============================================================================
+
+import threading
+from datetime import datetime, timedelta
+
+MINUTES_PER_DAY = 24 * 60
+
+def _minute_of_day(hhmm):
+    t = datetime.strptime(hhmm, '%H:%M')
+    return t.hour * 60 + t.minute
+
+class WindowAggregator:
+
+    # windows: list of (start, end) 'HH:MM' minute bounds, both inclusive
+    def __init__(self, windows, late_seconds=2, keep_days=3):
+
+        self.windows = [(_minute_of_day(a), _minute_of_day(b)) for a, b in windows]
+        self.late = timedelta(seconds=late_seconds)
+        self.keep_days = keep_days
+        self.minute_windows = [[] for _ in range(MINUTES_PER_DAY)] # minute of day -> window ids containing it
+        for wid, (start, end) in enumerate(self.windows):
+            for minute in range(start, end + 1):
+                self.minute_windows[minute].append(wid)
+        self.window_ids = {w: wid for wid, w in enumerate(self.windows)}
+
+        self.state = {} # (symbol, date, window id) -> [o, o_time, h, l, c, c_time]
+        self.dates = set()
+        self.dropped_late = 0
+        self.lock = threading.Lock()
+
+    def _update(self, symbol, day, minute, t_first, o, h, l, c, t_last, now):
+
+        wids = self.minute_windows[minute]
+        if len(wids) == 0:
+            return
+
+        cutoff = self._cutoff(now) if now is not None else None
+        for wid in wids:
+            if cutoff is not None and cutoff >= (day, self.windows[wid][1]):
+                self.dropped_late += 1
+                continue
+            key = (symbol, day, wid)
+            x = self.state.get(key)
+            if x is None:
+                self.state[key] = [o, t_first, h, l, c, t_last]
+                if day not in self.dates:
+                    self._add_date(day)
+                continue
+            if t_first < x[1]:
+                x[0], x[1] = o, t_first
+            if h > x[2]:
+                x[2] = h
+            if l < x[3]:
+                x[3] = l
+            if t_last >= x[5]:
+                x[4], x[5] = c, t_last
+
+    # (date, minute of day) of the last minute closed to ticks at now
+    def _cutoff(self, now):
+        t = now - self.late
+        return (t.date(), t.hour * 60 + t.minute - 1)
+
+    def _add_date(self, day):
+
+        self.dates.add(day)
+        if len(self.dates) > self.keep_days:
+            keep = set(sorted(self.dates)[-self.keep_days:])
+            self.state = {k: v for k, v in self.state.items() if k[1] in keep}
+            self.dates = keep
+
+    # A live tick. now is the receive time used to decide whether the tick is too
+    # late for a window that has closed; None accepts it unconditionally
+    def on_tick(self, symbol, timestamp, ltp, now=None):
+
+        with self.lock:
+            self._update(symbol, timestamp.date(), timestamp.hour * 60 + timestamp.minute, timestamp,
+                         ltp, ltp, ltp, ltp, timestamp, now)
+
+    # A completed 1 min bar, e.g. from history at startup
+    def on_bar(self, symbol, bar_time, o, h, l, c):
+
+        with self.lock:
+            self._update(symbol, bar_time.date(), bar_time.hour * 60 + bar_time.minute, bar_time,
+                         o, h, l, c, bar_time + timedelta(seconds=59), None)
+
+    # OHLC dict of the window from start to end (datetimes on the same day), None
+    # if the window is not tracked or has no data
+    def ohlc(self, symbol, start, end):
+
+        wid = self.window_ids.get((start.hour * 60 + start.minute, end.hour * 60 + end.minute))
+        if wid is None or start.date() != end.date():
+            return None
+        with self.lock:
+            x = self.state.get((symbol, start.date(), wid))
+            return {'o': x[0], 'h': x[2], 'l': x[3], 'c': x[4]} if x is not None else None